@@ -0,0 +1,93 @@
+"""
+Spreads reads over several local stand-in MLDB hosts answering with
+different latencies, one of them failing for a while, and prints how many
+reads each host got, the ejections and the per host latencies. No MLDB
+needed.
+usage: python benchmarks/bench_balance.py [num_reads] [strategy]
+"""
+from __future__ import absolute_import, division, print_function
+
+import json
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+from pymldb import Connection
+
+num_reads = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+strategy = sys.argv[2] if len(sys.argv) > 2 else 'least_outstanding'
+# seconds each stand-in takes to answer, and until when it answers 503
+HOSTS = [{'delay': 0.002, 'failing_until': 0},
+         {'delay': 0.005, 'failing_until': 0},
+         {'delay': 0.02, 'failing_until': 0},
+         {'delay': 0.002, 'failing_until': time.time() + 1}]
+BODY = json.dumps({'_rowName': ['a'], 'x': [1]}).encode('utf-8')
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_handler(config):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # else the body waits for the ACK of the headers
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            self.rfile.read(length)
+            time.sleep(config['delay'])
+            failing = time.time() < config['failing_until']
+            self.send_response(503 if failing else 200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(BODY)))
+            self.end_headers()
+            self.wfile.write(BODY)
+
+        def log_message(self, *args):
+            pass
+    return Handler
+
+
+servers = [Server(('127.0.0.1', 0), make_handler(config))
+           for config in HOSTS]
+for server in servers:
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+hosts = ['http://127.0.0.1:{}'.format(s.server_address[1]) for s in servers]
+
+conn = Connection(hosts, notebook=False, pool_size=32, balance=strategy)
+conn.balancer.eject_sec = 0.5
+
+
+def read(_):
+    try:
+        conn.query('SELECT x FROM ds', format='soa')
+    except Exception:
+        pass
+
+
+start = time.time()
+pool = ThreadPool(16)
+pool.map(read, range(num_reads))
+pool.close()
+elapsed = time.time() - start
+print('{} reads in {:.2f} s ({:.0f}/s), strategy {}'.format(
+    num_reads, elapsed, num_reads / elapsed, strategy))
+stats = conn.host_stats()
+for host, config in zip(hosts, HOSTS):
+    s = stats[host]
+    print('{} delay {:>4.0f} ms: {:>5} reads {:>4} errors {:>2} ejections '
+          'p50 {:>5.1f} ms p99 {:>5.1f} ms'.format(
+              host, config['delay'] * 1000, s['requests'], s['errors'],
+              s['ejections'], s['latency']['p50'] * 1000,
+              s['latency']['p99'] * 1000))
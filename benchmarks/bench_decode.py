@@ -0,0 +1,50 @@
+"""
+Compares the record based ('table' + DataFrame.from_records) and the
+columnar ('soa' + typed numpy arrays) decoding of query results.
+No MLDB needed, the payloads are generated locally.
+usage: python benchmarks/bench_decode.py [num_rows]
+"""
+from __future__ import absolute_import, division, print_function
+
+import json
+import sys
+import time
+import tracemalloc
+
+from pymldb import _table_to_dataframe
+from pymldb.decode import loads, soa_to_dataframe
+
+num_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+row_names = ['row{}'.format(i) for i in range(num_rows)]
+columns = {
+    'int': list(range(num_rows)),
+    'float': [i * 0.5 for i in range(num_rows)],
+    'sparse': [None if i % 3 else i for i in range(num_rows)],
+    'str': ['v{}'.format(i % 100) for i in range(num_rows)],
+}
+
+table = [['_rowName'] + list(columns)]
+for i, name in enumerate(row_names):
+    table.append([name] + [values[i] for values in columns.values()])
+table = json.dumps(table).encode('utf-8')
+
+soa = dict(columns)
+soa['_rowName'] = row_names
+soa = json.dumps(soa).encode('utf-8')
+
+
+def bench(name, decode, payload):
+    tracemalloc.start()
+    start = time.time()
+    df = decode(payload)
+    elapsed = time.time() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert len(df) == num_rows
+    print('{:>8}: {:>12,.0f} rows/sec  peak {:>8.1f} MiB'.format(
+        name, num_rows / elapsed, peak / 2 ** 20))
+
+
+print('{:,} rows, {} columns'.format(num_rows, len(columns)))
+bench('records', lambda p: _table_to_dataframe(json.loads(p)), table)
+bench('soa', lambda p: soa_to_dataframe(loads(p)), soa)
@@ -0,0 +1,48 @@
+"""
+Measures the time `import pymldb` takes in a fresh interpreter and fails
+(exit code 1) when it regresses: either a heavy dependency is imported
+eagerly again or the import takes longer than the budget.
+usage: python benchmarks/bench_import.py [budget_ms]
+"""
+from __future__ import absolute_import, division, print_function
+
+import json
+import subprocess
+import sys
+
+# only needed once the matching feature is used
+LAZY_MODULES = ['pandas', 'numpy', 'requests', 'tqdm', 'pygments', 'IPython',
+                'multiprocessing', 'orjson', 'ujson']
+RUNS = 10
+
+budget_ms = float(sys.argv[1]) if len(sys.argv) > 1 else 100
+
+code = """
+import json, sys, time
+start = time.time()
+import pymldb
+elapsed = time.time() - start
+print(json.dumps([elapsed, [m for m in %r if m in sys.modules]]))
+""" % (LAZY_MODULES,)
+
+timings = []
+loaded = set()
+for _ in range(RUNS):
+    out = subprocess.check_output([sys.executable, '-c', code])
+    elapsed, modules = json.loads(out.decode('utf-8'))
+    timings.append(elapsed * 1000)
+    loaded.update(modules)
+
+timings.sort()
+median = timings[len(timings) // 2]
+print('import pymldb: median {:.1f} ms, min {:.1f} ms, max {:.1f} ms'.format(
+    median, timings[0], timings[-1]))
+
+failed = False
+if loaded:
+    print('FAIL: imported eagerly: {}'.format(', '.join(sorted(loaded))))
+    failed = True
+if median > budget_ms:
+    print('FAIL: median above the {:.0f} ms budget'.format(budget_ms))
+    failed = True
+sys.exit(1 if failed else 0)
@@ -0,0 +1,51 @@
+"""
+Compares Column.value_counts/count/unique computed by MLDB (GROUP BY
+pushdown) with downloading the column and computing them with pandas:
+bytes received and latency. Needs a running MLDB; a dataset named
+bench_pushdown is created and deleted.
+usage: python benchmarks/bench_pushdown.py [host] [num_rows]
+"""
+from __future__ import absolute_import, division, print_function
+
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from pymldb import Connection
+from pymldb.data import BatFrame
+
+host = sys.argv[1] if len(sys.argv) > 1 else 'http://localhost'
+num_rows = int(sys.argv[2]) if len(sys.argv) > 2 else 200000
+dataset = 'bench_pushdown'
+
+conn = Connection(host, notebook=False)
+values = np.arange(num_rows) % 100
+df = pd.DataFrame({'x': np.where(values % 10 == 0, np.nan, values)},
+                  index=['row{}'.format(i) for i in range(num_rows)])
+conn.put_dataframe(dataset, df)
+column = BatFrame(conn.uri + '/v1/datasets/' + dataset, conn)['x']
+
+
+def bench(name, fn):
+    conn.metrics.reset()
+    start = time.time()
+    fn()
+    elapsed = time.time() - start
+    received = sum(s['bytes_received'] for s in conn.stats().values())
+    print('{:>20}: {:>8.1f} ms  {:>12,} bytes received'.format(
+        name, elapsed * 1000, received))
+
+
+try:
+    print('{:,} rows'.format(num_rows))
+    bench('value_counts pull', lambda: column.toPandas().value_counts())
+    bench('value_counts push', column.value_counts)
+    bench('count pull', lambda: column.toPandas().count())
+    bench('count push', column.count)
+    bench('unique pull', lambda: set(column.toPandas().values))
+    # on a plain column, unique() uses the /columns/<id>/values route
+    bench('unique push', (column * 1).unique)
+finally:
+    conn.delete('/v1/datasets/' + dataset)
@@ -0,0 +1,45 @@
+"""
+Measures how fast BatFrame/Column expressions are built: chained filters,
+sorts and slices, and the buildQuery() calls made when they are executed.
+No MLDB needed, nothing is sent.
+usage: python benchmarks/bench_query_build.py [iterations]
+"""
+from __future__ import absolute_import, division, print_function
+
+import sys
+import time
+
+from pymldb.data import BatFrame
+
+iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+# queries are only built, the connection is never used
+bf = BatFrame('http://localhost/v1/datasets/bench', conn=object())
+
+
+def filter_chain():
+    a = bf['a']
+    b = bf['b']
+    return bf[((a > 1) & (b < 2)) | (a == 'x')].sort(['a', 'b']).head(10)
+
+
+def arithmetic():
+    return ((bf['a'] * 2 + bf['b']) / 3 - 1)[10:100]
+
+
+def repeated_build(frame):
+    return lambda: [frame.query.buildQuery() for _ in range(10)]
+
+
+def bench(name, fn):
+    start = time.time()
+    for _ in range(iterations):
+        fn()
+    elapsed = time.time() - start
+    print('{:>16}: {:>10,.0f} ops/sec  {:>6.1f} us/op'.format(
+        name, iterations / elapsed, elapsed / iterations * 1e6))
+
+
+print('{:,} iterations'.format(iterations))
+bench('filter chain', filter_chain)
+bench('arithmetic', arithmetic)
+bench('10x buildQuery', repeated_build(filter_chain()))
@@ -0,0 +1,106 @@
+"""
+Compares HTTP over a Unix domain socket (Connection('unix:///path')) with
+HTTP over loopback TCP: latency of sequential GETs and throughput of
+concurrent ones, against local stand-in servers returning the same JSON
+body. No MLDB needed.
+usage: python benchmarks/bench_unix.py [num_requests] [body_bytes]
+"""
+from __future__ import absolute_import, division, print_function
+
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn, UnixStreamServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn, UnixStreamServer
+
+from pymldb import Connection
+
+num_requests = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+body_bytes = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+BODY = json.dumps({'x': 'x' * body_bytes}).encode('utf-8')
+THREADS = 8
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.rfile.read(length)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY)
+
+    def address_string(self):
+        return 'local'  # Unix sockets have no client address
+
+    def log_message(self, *args):
+        pass
+
+
+class TCPHandler(Handler):
+    # else the body waits for the ACK of the headers
+    disable_nagle_algorithm = True
+
+
+class TCPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class UnixServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(server):
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+
+tcp = TCPServer(('127.0.0.1', 0), TCPHandler)
+serve(tcp)
+socket_path = os.path.join(tempfile.mkdtemp(), 'mldb.sock')
+unix = UnixServer(socket_path, Handler)
+serve(unix)
+
+
+def bench(name, host):
+    conn = Connection(host, notebook=False, pool_size=THREADS)
+    conn.get('/v1/types')  # connect
+    latencies = []
+    for _ in range(num_requests // 4):
+        start = time.time()
+        conn.get('/v1/types')
+        latencies.append(time.time() - start)
+    latencies.sort()
+
+    start = time.time()
+    pool = ThreadPool(THREADS)
+    pool.map(lambda _: conn.get('/v1/types'), range(num_requests))
+    pool.close()
+    elapsed = time.time() - start
+    print('{:>4}: p50 {:>6.0f} us  p99 {:>6.0f} us  {:>7.0f} requests/s '
+          '({} threads)'.format(
+              name, latencies[len(latencies) // 2] * 1e6,
+              latencies[int(len(latencies) * 0.99)] * 1e6,
+              num_requests / elapsed, THREADS))
+    conn.close()
+
+
+try:
+    print('{} requests, {} bytes bodies'.format(num_requests, len(BODY)))
+    bench('tcp', 'http://127.0.0.1:{}'.format(tcp.server_address[1]))
+    bench('unix', 'unix://' + socket_path)
+finally:
+    unix.server_close()
+    os.remove(socket_path)
@@ -8,12 +8,21 @@ from __future__ import absolute_import, division, print_function
 
 from .version import __version__  # noqa
 
-import pandas as pd
-import requests
 import json
 from pymldb.util import add_repr_html_to_response
 import threading
-from .progress_monitor import ProgressMonitor
+from .transport import Transport, unix_socket_uri
+from .prefetch import prefetched
+from .sql import split_limit_offset, split_clauses, add_where, has_aggregate
+from .decode import loads, soa_to_dataframe
+from .cache import (ResultCache, MetadataCache, referenced_datasets,  # noqa
+                    dataset_from_url)
+from .metrics import Metrics  # noqa
+from .balance import HostBalancer  # noqa
+try:
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote
 
 
 def decorate_response(fn):
@@ -40,126 +49,558 @@ class ResourceError(Exception):
 
 class Connection(object):
 
-    def __init__(self, host="http://localhost", notebook=True):
-        if not host.startswith("http"):
-            raise Exception("URIs must start with 'http'")
-        if host[-1] == '/':
-            host = host[:-1]
-        self.uri = host
+    def __init__(self, host="http://localhost", notebook=True, pool_size=10,
+                 warm_up=0, transport=None, columnar=True, cache=None,
+                 metrics=None, coalesce=False, metadata_ttl_sec=30,
+                 balance='least_outstanding'):
+        """
+        Parameters
+        ----------
+        host: string or list of strings
+            Base URI of MLDB, e.g. http://localhost:8080, or unix:// followed
+            by the path of the Unix domain socket MLDB listens on, e.g.
+            unix:///var/run/mldb.sock, to skip the TCP stack when MLDB runs
+            on the same machine. Given a list of
+            hosts serving the same data (read-only replicas), reads are
+            spread over all of them and everything else is sent to the
+            first one, the primary, see balance.py. Per host statistics are
+            reported by host_stats().
+        notebook: bool
+            Whether progress should be displayed as notebook widgets.
+        pool_size: int
+            Maximum number of keep-alive connections kept open to the host.
+            Ignored when transport is given.
+        warm_up: int
+            Number of pooled connections to open right away.
+        transport: Transport
+            Share an existing pooled transport instead of creating one.
+        columnar: bool
+            Decode DataFrame results from the column oriented 'soa' format
+            into typed numpy arrays (the default) rather than from one
+            record per row.
+        cache: ResultCache
+            Opt-in cache of query results. It is invalidated for a dataset
+            whenever this connection writes to /v1/datasets/<id>/...
+        metrics: Metrics
+            Where requests are recorded, see stats(). Ignored when transport
+            is given. Metrics(enabled=False) turns the recording off.
+        coalesce: bool
+            Opt-in: concurrent identical GETs (e.g. several threads asking
+            for the same query or BatFrame.shape) share a single request and
+            its response. Ignored when transport is given. The number of
+            suppressed duplicates is reported by stats() per route and by
+            transport.coalescer.stats().
+        metadata_ttl_sec: float or None
+            How long the status (row and value counts) and column list of a
+            dataset are reused by BatFrame and Column before being fetched
+            again, see the metadata attribute. Writes through this
+            connection invalidate them. 0 disables the cache, None keeps
+            them until invalidated.
+        balance: string
+            How the host of each read is picked when there are several:
+            'least_outstanding' or 'latency'. Ignored when transport is
+            given.
+        """
+        hosts = list(host) if isinstance(host, (list, tuple)) else [host]
+        for i, host in enumerate(hosts):
+            if host.startswith('unix://'):
+                host = hosts[i] = unix_socket_uri(host[len('unix://'):])
+            if not host.startswith("http"):
+                raise Exception("URIs must start with 'http' or 'unix://'")
+            if host[-1] == '/':
+                hosts[i] = host[:-1]
+        self.hosts = hosts
+        self.uri = hosts[0]
         self.notebook = notebook
+        self.columnar = columnar
+        self.cache = cache
+        self._tracker = None
+        self._lock = threading.Lock()
+        if transport is None:
+            balancer = None
+            if len(hosts) > 1:
+                balancer = HostBalancer(hosts, balance)
+            transport = Transport(pool_size=pool_size, metrics=metrics,
+                                  coalesce=coalesce, balancer=balancer)
+        self.transport = transport
+        self.metadata = MetadataCache(transport, metadata_ttl_sec)
+        # lookups of large key sets (ix[list], isin), see pymldb.lookup:
+        # maximum size of an IN (...) sent in one query, percent-encoded,
+        # so that URLs stay below the common 8 KB limit
+        self.max_in_bytes = 6000
+        # number of concurrent queries a split IN is run with
+        self.lookup_parallel = 4
+        # number of keys from which they are uploaded to a temporary
+        # dataset instead, None to never do so
+        self.temp_dataset_keys = None
+        # maximum size of the SELECT of fused aggregates (agg, describe)
+        # before they are split in concurrent queries
+        self.max_select_bytes = 8000
+        if warm_up:
+            for host in hosts:
+                self.transport.warm_up(host, warm_up)
 
     @decorate_response
     def get(self, url, data=None, **kwargs):
-        params = {}
-        for k, v in kwargs.iteritems():
-            if type(v) in [dict, list]:
-                v = json.dumps(v)
-            params[str(k)] = v
-        return requests.get(self.uri + url, params=params, json=data)
+        return self.transport.get(self.uri + url,
+                                  params=_encode_params(kwargs), json=data)
 
     @decorate_response
     def put(self, url, payload=None):
         if payload is None:
             payload = {}
-        return requests.put(self.uri + url, json=payload)
+        try:
+            return self.transport.put(self.uri + url, json=payload)
+        finally:
+            self._invalidate(url, payload)
 
     @decorate_response
     def post(self, url, payload=None):
         if payload is None:
             payload = {}
-        return requests.post(self.uri + url, json=payload)
+        try:
+            return self.transport.post(self.uri + url, json=payload)
+        finally:
+            self._invalidate(url, payload)
 
     @decorate_response
     def delete(self, url):
-        return requests.delete(self.uri + url)
+        try:
+            return self.transport.delete(self.uri + url)
+        finally:
+            self._invalidate(url)
+
+    def _invalidate(self, url, payload=None):
+        """
+        Drops the cached results and metadata of the datasets written to by
+        a call.
+        """
+        datasets = []
+        dataset = dataset_from_url(url)
+        if dataset is not None:
+            datasets.append(dataset)
+        # procedures (re)create their output dataset
+        params = payload.get('params') if isinstance(payload, dict) else None
+        if isinstance(params, dict):
+            output = params.get('outputDataset')
+            if isinstance(output, dict):
+                output = output.get('id')
+            if output:
+                datasets.append(output)
+        for dataset in datasets:
+            self.metadata.invalidate(dataset)
+            if self.cache is not None:
+                self.cache.invalidate_dataset(dataset)
+
+    def _cached_content(self, url, params, fetch, datasets=None):
+        """
+        Returns the body of the GET response returned by fetch(), going
+        through the result cache when there is one. Only 200 responses are
+        cached. The entry is tagged with datasets, which default to those
+        referenced by the 'q' param.
+        """
+        if self.cache is None:
+            return fetch().content
+        if datasets is None:
+            datasets = referenced_datasets(params.get('q', ''))
+        key = self.cache.key(url, params)
+        content = self.cache.get(key, self._dataset_version)
+        if content is None:
+            generation = self.cache.generation(datasets)
+            response = fetch()
+            content = response.content
+            if response.status_code == 200:
+                self.cache.put(key, content, datasets, self._dataset_version,
+                               generation)
+        return content
+
+    def _dataset_version(self, dataset):
+        resp = self.transport.get(
+            self.uri + '/v1/datasets/' + quote(dataset, safe=''))
+        if resp.status_code != 200:
+            return None
+        return json.dumps(resp.json().get('status'), sort_keys=True)
+
+    def close(self):
+        """Closes the pooled connections."""
+        self.transport.close()
+
+    @property
+    def metrics(self):
+        """The Metrics recording every request, e.g. to add export hooks."""
+        return self.transport.metrics
+
+    def stats(self):
+        """
+        Returns the request statistics, keyed by "VERB /route/<id>": count,
+        errors, coalesced duplicates, status codes, bytes sent/received and
+        latency histograms per phase (connect, server, download, total,
+        decode, build).
+        """
+        return self.transport.metrics.snapshot()
+
+    @property
+    def balancer(self):
+        """
+        The HostBalancer spreading reads over the hosts, or None with a
+        single host. Its max_failures, eject_sec and slow_sec attributes
+        tune when a host is ejected.
+        """
+        return self.transport.balancer
+
+    def host_stats(self):
+        """
+        Returns, by host, the requests in flight, the requests, errors and
+        ejections counted, whether the host is currently ejected, and its
+        latency (seconds): moving average and histogram quantiles.
+        """
+        if self.transport.balancer is None:
+            return {}
+        return self.transport.balancer.stats()
 
-    def query(self, sql, **kwargs):
+    def query(self, sql, parallel=None, **kwargs):
         """
         Shortcut for GET /v1/query, except with argument format='dataframe'
         (the default), in which case it will simply wrap the result of the GET
         query to /v1/query (with format='table') in a `pandas.DataFrame`.
+        When the connection is columnar, format='soa' is requested instead
+        and each column is decoded into a typed numpy array.
+
+        With parallel=N (format='dataframe' only), the query is split in N
+        disjoint partitions on rowHash() which are run concurrently over the
+        pooled transport. The partitions are concatenated in partition order.
+        Queries with GROUP BY, HAVING, ORDER BY, LIMIT or OFFSET clauses
+        cannot be partitioned and are rejected, as are aggregates without
+        GROUP BY since they would be computed per partition.
         """
+        if parallel is not None and parallel > 1:
+            if kwargs.get('format', 'dataframe') != 'dataframe':
+                raise ValueError("parallel requires format='dataframe'")
+            return self._parallel_query(sql, parallel)
         if 'format' not in kwargs or kwargs['format'] == 'dataframe':
-            resp = self.get('/v1/query', data={'q': sql, 'format': 'table'}).json()
-            if len(resp) == 0:
-                return pd.DataFrame()
-            else:
-                return pd.DataFrame.from_records(resp[1:], columns=resp[0],
-                                                 index="_rowName")
+            return self._query_dataframe(sql)
         kwargs['q'] = sql
-        return self.get('/v1/query', **kwargs).json()
+        content = self._cached_content(
+            '/v1/query', kwargs, lambda: self.get('/v1/query', **kwargs))
+        with self.metrics.time('GET', '/v1/query', 'decode'):
+            return loads(content)
+
+    def _query_dataframe(self, sql):
+        data = _dataframe_params(sql, self.columnar)
+        content = self._cached_content(
+            '/v1/query', data, lambda: self.get('/v1/query', data=data))
+        with self.metrics.time('GET', '/v1/query', 'decode'):
+            result = loads(content)
+        with self.metrics.time('GET', '/v1/query', 'build'):
+            return _to_dataframe(result, self.columnar)
+
+    def _parallel_query(self, sql, parallel):
+        for clause, body in split_clauses(sql):
+            if clause in ('GROUP BY', 'HAVING', 'ORDER BY', 'LIMIT', 'OFFSET'):
+                raise ValueError(
+                    "Queries with a {} clause cannot be run in parallel"
+                    .format(clause))
+            if clause == 'SELECT' and has_aggregate(body):
+                raise ValueError("Queries with aggregates cannot be run in "
+                                 "parallel, see query_shards")
+        queries = [add_where(sql, 'rowHash() % {} = {}'.format(parallel, i))
+                   for i in range(parallel)]
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(parallel)
+        try:
+            frames = pool.map(self.query, queries)
+        finally:
+            pool.close()
+            pool.join()
+        frames = [df for df in frames if len(df)]
+        import pandas as pd
+        if len(frames) == 0:
+            return pd.DataFrame()
+        return pd.concat(frames)
+
+    def query_shards(self, sql_template, datasets, parallel=None,
+                     format='dataframe'):
+        """
+        Runs sql_template on every dataset of datasets (shards sharing a
+        schema, e.g. one per day) concurrently, `parallel` (default: all)
+        at a time, and merges the results. sql_template is a SELECT whose
+        {dataset} placeholder is replaced by the id of each dataset, e.g.
+        'SELECT x FROM {dataset} WHERE y > 0'.
+
+        Plain SELECTs are concatenated in the order of datasets. With ORDER
+        BY, the sorted results are merged, LIMIT and OFFSET being applied
+        to the merged rows (each shard only returns LIMIT + OFFSET rows).
+        With GROUP BY or aggregates, count, sum, min, max and avg are
+        combined group by group from the results of every shard, other
+        aggregates and HAVING/ORDER BY/LIMIT are rejected. See
+        pymldb.shards.ShardPlan.
+
+        Returns a `pandas.DataFrame`, or the merged result in the 'soa'
+        format with format='soa'.
+        """
+        if format not in ('dataframe', 'soa'):
+            raise ValueError("format must be 'dataframe' or 'soa'")
+        from .shards import query_shards
+        result = query_shards(self, sql_template, datasets, parallel)
+        if format == 'soa':
+            return result
+        with self.metrics.time('GET', '/v1/query', 'build'):
+            return soa_to_dataframe(result)
+
+    def query_iter(self, sql, chunk_rows=10000, prefetch=1):
+        """
+        Runs sql page by page (LIMIT/OFFSET) and yields each page as a
+        `pandas.DataFrame` of at most chunk_rows rows. The next `prefetch`
+        pages are fetched by a background thread while the current one is
+        being processed, so memory stays bounded by a few chunks.
+
+        A trailing LIMIT/OFFSET in sql is honored. Without an ORDER BY clause
+        MLDB returns rows in a stable (row hash) order, which makes pages
+        disjoint as long as the dataset is not modified while iterating.
+        """
+        if chunk_rows <= 0:
+            raise ValueError("chunk_rows must be positive")
+        return prefetched(self._iter_pages(sql, chunk_rows), prefetch)
+
+    def _iter_pages(self, sql, chunk_rows):
+        sql, limit, offset = split_limit_offset(sql)
+        fetched = 0
+        while limit is None or fetched < limit:
+            num_rows = chunk_rows
+            if limit is not None:
+                num_rows = min(num_rows, limit - fetched)
+            page = '{} LIMIT {} OFFSET {}'.format(sql, num_rows,
+                                                  offset + fetched)
+            df = self._query_dataframe(page)
+            if len(df):
+                yield df
+            if len(df) < num_rows:
+                return
+            fetched += len(df)
+
+    def put_dataframe(self, dataset_id, df, chunk_rows=5000, workers=4,
+                      max_in_flight=None, timestamp=None, create=True,
+                      dataset_type='tabular', commit=True):
+        """
+        Uploads a `pandas.DataFrame` to dataset_id, one row per DataFrame row
+        named after its index, skipping null cells.
+
+        Rows are sent chunk_rows at a time to /v1/datasets/<id>/multirows by
+        `workers` concurrent threads, with at most max_in_flight (default
+        2 * workers) chunks waiting to be sent. The dataset is created first
+        (PUT with dataset_type) if create, and committed once at the end if
+        commit. timestamp defaults to now.
 
-    def put_and_track(self, url, payload, refresh_rate_sec=1):
+        Returns upload statistics: rows, chunks, bytes, seconds and
+        rows_per_sec.
+        """
+        from .ingest import put_dataframe
+        return put_dataframe(self, dataset_id, df, chunk_rows, workers,
+                             max_in_flight, timestamp, create, dataset_type,
+                             commit)
+
+    def ingest(self, dataset_id, source, format=None, row_name_column=None,
+               chunk_rows=5000, workers=4, max_in_flight=None, timestamp=None,
+               create=True, dataset_type='tabular', commit=True,
+               progress=True, report_sec=5):
+        """
+        Streams rows from source into dataset_id with bounded memory.
+
+        source is either the path of a CSV (with a header line) or JSON
+        lines file, possibly gzipped, or an iterable of dicts or of
+        (rowName, dict) pairs. format ('csv' or 'jsonl') is guessed from the
+        file extension when not given. Rows are named after the
+        row_name_column value, or numbered from 1. CSV cells are typed
+        (int, float or string) and empty cells are skipped.
+
+        A producer thread reads, parses and groups rows in chunks of
+        chunk_rows, which `workers` threads upload through
+        /v1/datasets/<id>/multirows. At most max_in_flight chunks wait in
+        between: when the server slows down, reading pauses, so memory
+        does not depend on the size of the input. Overloaded responses
+        (429/503) are retried with a backoff.
+
+        progress is called with the upload statistics every report_sec
+        seconds and at the end (True prints them, False is silent). The
+        final statistics are returned. See put_dataframe for create,
+        dataset_type, timestamp and commit.
+        """
+        from .ingest import ingest
+        return ingest(self, dataset_id, source, format, row_name_column,
+                      chunk_rows, workers, max_in_flight, timestamp, create,
+                      dataset_type, commit, progress, report_sec)
+
+    def function_client(self, function_id, window_ms=0, max_batch=64,
+                        workers=None, warm_up=True):
+        """
+        Returns a FunctionClient applying function_id with low latency,
+        e.g. for real-time scoring: client(input) returns the output of the
+        function, client.submit(input) queues calls sent in parallel and
+        client.stats() reports p50/p99 latencies. workers (default:
+        the pool size) connections are opened right away if warm_up. See
+        pymldb.functions.FunctionClient.
+        """
+        from .functions import FunctionClient
+        return FunctionClient(self, function_id, window_ms, max_batch,
+                              workers, warm_up)
+
+    @property
+    def tracker(self):
+        """
+        The RunTracker polling every run tracked by put_and_track and
+        post_and_track from a single thread.
+        """
+        if self._tracker is None:
+            with self._lock:
+                if self._tracker is None:
+                    from .progress_monitor import RunTracker
+                    self._tracker = RunTracker()
+        return self._tracker
+
+    def put_and_track(self, url, payload, refresh_rate_sec=1, policy=None):
         """
         Put and track progress, displaying progress bars.
 
+        The run is polled according to policy, by default an
+        AdaptivePolling starting fast and backing off up to
+        max(refresh_rate_sec, 30) seconds while progress is steady. See
+        polling.py for the policies, and tracker.poll_counts for the number
+        of polls made per run.
+
         May display the wrong progress if 2 things post/put on the same
         procedure name at the same time.
         """
-        if not url.startswith('/v1/procedures'):
-            raise Exception("The only supported route is /v1/procedures")
-        parts = url.split('/')
-        len_parts = len(parts)
-        if len_parts not in [4, 6]:
-            raise Exception(
-                "You must either PUT a procedure or a procedure run")
-
-        proc_id = parts[3]
-        run_id = None
-
-        if len_parts == 4:
-                if 'params' not in payload:
-                    payload['params'] = {}
-                payload['params']['runOnCreation'] = True
-        elif len_parts == 6:
-            run_id = parts[-1]
+        proc_id, run_id = _tracked_put(url, payload)
 
+        from .progress_monitor import ProgressMonitor
         pm = ProgressMonitor(self, refresh_rate_sec, proc_id, run_id,
-                             self.notebook)
-        t = threading.Thread(target=pm.monitor_progress)
-        t.start()
+                             self.notebook,
+                             policy or _default_policy(refresh_rate_sec))
+        self.tracker.track(pm)
 
         try:
             return self.put(url, payload)
         except Exception as e:
             print(e)
         finally:
-            pass
-            pm.event.set()
-            t.join()
+            self.tracker.stop(pm)
 
-    def post_and_track(self, url, payload, refresh_rate_sec=1):
+    def post_and_track(self, url, payload, refresh_rate_sec=1, policy=None):
         """
         Post and track progress, displaying progress bars.
 
+        See put_and_track for refresh_rate_sec and policy.
+
         May display the wrong progress if 2 things post/put on the same
         procedure name at the same time.
         """
-        if not url.startswith('/v1/procedures'):
-            raise Exception("The only supported route is /v1/procedures")
-        if url.endswith('/runs'):
-            raise Exception(
-                "Posting and tracking run is unsupported at the moment")
-        if len(url.split('/')) != 3:
-            raise Exception("You must POST a procedure")
-
-        if 'params' not in payload:
-            payload['params'] = {}
-        payload['params']['runOnCreation'] = False
+        _tracked_post(url, payload)
 
         res = self.post('/v1/procedures', payload).json()
         proc_id = res['id']
 
+        from .progress_monitor import ProgressMonitor
         pm = ProgressMonitor(self, refresh_rate_sec, proc_id,
-                             notebook=self.notebook)
-
-        t = threading.Thread(target=pm.monitor_progress)
-        t.start()
+                             notebook=self.notebook,
+                             policy=policy or _default_policy(refresh_rate_sec))
+        self.tracker.track(pm)
 
         try:
             return self.post('/v1/procedures/{}/runs'.format(proc_id), {})
         except Exception as e:
             print(e)
         finally:
-            pm.event.set()
-            t.join()
+            self.tracker.stop(pm)
+
+
+def _encode_params(kwargs):
+    """Query string params of kwargs, dicts and lists encoded as JSON."""
+    params = {}
+    for k, v in kwargs.items():
+        if type(v) in [dict, list]:
+            v = json.dumps(v)
+        params[str(k)] = v
+    return params
+
+
+def _dataframe_params(sql, columnar):
+    """Params of the GET /v1/query behind a format='dataframe' query."""
+    return {'q': sql, 'format': 'soa' if columnar else 'table'}
+
+
+def _to_dataframe(result, columnar):
+    """Builds the DataFrame of a query run with _dataframe_params."""
+    if columnar:
+        return soa_to_dataframe(result)
+    return _table_to_dataframe(result)
+
+
+def _tracked_put(url, payload):
+    """
+    Checks that url is a procedure or a procedure run, making a new
+    procedure run on creation. Returns (procedure id, run id or None).
+    """
+    if not url.startswith('/v1/procedures'):
+        raise Exception("The only supported route is /v1/procedures")
+    parts = url.split('/')
+    len_parts = len(parts)
+    if len_parts not in [4, 6]:
+        raise Exception(
+            "You must either PUT a procedure or a procedure run")
+
+    if len_parts == 4:
+        if 'params' not in payload:
+            payload['params'] = {}
+        payload['params']['runOnCreation'] = True
+        return parts[3], None
+    return parts[3], parts[-1]
+
+
+def _tracked_post(url, payload):
+    """
+    Checks that url is the procedure collection. The procedure is created
+    without running, the run being posted separately.
+    """
+    if not url.startswith('/v1/procedures'):
+        raise Exception("The only supported route is /v1/procedures")
+    if url.endswith('/runs'):
+        raise Exception(
+            "Posting and tracking run is unsupported at the moment")
+    if len(url.split('/')) != 3:
+        raise Exception("You must POST a procedure")
+
+    if 'params' not in payload:
+        payload['params'] = {}
+    payload['params']['runOnCreation'] = False
+
+
+def _default_policy(refresh_rate_sec):
+    from .polling import AdaptivePolling
+    return AdaptivePolling(max_interval=max(refresh_rate_sec, 30))
+
+
+def _table_to_dataframe(resp):
+    """Wraps the result of a format='table' query in a pandas.DataFrame."""
+    import pandas as pd
+    if len(resp) == 0:
+        return pd.DataFrame()
+    return pd.DataFrame.from_records(resp[1:], columns=resp[0],
+                                     index="_rowName")
+
+
+_default_connections = {}
+_default_connections_lock = threading.Lock()
+
+
+def _default_connection(url):
+    """
+    Returns the Connection shared by every object created without one (e.g.
+    BatFrame(url)) and pointing to the same host as url.
+    """
+    host = url.split('/v1/', 1)[0].rstrip('/')
+    with _default_connections_lock:
+        conn = _default_connections.get(host)
+        if conn is None:
+            conn = Connection(host, notebook=False)
+            _default_connections[host] = conn
+    return conn
@@ -0,0 +1,144 @@
+#
+# aggregate.py
+# Copyright (c) 2016 Datacratic. All rights reserved.
+#
+# Aggregates (count, sum, mean, min, max, std, var) of many expressions
+# computed by MLDB in a single SELECT, split in a few concurrent queries
+# only when the SELECT gets too long. Used by BatFrame.agg/describe,
+# Column.agg and BatFrame.groupby.
+#
+from __future__ import absolute_import, division, print_function
+
+from pymldb.expr import Compiler, Func, Raw, to_sql, unique
+
+# aggregate name -> MLDB aggregator
+_FUNCTIONS = {'count': 'count', 'sum': 'sum', 'mean': 'avg', 'min': 'min',
+              'max': 'max', 'std': 'stddev', 'var': 'variance'}
+# sample estimators, NaN below 2 values like pandas
+_MOMENTS = ('std', 'var')
+AGGREGATES = ('count', 'sum', 'mean', 'min', 'max') + _MOMENTS
+# only defined over numbers
+_ARITHMETIC = ('sum', 'mean') + _MOMENTS
+
+
+class _Numbers(Raw):
+    """SQL of an expression where it is a number, else null."""
+
+
+def numeric(expr):
+    """expr where it is a number, else null."""
+    if isinstance(expr, _Numbers):
+        return expr
+    sql = to_sql(expr)
+    return _Numbers('CASE WHEN {} IS NUMBER THEN {} END'.format(sql, sql))
+
+
+def parts(agg, expr):
+    """
+    The MLDB aggregates needed to compute agg over expr. agg None stands
+    for expr itself, e.g. a GROUP BY key. sum, mean, std and var ignore
+    the values which aren't numbers (e.g. of a string column), which would
+    fail the whole query.
+    """
+    if agg is None:
+        return [expr]
+    if agg not in _FUNCTIONS:
+        raise ValueError("Unknown aggregate {}, expected one of {}".format(
+            agg, ', '.join(AGGREGATES)))
+    if agg in _ARITHMETIC:
+        expr = numeric(expr)
+    return [Func(_FUNCTIONS[agg], expr)]
+
+
+def combine(agg, values):
+    """Value of agg out of the values of its parts."""
+    if agg in _MOMENTS and values[0] is None:
+        return float('nan')
+    return values[0]
+
+
+def _alias(i):
+    return '_{}'.format(i)
+
+
+def _select_chunks(sqls, max_bytes):
+    """Groups the indices of sqls so that each SELECT fits in max_bytes."""
+    chunk = []
+    size = 0
+    for i, sql in enumerate(sqls):
+        length = len(sql) + len(_alias(i)) + 7  # ' AS "",'
+        if chunk and size + length > max_bytes:
+            yield chunk
+            chunk = []
+            size = 0
+        chunk.append(i)
+        size += length
+    if chunk:
+        yield chunk
+
+
+def run_parts(query, exprs, max_bytes=8000, parallel=4):
+    """
+    Runs SELECT exprs with the other clauses of query (WHERE, GROUP BY...,
+    GROUP BY 1 when it has none) and returns (row names, {expr: values}).
+    When the SELECT exceeds max_bytes, it is split across up to `parallel`
+    concurrent queries whose rows are matched by row name, which requires
+    the query not to have a LIMIT. Errors raise a ResourceError.
+    """
+    compiler = Compiler()
+    exprs = unique(exprs)
+    sqls = [compiler.sql(e) for e in exprs]
+    if not query.GROUPBY:
+        query = query.replace(GROUPBY=('1',))
+    chunks = list(_select_chunks(sqls, max_bytes))
+    if query.LIMIT is not None or query.OFFSET is not None:
+        chunks = [list(range(len(sqls)))]
+
+    def run(chunk):
+        select = tuple('{} AS "{}"'.format(sqls[i], _alias(i))
+                       for i in chunk)
+        return query.replace(SELECT=select).executeQuery(format='soa',
+                                                         strict=True)
+
+    if len(chunks) == 1 or parallel <= 1:
+        results = [run(chunk) for chunk in chunks]
+    else:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(parallel, len(chunks)))
+        try:
+            results = pool.map(run, chunks)
+        finally:
+            pool.close()
+            pool.join()
+
+    row_names = results[0].get('_rowName', [])
+    values = {}
+    for chunk, result in zip(chunks, results):
+        names = result.get('_rowName', [])
+        if names == row_names:
+            order = range(len(names))
+        else:
+            position = dict((name, i) for i, name in enumerate(names))
+            order = [position.get(name) for name in row_names]
+        for i in chunk:
+            column = result.get(_alias(i), [None] * len(names))
+            values[exprs[i]] = [None if j is None else column[j]
+                                for j in order]
+    return row_names, values
+
+
+def aggregate(query, specs, max_bytes=8000, parallel=4):
+    """
+    Computes specs, a list of (agg, expr), over the rows of query (one
+    result row, or one per group when query has a GROUP BY). Returns
+    (row names, [values of each spec]). Parts shared by several specs (e.g.
+    count for count and std) are computed once.
+    """
+    needed = [parts(agg, expr) for agg, expr in specs]
+    row_names, values = run_parts(
+        query, [p for ps in needed for p in ps], max_bytes, parallel)
+    results = []
+    for (agg, _), ps in zip(specs, needed):
+        columns = [values[p] for p in ps]
+        results.append([combine(agg, row) for row in zip(*columns)])
+    return row_names, results
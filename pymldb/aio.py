@@ -0,0 +1,288 @@
+#
+# aio.py
+# Copyright (c) 2016 Datacratic. All rights reserved.
+#
+# AsyncConnection: the get/put/post/delete/query and procedure tracking
+# calls of Connection as asyncio coroutines, over the non-blocking aiohttp
+# client. Python 3.5+ only and not imported by `import pymldb`, aiohttp is
+# imported on first use.
+#
+from __future__ import absolute_import, division, print_function
+
+import asyncio
+try:
+    from urllib.parse import urlencode
+except ImportError:
+    from urllib import urlencode
+
+from pymldb import (ResourceError, _dataframe_params, _default_policy,
+                    _encode_params, _to_dataframe, _tracked_post,
+                    _tracked_put)
+from pymldb.decode import dumps, loads
+from pymldb.metrics import Metrics, clock
+
+_JSON_HEADERS = {'Content-Type': 'application/json'}
+
+
+def _aiohttp():
+    try:
+        import aiohttp
+    except ImportError:
+        raise ImportError("AsyncConnection requires aiohttp: "
+                          "pip install pymldb[async]")
+    return aiohttp
+
+
+class _Request(object):
+
+    def __init__(self, method, url):
+        self.method = method
+        self.url = url
+
+
+class Response(object):
+    """
+    Response of an AsyncConnection call, read in full. Has the attributes
+    of a requests.Response used with pymldb: status_code, reason, headers,
+    content, text, json() and request.method/url.
+    """
+
+    def __init__(self, method, url, status_code, reason, headers, content):
+        self.request = _Request(method, url)
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8')
+
+    def json(self):
+        return loads(self.content)
+
+    def __repr__(self):
+        return '<Response [{}]>'.format(self.status_code)
+
+
+class AsyncConnection(object):
+    """
+    Coroutine version of Connection, for asyncio applications:
+
+        async with AsyncConnection('http://localhost:8080') as conn:
+            frames = await asyncio.gather(*[conn.query(sql) for sql in sqls])
+
+    At most max_concurrency requests are sent at once, the others wait for
+    their turn without blocking the event loop, so thousands of calls can be
+    gathered. The HTTP session is created by the first call and bound to
+    its event loop.
+    """
+
+    def __init__(self, host="http://localhost", max_concurrency=100,
+                 pool_size=None, columnar=True, metrics=None,
+                 timeout_sec=None, notebook=False):
+        """
+        Parameters
+        ----------
+        host: string
+            Base URI of MLDB, e.g. http://localhost:8080, or unix:// followed
+            by the path of the Unix domain socket MLDB listens on.
+        max_concurrency: int
+            Maximum number of requests in flight.
+        pool_size: int
+            Maximum number of keep-alive connections kept open to the host.
+            Defaults to max_concurrency.
+        columnar: bool
+            See Connection.
+        metrics: Metrics
+            Where requests are recorded, see stats().
+        timeout_sec: float or None
+            Timeout of each request, None to wait forever.
+        notebook: bool
+            Whether the progress of tracked procedures is displayed as
+            notebook widgets.
+        """
+        self.socket_path = None
+        if host.startswith('unix://'):
+            self.socket_path = host[len('unix://'):]
+            host = 'http://localhost'
+        if not host.startswith("http"):
+            raise Exception("URIs must start with 'http' or 'unix://'")
+        if host[-1] == '/':
+            host = host[:-1]
+        self.uri = host
+        self.max_concurrency = max_concurrency
+        self.pool_size = pool_size or max_concurrency
+        self.columnar = columnar
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.timeout_sec = timeout_sec
+        self.notebook = notebook
+        self._session = None
+        self._semaphore = None
+
+    def _open(self):
+        if self._session is None:
+            aiohttp = _aiohttp()
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            if self.socket_path is not None:
+                connector = aiohttp.UnixConnector(self.socket_path,
+                                                  limit=self.pool_size)
+            else:
+                connector = aiohttp.TCPConnector(limit=self.pool_size)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout_sec))
+        return self._session
+
+    async def request(self, method, url, params=None, json=None):
+        """
+        Sends a request to url (a full URL) and returns its Response,
+        whatever its status. json is the payload, serialized with the
+        fastest encoder available.
+        """
+        session = self._open()
+        body = None if json is None else dumps(json)
+        if params:
+            # aiohttp only takes strings and numbers, requests str()s them
+            params = dict((k, v if isinstance(v, (str, int, float)) and
+                           not isinstance(v, bool) else str(v))
+                          for k, v in params.items())
+        async with self._semaphore:
+            start = clock()
+            try:
+                async with session.request(
+                        method, url, params=params, data=body,
+                        headers=_JSON_HEADERS if body is not None else None
+                        ) as resp:
+                    content = await resp.read()
+                    response = Response(method, url, resp.status, resp.reason,
+                                        resp.headers, content)
+            except Exception:
+                self.metrics.record_request(method, url, None, 0, 0,
+                                            {'total': clock() - start})
+                raise
+        sent = len(url) + (len(body) if body is not None else 0)
+        if params:
+            sent += len(urlencode(params)) + 1
+        self.metrics.record_request(method, url, response.status_code, sent,
+                                    len(content), {'total': clock() - start})
+        return response
+
+    async def _checked(self, method, url, params=None, json=None):
+        response = await self.request(method, self.uri + url, params, json)
+        if response.status_code < 200 or response.status_code >= 400:
+            raise ResourceError(response)
+        return response
+
+    async def get(self, url, data=None, **kwargs):
+        return await self._checked('GET', url, _encode_params(kwargs), data)
+
+    async def put(self, url, payload=None):
+        return await self._checked('PUT', url, json=payload or {})
+
+    async def post(self, url, payload=None):
+        return await self._checked('POST', url, json=payload or {})
+
+    async def delete(self, url):
+        return await self._checked('DELETE', url)
+
+    async def query(self, sql, **kwargs):
+        """
+        Same as Connection.query, without parallel: with format='dataframe'
+        (the default) the result is wrapped in a `pandas.DataFrame`, with
+        another format the decoded JSON is returned. Results are decoded on
+        the event loop.
+        """
+        if 'format' not in kwargs or kwargs['format'] == 'dataframe':
+            data = _dataframe_params(sql, self.columnar)
+            response = await self.get('/v1/query', data=data)
+            with self.metrics.time('GET', '/v1/query', 'decode'):
+                result = loads(response.content)
+            with self.metrics.time('GET', '/v1/query', 'build'):
+                return _to_dataframe(result, self.columnar)
+        kwargs['q'] = sql
+        response = await self.get('/v1/query', **kwargs)
+        with self.metrics.time('GET', '/v1/query', 'decode'):
+            return loads(response.content)
+
+    async def put_and_track(self, url, payload, refresh_rate_sec=1,
+                            policy=None):
+        """
+        Coroutine version of Connection.put_and_track. The run is polled
+        from the event loop while the PUT is in flight. Errors are raised.
+        """
+        proc_id, run_id = _tracked_put(url, payload)
+        return await self._track(self.put(url, payload), proc_id, run_id,
+                                 policy or _default_policy(refresh_rate_sec))
+
+    async def post_and_track(self, url, payload, refresh_rate_sec=1,
+                             policy=None):
+        """Coroutine version of Connection.post_and_track."""
+        _tracked_post(url, payload)
+        proc_id = (await self.post('/v1/procedures', payload)).json()['id']
+        return await self._track(
+            self.post('/v1/procedures/{}/runs'.format(proc_id), {}), proc_id,
+            None, policy or _default_policy(refresh_rate_sec))
+
+    async def _track(self, call, proc_id, run_id, policy):
+        """Awaits call, logging the progress of the run as policy says."""
+        sl = None
+        task = asyncio.ensure_future(call)
+        runs = '/v1/procedures/{}/runs'.format(proc_id)
+        state = None
+        interval = policy.first()
+        try:
+            while True:
+                done, _ = await asyncio.wait([task], timeout=interval)
+                if done:
+                    break
+                progress = None
+                if run_id is None:
+                    response = await self.request('GET', self.uri + runs)
+                    if response.status_code == 200 and response.json():
+                        run_id = response.json()[0]
+                else:
+                    response = await self.request(
+                        'GET', '{}{}/{}'.format(self.uri, runs, run_id))
+                    if response.status_code == 200:
+                        run = response.json()
+                        state = run['state']
+                        progress = run.get('progress')
+                        if state == 'executing' and progress:
+                            if sl is None:
+                                from pymldb.steps_logger import getStepsLogger
+                                sl = getStepsLogger(self.notebook)
+                            sl.log_progress_steps(progress.get('steps',
+                                                               [progress]))
+                interval = policy.next(state, progress, clock())
+        except BaseException:
+            # polling failed: don't leave the call running unobserved
+            task.cancel()
+            task.add_done_callback(
+                lambda t: t.cancelled() or t.exception())
+            raise
+        result = task.result()
+        if sl is not None:
+            # as ProgressMonitor, only a finished run closes the progress
+            response = await self.request(
+                'GET', '{}{}/{}'.format(self.uri, runs, run_id))
+            if response.status_code == 200 and \
+                    response.json()['state'] == 'finished':
+                sl.clean_finish()
+        return result
+
+    def stats(self):
+        """Request statistics, see Connection.stats."""
+        return self.metrics.snapshot()
+
+    async def close(self):
+        """Closes the pooled connections."""
+        if self._session is not None:
+            session, self._session = self._session, None
+            await session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
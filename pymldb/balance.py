@@ -0,0 +1,165 @@
+#
+# balance.py
+# Copyright (c) 2016 Datacratic. All rights reserved.
+#
+# Distribution of the reads of a Connection over several MLDB hosts serving
+# the same data (read-only replicas), with temporary ejection of the hosts
+# that fail or are too slow. Writes stay on the primary host.
+#
+from __future__ import absolute_import, division, print_function
+
+import itertools
+import threading
+
+from .metrics import Histogram, clock
+
+STRATEGIES = ('least_outstanding', 'latency')
+
+
+class _Host(object):
+
+    def __init__(self, uri):
+        self.uri = uri
+        self.outstanding = 0
+        self.requests = 0
+        self.errors = 0
+        self.failures = 0  # consecutive
+        self.ejections = 0
+        self.ejected_until = 0
+        self.latency = None  # moving average, seconds
+        self.histogram = Histogram()
+
+    def summary(self, now):
+        latency = self.histogram.summary()
+        return {
+            'outstanding': self.outstanding,
+            'requests': self.requests,
+            'errors': self.errors,
+            'ejections': self.ejections,
+            'ejected': self.ejected_until > now,
+            'latency_avg': self.latency,
+            'latency': dict((k, latency[k])
+                            for k in ('mean', 'p50', 'p90', 'p99', 'max')),
+        }
+
+
+class HostBalancer(object):
+    """
+    Picks the host each read is sent to, out of hosts (base URIs) whose first
+    one is the primary.
+
+    GETs addressed to the primary are sent to:
+      - 'least_outstanding': the host with the fewest requests in flight,
+        the fastest one on ties
+      - 'latency': the host with the smallest (requests in flight + 1) *
+        moving average of its latency
+    A read failing to connect is retried on the other hosts. GETs of
+    /v1/procedures (runs created by writes) and all other verbs go to the
+    primary.
+
+    A host is ejected for eject_sec seconds after max_failures consecutive
+    failures: connection errors, 5xx responses, or responses slower than
+    slow_sec (None: never too slow). Until it succeeds again, a single
+    failure ejects it again. Ejections are counted in stats().
+    When every host is ejected, the one coming back first is used.
+    """
+
+    def __init__(self, hosts, strategy='least_outstanding', max_failures=3,
+                 eject_sec=10, slow_sec=None, decay=0.2):
+        if strategy not in STRATEGIES:
+            raise ValueError("Unknown strategy {}, expected one of {}".format(
+                strategy, ', '.join(STRATEGIES)))
+        self.hosts = [_Host(uri) for uri in hosts]
+        self.primary = self.hosts[0].uri
+        self.strategy = strategy
+        self.max_failures = max_failures
+        self.eject_sec = eject_sec
+        self.slow_sec = slow_sec
+        # weight of the last request in the latency moving average
+        self.decay = decay
+        # spreads ties between idle hosts
+        self._turn = itertools.count()
+        self._lock = threading.Lock()
+
+    def _cost(self, host):
+        if self.strategy == 'latency':
+            return ((host.outstanding + 1) * (host.latency or 0),
+                    host.outstanding)
+        return (host.outstanding, host.latency or 0)
+
+    def acquire(self, exclude=()):
+        """Picks a host for a read and counts it as in flight."""
+        now = clock()
+        with self._lock:
+            candidates = [h for h in self.hosts if h not in exclude]
+            available = [h for h in candidates if h.ejected_until <= now]
+            if available:
+                start = next(self._turn) % len(available)
+                available = available[start:] + available[:start]
+                host = min(available, key=self._cost)
+            else:
+                host = min(candidates, key=lambda h: h.ejected_until)
+            host.outstanding += 1
+            return host
+
+    def release(self, host, seconds, failed):
+        """Records the outcome of a read sent to host by acquire()."""
+        failed = failed or (self.slow_sec is not None and
+                            seconds > self.slow_sec)
+        with self._lock:
+            host.outstanding -= 1
+            host.requests += 1
+            host.histogram.add(seconds)
+            if host.latency is None:
+                host.latency = seconds
+            else:
+                host.latency += self.decay * (seconds - host.latency)
+            if not failed:
+                host.failures = 0
+                return
+            host.errors += 1
+            host.failures += 1
+            if host.failures >= self.max_failures:
+                # back from ejection, a single failure ejects it again
+                host.failures = self.max_failures - 1
+                host.ejections += 1
+                host.ejected_until = clock() + self.eject_sec
+
+    def balanced(self, method, url):
+        """Whether the request can be sent to any host."""
+        return method == 'GET' and url.startswith(self.primary + '/') and \
+            not url.startswith(self.primary + '/v1/procedures')
+
+    def send(self, request, method, url, kwargs):
+        """
+        Sends the request with request(method, url, **kwargs), to the host
+        picked by acquire() when it is a read, else to the primary.
+        """
+        if len(self.hosts) == 1 or not self.balanced(method, url):
+            return request(method, url, **kwargs)
+        import requests
+        path = url[len(self.primary):]
+        tried = []
+        while True:
+            host = self.acquire(tried)
+            start = clock()
+            try:
+                response = request(method, host.uri + path, **kwargs)
+            except requests.RequestException as e:
+                self.release(host, clock() - start, True)
+                tried.append(host)
+                if len(tried) == len(self.hosts) or not isinstance(
+                        e, (requests.ConnectionError, requests.Timeout)):
+                    raise
+                continue
+            except Exception:
+                self.release(host, clock() - start, True)
+                raise
+            self.release(host, clock() - start, response.status_code >= 500)
+            return response
+
+    def stats(self):
+        """Returns the state and latency (seconds) of each host, by URI."""
+        now = clock()
+        with self._lock:
+            return dict((h.uri, h.summary(now)) for h in self.hosts)
@@ -0,0 +1,348 @@
+#
+# cache.py
+# Copyright (c) 2016 Datacratic. All rights reserved.
+#
+# Client side cache of query results. Entries are the raw response bodies,
+# kept in a byte-size bounded LRU with a TTL, and are tagged with the datasets
+# they were read from so that writes can invalidate them. Dataset metadata
+# (status and columns) is cached separately, per dataset.
+#
+from __future__ import absolute_import, division, print_function
+
+import copy
+import re
+import threading
+import time
+from collections import OrderedDict
+try:
+    from urllib.parse import unquote
+except ImportError:
+    from urllib import unquote
+
+from .sql import split_list
+
+_TOKEN = re.compile(
+    r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")|(\s+)|([A-Za-z_]\w*)")
+# case insensitive words, identifiers are case sensitive
+_KEYWORDS = frozenset("""
+    SELECT NAMED FROM WHEN WHERE GROUP ORDER BY HAVING LIMIT OFFSET AS ASC
+    DESC AND OR NOT IS NULL TRUE FALSE IN LIKE BETWEEN CASE THEN ELSE END
+    JOIN INNER OUTER LEFT RIGHT FULL ON EXCLUDING
+    """.split())
+_DATASET_REF = re.compile(r'\b(?:FROM|JOIN)\s+', re.IGNORECASE)
+_NAME = re.compile(r'"(?:[^"]|"")+"|[A-Za-z_][\w.]*')
+_DATASET_ROUTE = re.compile(r'^/v1/datasets/([^/?]+)(/[^?]*)?')
+
+
+def _normalize_token(match):
+    if match.group(1):
+        return match.group(1)
+    if match.group(2):
+        return ' '
+    word = match.group(3)
+    return word.upper() if word.upper() in _KEYWORDS else word
+
+
+def normalize_sql(sql):
+    """
+    Collapses whitespace and upper cases keywords outside of strings and
+    quoted identifiers, so that equivalent spellings share a cache entry.
+    """
+    sql = _TOKEN.sub(_normalize_token, sql)
+    return sql.strip().rstrip(';').strip()
+
+
+def _table_names(sql, pos, datasets):
+    """
+    Adds the datasets of the table expression at sql[pos:] to datasets,
+    looking into the arguments of table functions, e.g. transpose(ds) or
+    merge(a, b). Subqueries are skipped, their own FROM is found anyway.
+    """
+    match = _NAME.match(sql, pos)
+    if match is None:
+        return
+    name = match.group()
+    end = match.end()
+    while end < len(sql) and sql[end].isspace():
+        end += 1
+    if name.startswith('"'):
+        datasets.add(name[1:-1].replace('""', '"'))
+    elif end < len(sql) and sql[end] == '(':
+        depth = 0
+        for close in range(end, len(sql)):
+            if sql[close] == '(':
+                depth += 1
+            elif sql[close] == ')':
+                depth -= 1
+                if depth == 0:
+                    break
+        for arg in split_list(sql[end + 1:close]):
+            # {...}: configuration of the function
+            if not arg.startswith('{'):
+                _table_names(arg, 0, datasets)
+    else:
+        datasets.add(name)
+
+
+def referenced_datasets(sql):
+    """
+    Names of the datasets appearing after FROM or JOIN in sql, including
+    the arguments of table functions.
+    """
+    datasets = set()
+    for match in _DATASET_REF.finditer(sql):
+        _table_names(sql, match.end(), datasets)
+    return datasets
+
+
+def dataset_from_url(url):
+    """Id of the dataset a /v1/datasets/<id>/... url points to, or None."""
+    if '/v1/' not in url:
+        return None
+    match = _DATASET_ROUTE.match(url[url.index('/v1/'):])
+    if match is None:
+        return None
+    return unquote(match.group(1))
+
+
+class ResultCache(object):
+    """
+    Thread-safe LRU cache of query results bounded by the total size of the
+    cached bodies.
+
+    Parameters
+    ----------
+    max_bytes: int
+        Entries are evicted, least recently used first, once the cached
+        bodies exceed this size.
+    ttl_sec: float or None
+        Entries older than this are never served. None means no expiry.
+    revalidate_sec: float or None
+        When set, the status of the datasets an entry was read from is
+        fetched again at most every revalidate_sec seconds. A status that
+        changed (e.g. a commit by another client) invalidates the dataset's
+        entries. None disables the check.
+    """
+
+    def __init__(self, max_bytes=64 * 2 ** 20, ttl_sec=300,
+                 revalidate_sec=None):
+        self.max_bytes = max_bytes
+        self.ttl_sec = ttl_sec
+        self.revalidate_sec = revalidate_sec
+        self._entries = OrderedDict()  # key -> (content, datasets, expiry)
+        self._versions = {}  # dataset -> (version, checked at)
+        # dataset -> number of invalidations, None -> number of clear()s
+        self._generations = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0,
+                       'expirations': 0, 'invalidations': 0}
+
+    @staticmethod
+    def key(url, params):
+        items = []
+        for k, v in sorted(params.items()):
+            if k == 'q':
+                v = normalize_sql(v)
+            items.append((k, str(v)))
+        return (url, tuple(items))
+
+    def get(self, key, fetch_version=None):
+        """
+        Returns the cached content for key, or None. fetch_version(dataset)
+        is used for revalidation, see revalidate_sec.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            content, datasets, expiry = entry
+            if expiry is not None and expiry < now:
+                self._remove(key)
+                self._stats['expirations'] += 1
+                self._stats['misses'] += 1
+                return None
+            stale = [ds for ds in datasets if self._needs_check(ds, now)]
+
+        # fetch versions outside of the lock, it's a round trip
+        if fetch_version is not None:
+            for ds in stale:
+                self._check_version(ds, fetch_version(ds), now)
+
+        with self._lock:
+            if key not in self._entries:
+                self._stats['misses'] += 1
+                return None
+            # most recently used last
+            self._entries[key] = self._entries.pop(key)
+            self._stats['hits'] += 1
+            return content
+
+    def generation(self, datasets):
+        """
+        Token to take before fetching a result read from datasets and to
+        pass to put(), which drops the result if one of them was invalidated
+        in the meantime.
+        """
+        with self._lock:
+            return self._generation(datasets)
+
+    def put(self, key, content, datasets, fetch_version=None,
+            generation=None):
+        size = len(content)
+        if size > self.max_bytes:
+            return
+        now = time.time()
+        if fetch_version is not None and self.revalidate_sec is not None:
+            for ds in datasets:
+                if ds not in self._versions:
+                    self._check_version(ds, fetch_version(ds), now)
+        expiry = None if self.ttl_sec is None else now + self.ttl_sec
+        with self._lock:
+            if generation is not None and \
+                    generation != self._generation(datasets):
+                # fetched before a write, possibly stale
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (content, frozenset(datasets), expiry)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self._stats['evictions'] += 1
+
+    def invalidate_dataset(self, dataset):
+        """Drops every entry read from dataset."""
+        with self._lock:
+            self._generations[dataset] = self._generations.get(dataset, 0) + 1
+            self._versions.pop(dataset, None)
+            keys = [k for k, e in self._entries.items() if dataset in e[1]]
+            for key in keys:
+                self._remove(key)
+            self._stats['invalidations'] += len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._generations[None] = self._generations.get(None, 0) + 1
+            self._entries.clear()
+            self._versions.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._bytes
+        return stats
+
+    def _generation(self, datasets):
+        return tuple(self._generations.get(ds, 0)
+                     for ds in [None] + sorted(datasets))
+
+    def _remove(self, key):
+        content, _, _ = self._entries.pop(key)
+        self._bytes -= len(content)
+
+    def _needs_check(self, dataset, now):
+        if self.revalidate_sec is None:
+            return False
+        version = self._versions.get(dataset)
+        return version is None or version[1] + self.revalidate_sec < now
+
+    def _check_version(self, dataset, version, now):
+        with self._lock:
+            previous = self._versions.get(dataset)
+            self._versions[dataset] = (version, now)
+        if previous is not None and previous[0] != version:
+            self.invalidate_dataset(dataset)
+            with self._lock:
+                self._versions[dataset] = (version, now)
+
+
+class MetadataCache(object):
+    """
+    Thread-safe cache of the metadata of the datasets read through a
+    Connection: the dataset status (rowCount, valueCount...) and the column
+    list. Entries are fetched lazily on first use and fetched again once
+    older than ttl_sec (None: never expire) or after invalidate().
+
+    Parameters
+    ----------
+    transport: Transport
+        Used to GET <dataset_url> and <dataset_url>/columns.
+    ttl_sec: float or None
+        Maximum age of the served metadata. 0 disables the cache.
+    """
+
+    def __init__(self, transport, ttl_sec=30):
+        self.transport = transport
+        self.ttl_sec = ttl_sec
+        self._entries = {}  # (dataset url, kind) -> (value, fetched at)
+        # dataset id (None: every dataset) -> number of invalidations
+        self._generations = {}
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+    def status(self, dataset_url):
+        """The 'status' of the dataset: rowCount, valueCount, ..."""
+        return self._get(dataset_url, 'status', '')
+
+    def columns(self, dataset_url):
+        """The names of the dataset's columns."""
+        return self._get(dataset_url, 'columns', '/columns')
+
+    def _generation(self, dataset):
+        return (self._generations.get(None, 0),
+                self._generations.get(dataset, 0))
+
+    def _get(self, dataset_url, kind, route):
+        dataset_url = dataset_url.rstrip('/')
+        key = (dataset_url, kind)
+        dataset = dataset_from_url(dataset_url)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (self.ttl_sec is None or
+                                      entry[1] + self.ttl_sec > now):
+                self._stats['hits'] += 1
+                # copies: callers may modify what they get
+                return copy.deepcopy(entry[0])
+            self._stats['misses'] += 1
+            generation = self._generation(dataset)
+
+        resp = self.transport.get(dataset_url + route)
+        if resp.status_code != 200:
+            from pymldb import ResourceError
+            raise ResourceError(resp)
+        value = resp.json()
+        if kind == 'status':
+            value = value['status']
+        with self._lock:
+            # not if invalidated while in flight, it may be stale
+            if self._generation(dataset) == generation:
+                self._entries[key] = (copy.deepcopy(value), now)
+        return value
+
+    def invalidate(self, dataset=None):
+        """
+        Drops the metadata of dataset (an id or a dataset url), or of every
+        dataset when None.
+        """
+        if dataset is not None and '/v1/' in dataset:
+            dataset = dataset_from_url(dataset)
+        with self._lock:
+            self._generations[dataset] = self._generations.get(dataset, 0) + 1
+            keys = [k for k in self._entries
+                    if dataset is None or dataset_from_url(k[0]) == dataset]
+            for key in keys:
+                del self._entries[key]
+            self._stats['invalidations'] += len(keys)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+        return stats
@@ -0,0 +1,84 @@
+#
+# coalesce.py
+# Copyright (c) 2016 Datacratic. All rights reserved.
+#
+# Single-flight request coalescing: while a call for a given key is in
+# flight, identical calls wait for it and share its result.
+#
+from __future__ import absolute_import, division, print_function
+
+import json
+import threading
+
+
+def request_key(method, url, kwargs):
+    """
+    Hashable identity of a request made with requests' keyword arguments,
+    or None when the request should not be coalesced.
+    """
+    if kwargs.get('stream'):
+        return None
+    try:
+        return (method, url,
+                json.dumps(kwargs.get('params'), sort_keys=True),
+                json.dumps(kwargs.get('json'), sort_keys=True),
+                kwargs.get('data'),
+                json.dumps(kwargs.get('headers'), sort_keys=True))
+    except TypeError:
+        # not JSON serializable, or unhashable data
+        return None
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Runs fn once per key among concurrent callers of do(key, fn). Callers
+    arriving while the call is in flight get the same result (or exception)
+    instead of running fn again. Nothing is cached once the call returns.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.executed = 0
+        self.suppressed = 0
+
+    def do(self, key, fn):
+        """Returns (result of fn, whether this call was suppressed)."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.executed += 1
+            else:
+                self.suppressed += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+    def stats(self):
+        with self._lock:
+            return {'executed': self.executed, 'suppressed': self.suppressed,
+                    'in_flight': len(self._calls)}
@@ -8,32 +8,62 @@
 # @File Name:          data.py
 
 
+from collections import OrderedDict
 import pandas as pd
 from pymldb.query import Query
 from pymldb.index import Time, Index
-import requests
+from pymldb.prefetch import prefetched
+from pymldb.decode import column_to_array, soa_to_dataframe
+from pymldb.expr import (Col, Const, Func, Unary, BinOp, BoolOp, In, IsNull,
+                         as_expr, literal, compile_sql, unique)
+from pymldb.aggregate import aggregate, numeric
+from pymldb.groupby import GroupBy
 import logging
-import numpy as np
-logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+DESCRIBE = ['count', 'mean', 'std', 'min', 'max']
+
+
+def _aggregate_row(query, specs):
+    """
+    Values of specs, a list of (aggregate name, expression), over all the
+    rows of query, computed by MLDB in as few SELECTs as possible. Errors
+    raise a ResourceError.
+    """
+    conn = query.conn
+    # the order of the rows doesn't change their aggregates
+    query = query.replace(ORDERBY=())
+    # raises on an error response, which can't be mistaken for no rows
+    row_names, results = aggregate(query, specs,
+                                   getattr(conn, 'max_select_bytes', 8000),
+                                   getattr(conn, 'lookup_parallel', 4))
+    if not row_names:
+        # successful query which selected no row
+        return [0 if agg == 'count' else None for agg, _ in specs]
+    return [values[0] for values in results]
 
 
 class BatFrame(object):
-    def __init__(self, dataset_url):
+    def __init__(self, dataset_url, conn=None):
+        if conn is None:
+            from pymldb import _default_connection
+            conn = _default_connection(dataset_url)
         self.dataset_url = dataset_url
-        self.query = Query(dataset_url)
-        self._time = Time(dataset_url)
+        self.conn = conn
+        self.query = Query(dataset_url, conn)
+        self._time = Time(dataset_url, conn)
         self._index = Index(self)
 
     def __getitem__(self, val):
 
         if isinstance(val, str):
-            col = Column(val, self.dataset_url)
-            col.query.mergeQuery(self.query)
+            col = Column(val, self.dataset_url, self.conn)
+            col.query = col.query.mergeQuery(self.query)
             return col
         elif isinstance(val, Query):
             bf = self.copy()
             # bf.query.addSELECT('*')
-            bf.query.mergeQuery(val)
+            bf.query = bf.query.mergeQuery(val)
             return bf
         elif isinstance(val, slice):
             start = val.start
@@ -42,24 +72,24 @@ class BatFrame(object):
             bf = self.copy()
             # bf.query.addSELECT('*')
             if start is not None:
-                bf.query.setOFFSET(start)
+                bf.query = bf.query.setOFFSET(start)
             if stop is not None:
-                bf.query.setLIMIT(stop)
+                bf.query = bf.query.setLIMIT(stop)
             return bf
         elif isinstance(val, list):
             bf = self.copy()
             for value in val:
-                bf.query.addSELECT("\"{}\"".format(value))
+                bf.query = bf.query.addSELECT(Col(value))
             return bf
         elif isinstance(val, Column):
             bf = self.copy()
-            bf.query.addWHERE("({})".format(val.execution_name))
+            bf.query = bf.query.addWHERE(val.expr)
             return bf
 
     @property
     def columns(self):
         """Returns a numpy array of the columns name"""
-        return requests.get(self.dataset_url + '/columns').json()
+        return self.conn.metadata.columns(self.dataset_url)
 
     @property
     def rows(self):
@@ -79,19 +109,130 @@ class BatFrame(object):
         return copy_index
 
     def copy(self):
-        bf = BatFrame(self.dataset_url)
-        bf.query = self.query.copy()
+        # queries are immutable, the copy can share them
+        bf = BatFrame.__new__(BatFrame)
+        bf.__dict__.update(self.__dict__)
+        bf._index = Index(bf)
         return bf
 
     def toPandas(self):
+        timer = self.conn.metrics.time('GET', self.dataset_url + '/query',
+                                       'build')
+        if self.conn.columnar:
+            result = self.query.executeQuery(format="soa")
+            with timer:
+                return soa_to_dataframe(result)
         result = self.query.executeQuery(format="aos")
         if len(result) == 0:
             return pd.DataFrame()
-        return pd.DataFrame.from_records(result, index="_rowName")
+        with timer:
+            return pd.DataFrame.from_records(result, index="_rowName")
+
+    def iter_chunks(self, chunk_rows=10000, prefetch=1):
+        """
+        Yields the rows selected by this frame as `pandas.DataFrame` chunks
+        of at most chunk_rows rows. The next `prefetch` chunks are fetched in
+        a background thread while the current one is being processed.
+        """
+        if chunk_rows <= 0:
+            raise ValueError("chunk_rows must be positive")
+        return prefetched(self._iter_chunks(chunk_rows), prefetch)
+
+    def _iter_chunks(self, chunk_rows):
+        limit = self.query.LIMIT
+        offset = self.query.OFFSET or 0
+        fetched = 0
+        while limit is None or fetched < limit:
+            num_rows = chunk_rows
+            if limit is not None:
+                num_rows = min(num_rows, limit - fetched)
+            bf = self.copy()
+            # bypass setLIMIT/setOFFSET, they only ever narrow the slice
+            bf.query = bf.query.replace(LIMIT=num_rows,
+                                        OFFSET=offset + fetched)
+            df = bf.toPandas()
+            if len(df):
+                yield df
+            if len(df) < num_rows:
+                return
+            fetched += len(df)
+
+    def _selected_columns(self):
+        names = [e.name for e in self.query.SELECT if isinstance(e, Col)]
+        if names and len(names) == len(self.query.SELECT):
+            return unique(names)
+        return self.columns
+
+    def agg(self, spec):
+        """
+        Computes aggregates of columns in MLDB, all of them fused in a
+        single SELECT (split in a few concurrent ones if it is too long).
+
+        Parameters
+        ----------
+        spec: string, list or dict
+            An aggregate name or a list of names, applied to every selected
+            column, or a dict mapping column names to aggregate name(s).
+            Aggregates: count, sum, mean, min, max, std and var.
+
+        Returns
+        -------
+        A `pandas.DataFrame` with one row per aggregate and one column per
+        column, like `pandas.DataFrame.agg`.
+        """
+        if isinstance(spec, dict):
+            items = list(spec.items())
+        else:
+            items = [(column, spec) for column in self._selected_columns()]
+        items = [(column, [aggs] if isinstance(aggs, str) else list(aggs))
+                 for column, aggs in items]
+        if self.query.LIMIT is not None or self.query.OFFSET is not None:
+            # MLDB can't aggregate a slice of the rows
+            return self.toPandas().agg(OrderedDict(items))
+
+        specs = [(agg, Col(column)) for column, aggs in items
+                 for agg in aggs]
+        values = iter(_aggregate_row(self.query, specs))
+        index = unique(agg for _, aggs in items for agg in aggs)
+        result = OrderedDict()
+        for column, aggs in items:
+            result[column] = pd.Series(
+                OrderedDict((agg, next(values)) for agg in aggs),
+                index=index)
+        return pd.DataFrame(result, index=index)
+
+    def groupby(self, keys):
+        """
+        Groups the rows by the values of the keys column(s). The returned
+        GroupBy computes aggregates (agg, size) per group in MLDB, with
+        optional having, sort and head clauses, e.g.
+        bf.groupby('city').having('count', '*', '>', 100).agg('mean')
+        """
+        return GroupBy(self, keys)
+
+    def describe(self):
+        """
+        Count, mean, std, min and max of the numbers of the selected
+        columns, computed by MLDB in a single round trip (percentiles are
+        not computed). Like pandas, columns without numbers are left out.
+        """
+        if self.query.LIMIT is not None or self.query.OFFSET is not None:
+            return self.toPandas().describe()
+        columns = self._selected_columns()
+        specs = [(agg, numeric(Col(column)))
+                 for column in columns for agg in DESCRIBE]
+        values = _aggregate_row(self.query, specs)
+        result = OrderedDict()
+        for i, column in enumerate(columns):
+            column_values = values[i * len(DESCRIBE):(i + 1) * len(DESCRIBE)]
+            # count of numbers
+            if column_values[0]:
+                result[column] = pd.Series(column_values, index=DESCRIBE)
+        return pd.DataFrame(result, index=DESCRIBE)
 
     def head(self, num_rows=5):
         bf = self.copy()
-        bf.query.setLIMIT(num_rows)
+        bf.query = bf.query.setLIMIT(num_rows)
         return bf
 
     def query(self, query):
@@ -113,7 +254,7 @@ class BatFrame(object):
                 sort = "ASC"
             else:
                 sort = "DESC"
-            bf.query.addORDERBY("\"{}\" {}".format(by, sort))
+            bf.query = bf.query.addORDERBY("\"{}\" {}".format(by, sort))
         return bf
 
     @property
@@ -121,20 +262,18 @@ class BatFrame(object):
         """
         Returns (rowCount, valueCount)
         """
-        bf = self.copy()
-        content = requests.get(bf.dataset_url).json()
-        rowCount = content['status']['rowCount']
-        valueCount = content['status']['valueCount']
+        status = self.conn.metadata.status(self.dataset_url)
+        rowCount = status['rowCount']
+        valueCount = status['valueCount']
 
         return (rowCount, valueCount)
 
     def __repr__(self):
         bf = self.copy()
-        bf.query.setLIMIT(40)
+        bf.query = bf.query.setLIMIT(40)
         print(bf.toPandas())
-        response = requests.get(bf.dataset_url).json()
         try:
-            rowCount = response['status']['rowCount']
+            rowCount = self.conn.metadata.status(self.dataset_url)['rowCount']
         except:
             rowCount = None
 
@@ -145,7 +284,7 @@ class BatFrame(object):
 
 class Column(object):
 
-    def __init__(self, name, dataset_url):
+    def __init__(self, name, dataset_url, conn=None):
         """
         Parameters
         ----------
@@ -155,13 +294,25 @@ class Column(object):
         dataset_id:
             The base url where the dataset is located.
             e.g. localhost:8888/v1/datasets/<dataset_name>
+        conn: Connection
+            Connection whose pooled transport is used. Defaults to the
+            connection shared by all objects pointing to the same host.
         """
-        logging.debug("Instanciating Column with {}".format(name))
+        if conn is None:
+            from pymldb import _default_connection
+            conn = _default_connection(dataset_url)
         self.name = "\"{}\"".format(name)
-        self.execution_name = "\"{}\"".format(name)
+        # expression tree of the values of this column
+        self.expr = Col(name)
         self.dataset_url = dataset_url
-        self.query = Query(dataset_url)
-        self.query.addSELECT(self.name)
+        self.conn = conn
+        self.query = Query(dataset_url, conn)
+        self.query = self.query.addSELECT(self.expr)
+
+    @property
+    def execution_name(self):
+        """SQL of the (simplified) expression of this column."""
+        return compile_sql(self.expr)
 
     @property
     def values(self):
@@ -169,7 +320,7 @@ class Column(object):
         if len(result) > 2:
             raise RuntimeError("Only one column should be returned")
         colName = [x for x in result.keys() if x != "_rowName"][0]
-        return np.array(result[colName])
+        return column_to_array(result[colName])
 
     def __getitem__(self, val):
 
@@ -179,17 +330,18 @@ class Column(object):
             # step = val.step
             col = self.copy()
             if start is not None:
-                col.query.setOFFSET(start)
+                col.query = col.query.setOFFSET(start)
             if stop is not None:
-                col.query.setLIMIT(stop)
+                col.query = col.query.setLIMIT(stop)
             return col
         elif isinstance(val, Query):
             col = self.copy()
-            col.query.mergeQuery(val)
+            col.query = col.query.mergeQuery(val)
             return col
         elif isinstance(val, str):
             col = self.copy()
-            col.query.addWHERE("(rowName()='{}')".format(val))
+            col.query = col.query.addWHERE(
+                BinOp('=', Func('rowName'), Const(val)))
             return col
 
 
@@ -210,28 +362,17 @@ class Column(object):
 
         Notes
         -----
-        Returning self.query will allow the next object to use this column
+        Returning a query will allow the next object to use this column
         ops and concatenate something else
         """
         if isinstance(value, Column):
-            self.query.addWHERE("(({}){}({}))".format(
-                self.execution_name,
-                operator,
-                value.execution_name))
-        elif isinstance(value, str):
-            self.query.addWHERE("(({}){}\'{}\')".format(
-                self.execution_name,
-                operator,
-                value))
+            value = value.expr
         else:
-            self.query.addWHERE("(({}){}({}))".format(
-                self.execution_name,
-                operator,
-                value))
+            value = literal(value)
+        where = BinOp(operator, self.expr, value)
 
-        copy = self.copy()
-        copy.query.removeSELECT("{}".format(copy.execution_name))
-        return copy.query
+        # queries are immutable: this column is left untouched
+        return self.query.addWHERE(where).removeSELECT(self.expr)
 
     def __eq__(self, value):
         return self._comparison(value, '=')
@@ -273,30 +414,30 @@ class Column(object):
         concatenate something else
         """
         if isinstance(right, (int, float)):
-            right = right
+            right = literal(right)
         elif isinstance(right, Column):
-            right = right.execution_name
+            right = right.expr
         else:
             raise AttributeError(
                 "{} can only be used ".format(binary)
                 + "with integer, float or column")
 
         if isinstance(left, (int, float)):
-            left = left
+            left = literal(left)
         elif isinstance(left, Column):
-            left = left.execution_name
+            left = left.expr
         else:
             raise AttributeError(
                 "{} can only be used ".format(binary)
                 + "with integer, float or column")
 
         copy = self.copy()
-        copy.query.removeSELECT("{}".format(copy.execution_name))
+        copy.query = copy.query.removeSELECT(copy.expr)
         if binary == '^':  # POWER needs a different treatment
-            copy.execution_name = "pow({},{})".format(left, right)
+            copy.expr = Func('pow', left, right)
         else:
-            copy.execution_name = "{}{}{}".format(left, binary, right)
-        copy.query.addSELECT(copy.execution_name)
+            copy.expr = BinOp(binary, left, right)
+        copy.query = copy.query.addSELECT(copy.expr)
 
         return copy
 
@@ -350,65 +491,34 @@ class Column(object):
     def __rmod__(self, value):
         return self._binary_arithemtic(value, '%', self)
 
-    def __or__(self, value):
+    def _boolean(self, value, op, reflected=False):
         col = self.copy()
-        left = self.execution_name
+        left = self.expr
         right = value
 
-        col.query.removeSELECT(left)
+        col.query = col.query.removeSELECT(left)
         if isinstance(right, Column):
-            right = value.execution_name
-            col.query.removeSELECT(right)
+            right = value.expr
+            col.query = col.query.removeSELECT(right)
         elif isinstance(right, Query):
             right = right.WHERE
+        right = as_expr(right)
 
-        col.query.addWHERE('(({}) OR ({}))'.format(left, right))
+        args = [right, left] if reflected else [left, right]
+        col.query = col.query.addWHERE(BoolOp(op, args))
         return col.query
 
-    def __and__(self, value):
-        col = self.copy()
-        left = self.execution_name
-        right = value
-
-        col.query.removeSELECT(left)
-        if isinstance(right, Column):
-            right = value.execution_name
-            col.query.removeSELECT(right)
-        elif isinstance(right, Query):
-            right = right.WHERE
-
-        col.query.addWHERE('(({}) AND ({}))'.format(left, right))
+    def __or__(self, value):
+        return self._boolean(value, 'OR')
 
-        return col.query
+    def __and__(self, value):
+        return self._boolean(value, 'AND')
 
     def __rand__(self, value):
-        col = self.copy()
-        left = self.execution_name
-        right = value
-
-        col.query.removeSELECT(left)
-        if isinstance(right, Column):
-            right = value.execution_name
-            col.query.removeSELECT(right)
-        elif isinstance(right, Query):
-            right = right.WHERE
-
-        col.query.addWHERE('(({}) AND ({}))'.format(right, left))
+        return self._boolean(value, 'AND', reflected=True)
 
     def __ror__(self, value):
-        col = self.copy()
-        left = self.execution_name
-        right = value
-
-        col.query.removeSELECT(left)
-        if isinstance(right, Column):
-            right = value.execution_name
-            col.query.removeSELECT(right)
-        elif isinstance(right, Query):
-            right = right.WHERE
-
-        col.query.addWHERE('(({}) OR ({}))'.format(right, left))
-        return col.query
+        return self._boolean(value, 'OR', reflected=True)
 
     #################################
     #  Unary arithmetic operations  #
@@ -430,9 +540,9 @@ class Column(object):
         concatenate something else
         """
         copy = self.copy()
-        copy.query.removeSELECT("{}".format(copy.execution_name))
-        copy.execution_name = "{}({})".format(unary, self.execution_name)
-        copy.query.addSELECT(copy.execution_name)
+        copy.query = copy.query.removeSELECT(copy.expr)
+        copy.expr = Unary(unary, self.expr)
+        copy.query = copy.query.addSELECT(copy.expr)
 
         return copy
 
@@ -444,7 +554,7 @@ class Column(object):
 
     def __invert__(self):
         copy = self.copy()
-        copy.execution_name = "NOT {}".format(copy.execution_name)
+        copy.expr = Unary('NOT', copy.expr)
         return copy
 
     def __abs__(self):
@@ -478,64 +588,133 @@ class Column(object):
             yield values[i]
             i += 1
 
-    def max(self):
+    def _aggregate(self, function):
+        """
+        Value of the aggregate function (e.g. 'max') over this column,
+        computed by MLDB. None when no row is selected, errors raise a
+        ResourceError.
+        """
         copy = self.copy()
-        copy.query.removeSELECT("{}".format(copy.execution_name))
-        copy.execution_name = "max({})".format(self.execution_name)
-        copy.query.addSELECT(copy.execution_name)
-        copy.query.addGROUPBY(1)
-
-        result = copy.query.executeQuery(format="table")
+        copy.query = copy.query.removeSELECT(copy.expr)
+        copy.expr = Func(function, self.expr)
+        copy.query = copy.query.addSELECT(copy.expr)
+        copy.query = copy.query.addGROUPBY(1)
+
+        result = copy.query.executeQuery(format="table", strict=True)
+        if len(result) < 2:
+            return None
         return result[1][1]
 
-    def min(self):
-        copy = self.copy()
-        copy.query.removeSELECT("{}".format(copy.execution_name))
-        copy.execution_name = "min({})".format(self.execution_name)
-        copy.query.addSELECT(copy.execution_name)
-        copy.query.addGROUPBY(1)
+    def _is_sliced(self):
+        # aggregates can't be computed over a slice of the rows in MLDB
+        return self.query.LIMIT is not None or self.query.OFFSET is not None
 
-        result = copy.query.executeQuery(format="table")
-        return result[1][1]
+    def _groups(self, dropna=False):
+        """
+        Distinct values of this column and their number of occurrences, as
+        a 'soa' result with 'value' and 'count' columns. Only one row per
+        distinct value is transferred.
+        """
+        sql = self.execution_name
+        query = self.query.replace(
+            SELECT=('{} AS value'.format(sql), 'count(*) AS count'),
+            GROUPBY=(sql,),
+            ORDERBY=())
+        if dropna:
+            query = query.addWHERE(Unary('NOT', IsNull(self.expr)), 'AND')
+        return query.executeQuery(format="soa", strict=True)
+
+    def max(self):
+        return self._aggregate('max')
+
+    def min(self):
+        return self._aggregate('min')
 
     def copy(self):
-        name = self.name[1:-1]  # Removing the surrounding ''
-        col = Column(name, self.dataset_url)
-        col.execution_name = self.execution_name
-        col.query = self.query.copy()
+        # queries are immutable, the copy can share them
+        col = Column.__new__(Column)
+        col.__dict__.update(self.__dict__)
         return col
 
     def count(self):
         """Return number of non-NA/null observations in the Series"""
-        raise NotImplementedError()
+        if self._is_sliced():
+            return int(self.toPandas().count())
+        return self._aggregate('count') or 0
+
+    def agg(self, aggs):
+        """
+        Computes aggregates of this column in MLDB in a single SELECT.
+        aggs is an aggregate name (count, sum, mean, min, max, std or var),
+        whose value is returned, or a list of them, returned as a
+        `pandas.Series` indexed by name.
+        """
+        names = [aggs] if isinstance(aggs, str) else list(aggs)
+        if self._is_sliced():
+            return self.toPandas().agg(aggs)
+        values = _aggregate_row(self.query,
+                                [(agg, self.expr) for agg in names])
+        if isinstance(aggs, str):
+            return values[0]
+        return pd.Series(OrderedDict(zip(names, values)), index=names)
 
     def head(self, n=5):
         """Returns first n rows"""
         col = self.copy()
-        col.query.setLIMIT(n)
+        col.query = col.query.setLIMIT(n)
         return col.toPandas()
 
     def isnull(self):
-        raise NotImplementedError()
+        """
+        Returns the boolean column telling which values are null, computed
+        by MLDB. It can be used as a filter: bf[bf['x'].isnull()].
+        """
+        col = self.copy()
+        col.query = col.query.removeSELECT(col.expr)
+        col.expr = IsNull(self.expr)
+        col.query = col.query.addSELECT(col.expr)
+        return col
 
     def isin(self, values):
-        raise NotImplementedError()
+        """
+        Returns the query selecting the rows whose value is one of values,
+        e.g. bf[bf['x'].isin([1, 2, 3])]. Large sets of values are split in
+        several queries, see pymldb.lookup.
+        """
+        values = unique(literal(v) for v in values)
+        return self.query.addWHERE(In(self.expr, values)) \
+            .removeSELECT(self.expr)
 
-    def value_counts(self):
-        raise NotImplementedError()
+    def value_counts(self, dropna=True):
+        """
+        Returns a `pandas.Series` of the number of occurrences of each
+        distinct value, most frequent first, counted by MLDB with a GROUP BY.
+        Nulls are counted unless dropna.
+        """
+        if self._is_sliced():
+            return self.toPandas().value_counts(dropna=dropna)
+        result = self._groups(dropna)
+        if not result:
+            return pd.Series()
+        counts = pd.Series(column_to_array(result['count']),
+                           index=result.get('value'))
+        return counts.sort_values(ascending=False)
 
     def unique(self):
-        if self.name == self.execution_name:
-            url = self.dataset_url + '/columns/{}/values'.format(
-                self.name[1:-1])
-            logging.debug("Getting values at {}".format(url))
-            return requests.get(url).json()
-        else:
+        if self._is_sliced():
             result = self.query.executeQuery(format="soa")
             if len(result) > 2:
                 raise RuntimeError("Only one column should be returned")
             colName = [x for x in result.keys() if x != "_rowName"][0]
             return set(result[colName])
+        elif isinstance(self.expr, Col) and self.query.WHERE is None:
+            url = self.dataset_url + '/columns/{}/values'.format(
+                self.name[1:-1])
+            logger.debug("Getting values at {}".format(url))
+            return self.conn.transport.get(url).json()
+        else:
+            # one row per distinct value instead of one per row
+            return set(self._groups().get('value', []))
 
     def sort(self, ascending=True):
         col = self.copy()
@@ -544,7 +723,8 @@ class Column(object):
             sort = "ASC"
         else:
             sort = "DESC"
-        col.query.addORDERBY("{} {}".format(col.execution_name, sort))
+        col.query = col.query.addORDERBY(
+            "{} {}".format(col.execution_name, sort))
         return col
 
     def toPandas(self):
@@ -555,18 +735,17 @@ class Column(object):
         values = result[colName]
         rowName = result["_rowName"]
         if len(values) > 0:
-            s = pd.Series(values, index=rowName)
+            s = pd.Series(column_to_array(values), index=rowName)
         else:
             s = pd.Series()
         return s
 
     def __repr__(self):
         col = self.copy()
-        col.query.setLIMIT(40)
+        col.query = col.query.setLIMIT(40)
         print(col.toPandas())
-        response = requests.get(col.dataset_url).json()
         try:
-            rowCount = response['status']['rowCount']
+            rowCount = self.conn.metadata.status(self.dataset_url)['rowCount']
         except:
             rowCount = None
 
@@ -0,0 +1,126 @@
+#
+# decode.py
+# Copyright (c) 2016 Datacratic. All rights reserved.
+#
+# Columnar decoding of query results. Results are requested in the 'soa'
+# (structure of arrays) format and every column is converted straight into a
+# typed numpy array, instead of going through one python object per row.
+# numpy and pandas are only imported when a result is actually decoded.
+# Also home of the JSON encoder used for bulk uploads.
+#
+from __future__ import absolute_import, division, print_function
+
+import json
+from collections import OrderedDict
+
+_loads = None
+
+
+def _pick_loads():
+    try:
+        import orjson
+        return orjson.loads
+    except ImportError:
+        pass
+    try:
+        import ujson
+        return ujson.loads
+    except ImportError:
+        pass
+
+    def json_loads(content):
+        if isinstance(content, bytes):
+            content = content.decode('utf-8')
+        # keeps the column order on python 2
+        return json.loads(content, object_pairs_hook=OrderedDict)
+    return json_loads
+
+
+def loads(content):
+    """
+    Parses a JSON document using the fastest parser available (orjson, then
+    ujson, then the standard library). The parser is chosen on first use.
+    """
+    global _loads
+    if _loads is None:
+        _loads = _pick_loads()
+    return _loads(content)
+
+
+_dumps = None
+
+
+def _pick_dumps():
+    try:
+        import orjson
+        return orjson.dumps
+    except ImportError:
+        pass
+    try:
+        import ujson
+        return lambda obj: ujson.dumps(obj).encode('utf-8')
+    except ImportError:
+        pass
+    return lambda obj: json.dumps(obj).encode('utf-8')
+
+
+def dumps(obj):
+    """Serializes obj to JSON bytes, with the fastest encoder available."""
+    global _dumps
+    if _dumps is None:
+        _dumps = _pick_dumps()
+    return _dumps(obj)
+
+
+_NONE = type(None)
+try:
+    _INTEGERS = set([int, long])  # noqa
+except NameError:
+    _INTEGERS = set([int])
+_NUMBERS = _INTEGERS | set([float])
+
+
+def column_to_array(values):
+    """
+    Converts a list of JSON values into a numpy array of the narrowest
+    suitable dtype:
+      - bool for booleans without nulls
+      - int64 for integers without nulls
+      - float64 for numbers, nulls becoming NaN
+      - object for anything else (strings, timestamps, mixed types)
+    """
+    import numpy as np
+    kinds = set(map(type, values))
+    nullable = _NONE in kinds
+    kinds.discard(_NONE)
+    if kinds:
+        if kinds == set([bool]) and not nullable:
+            return np.array(values, dtype=np.bool_)
+        if kinds <= _INTEGERS and not nullable:
+            try:
+                return np.array(values, dtype=np.int64)
+            except OverflowError:
+                pass  # unsigned 64 bits hashes and the like
+        elif kinds <= _NUMBERS:
+            return np.array(values, dtype=np.float64)
+    array = np.empty(len(values), dtype=object)
+    array[:] = values
+    return array
+
+
+def soa_to_dataframe(soa):
+    """
+    Builds a `pandas.DataFrame` indexed by _rowName out of the result of a
+    format='soa' query.
+    """
+    import pandas as pd
+    if len(soa) == 0:
+        return pd.DataFrame()
+    columns = OrderedDict()
+    index = None
+    for name, values in soa.items():
+        if name == '_rowName':
+            index = pd.Index(column_to_array(values), name='_rowName')
+        else:
+            columns[name] = column_to_array(values)
+    return pd.DataFrame(columns, index=index)
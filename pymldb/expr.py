@@ -0,0 +1,414 @@
+#
+# expr.py
+# Copyright (c) 2016 Datacratic. All rights reserved.
+#
+# Expression trees behind Column operations. Trees are simplified (constant
+# folding, flattening of AND/OR, OR of equalities rewritten as IN) and only
+# then emitted as SQL, with the parentheses the precedence rules require.
+#
+from __future__ import absolute_import, division, print_function
+
+import numbers
+
+try:
+    string_types = (str, unicode)  # noqa
+except NameError:
+    string_types = (str,)
+
+ARITHMETIC = ('+', '-', '*', '/', '%')
+COMPARISONS = ('=', '!=', '<', '<=', '>', '>=')
+
+# binding strength of the operators, higher binds tighter
+_OR, _AND, _NOT, _COMPARISON, _SUM, _PRODUCT, _NEGATION, _ATOM = range(1, 9)
+_PRECEDENCE = {'+': _SUM, '-': _SUM, '*': _PRODUCT, '/': _PRODUCT,
+               '%': _PRODUCT, 'AND': _AND, 'OR': _OR}
+for _op in COMPARISONS:
+    _PRECEDENCE[_op] = _COMPARISON
+
+
+class Expr(object):
+    """
+    Immutable expression node. Nodes compare and hash by structure, so equal
+    subtrees can be shared and looked up in dicts.
+    """
+    precedence = _ATOM
+
+    def _init(self, *key):
+        self._key = (type(self).__name__,) + key
+        self._hash = hash(self._key)
+
+    def __eq__(self, other):
+        return isinstance(other, Expr) and self._key == other._key
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return self._hash
+
+    def __repr__(self):
+        return '<{} {}>'.format(type(self).__name__, to_sql(self))
+
+
+class Const(Expr):
+
+    def __init__(self, value):
+        self.value = value
+        # 1, 1.0 and True are equal in python but not in SQL
+        self._init(type(value).__name__, value)
+
+    def is_number(self):
+        return isinstance(self.value, numbers.Number) and \
+            not isinstance(self.value, bool)
+
+    def is_bool(self):
+        return isinstance(self.value, bool)
+
+
+class Col(Expr):
+
+    def __init__(self, name):
+        self.name = name
+        self._init(name)
+
+
+class Raw(Expr):
+    """SQL text coming from outside of the tree, kept as is."""
+    precedence = 0
+
+    def __init__(self, sql):
+        self.sql = sql
+        self._init(sql)
+
+
+class Func(Expr):
+
+    def __init__(self, name, *args):
+        self.name = name
+        self.args = tuple(args)
+        self._init(name, self.args)
+
+
+class Unary(Expr):
+    """'-' or 'NOT' applied to operand."""
+
+    def __init__(self, op, operand):
+        self.op = op
+        self.operand = operand
+        self.precedence = _NEGATION if op == '-' else _NOT
+        self._init(op, operand)
+
+
+class BinOp(Expr):
+    """Arithmetic or comparison operator."""
+
+    def __init__(self, op, left, right):
+        self.op = op
+        self.left = left
+        self.right = right
+        self.precedence = _PRECEDENCE[op]
+        self._init(op, left, right)
+
+
+class BoolOp(Expr):
+    """AND or OR of any number of operands."""
+
+    def __init__(self, op, args):
+        self.op = op
+        self.args = tuple(args)
+        self.precedence = _PRECEDENCE[op]
+        self._init(op, self.args)
+
+
+class In(Expr):
+    precedence = _COMPARISON
+
+    def __init__(self, operand, values):
+        self.operand = operand
+        self.values = tuple(values)
+        self._init(operand, self.values)
+
+
+class IsNull(Expr):
+    precedence = _COMPARISON
+
+    def __init__(self, operand):
+        self.operand = operand
+        self._init(operand)
+
+
+def as_expr(value):
+    """Wraps python values in Const and SQL strings in Raw."""
+    if isinstance(value, Expr):
+        return value
+    if isinstance(value, string_types):
+        return Raw(value)
+    return Const(value)
+
+
+def unique(values):
+    """values without duplicates, in order of first appearance."""
+    seen = set()
+    return [v for v in values if not (v in seen or seen.add(v))]
+
+
+def literal(value):
+    """Const holding value, numpy scalars converted to python ones."""
+    if value is None or isinstance(value, (bool,) + string_types):
+        return Const(value)
+    if isinstance(value, numbers.Integral):
+        return Const(int(value))
+    if isinstance(value, numbers.Real):
+        return Const(float(value))
+    return Raw(str(value))
+
+
+###############################################################################
+# Simplification
+
+def _fold_arithmetic(op, a, b):
+    """Value of `a op b`, or None when it must be left to the server."""
+    if op == '+':
+        return a + b
+    if op == '-':
+        return a - b
+    if op == '*':
+        return a * b
+    if b == 0:
+        return None
+    both_ints = isinstance(a, numbers.Integral) and \
+        isinstance(b, numbers.Integral)
+    if op == '/':
+        if both_ints and a % b:
+            return None  # integer division semantics differ
+        return a // b if both_ints else a / b
+    if op == '%' and both_ints and a >= 0 and b > 0:
+        return a % b
+    return None
+
+
+def _fold_comparison(op, a, b):
+    if op == '=':
+        return a == b
+    if op == '!=':
+        return a != b
+    if op == '<':
+        return a < b
+    if op == '<=':
+        return a <= b
+    if op == '>':
+        return a > b
+    return a >= b
+
+
+def _equality(node):
+    """(operand, constant values) of `x = c`, `c = x` or `x IN (...)`."""
+    if isinstance(node, In):
+        return node.operand, node.values
+    if isinstance(node, BinOp) and node.op == '=':
+        if isinstance(node.right, Const) and not isinstance(node.left, Const):
+            return node.left, (node.right,)
+        if isinstance(node.left, Const) and not isinstance(node.right, Const):
+            return node.right, (node.left,)
+    return None
+
+
+def _equalities_to_in(args):
+    """Merges the equalities on the same operand of an OR into one IN."""
+    groups = {}
+    for arg in args:
+        equality = _equality(arg)
+        if equality is not None:
+            groups.setdefault(equality[0], []).append(equality[1])
+    result = []
+    done = set()
+    for arg in args:
+        equality = _equality(arg)
+        if equality is None or len(groups[equality[0]]) < 2:
+            result.append(arg)
+            continue
+        operand = equality[0]
+        if operand in done:
+            continue
+        done.add(operand)
+        values = [v for group in groups[operand] for v in group]
+        result.append(In(operand, unique(values)))
+    return result
+
+
+def _simplify_bool(op, args):
+    identity, absorbing = (True, False) if op == 'AND' else (False, True)
+    flat = []
+    for arg in args:
+        for sub in (arg.args if isinstance(arg, BoolOp) and arg.op == op
+                    else (arg,)):
+            if isinstance(sub, Const) and sub.is_bool():
+                if sub.value == absorbing:
+                    return Const(absorbing)
+                continue  # identity
+            flat.append(sub)
+    flat = unique(flat)
+    if op == 'OR':
+        flat = _equalities_to_in(flat)
+    if len(flat) == 0:
+        return Const(identity)
+    if len(flat) == 1:
+        return flat[0]
+    return BoolOp(op, flat)
+
+
+def _simplify_node(node, simplify):
+    if isinstance(node, Func):
+        return Func(node.name, *[simplify(a) for a in node.args])
+
+    if isinstance(node, Unary):
+        operand = simplify(node.operand)
+        if isinstance(operand, Unary) and operand.op == node.op:
+            return operand.operand  # --x, NOT NOT x
+        if isinstance(operand, Const):
+            if node.op == '-' and operand.is_number():
+                return Const(-operand.value)
+            if node.op == 'NOT' and operand.is_bool():
+                return Const(not operand.value)
+        return Unary(node.op, operand)
+
+    if isinstance(node, BinOp):
+        left, right = simplify(node.left), simplify(node.right)
+        if isinstance(left, Const) and isinstance(right, Const):
+            a, b = left.value, right.value
+            if left.is_number() and right.is_number():
+                if node.op in ARITHMETIC:
+                    value = _fold_arithmetic(node.op, a, b)
+                    if value is not None:
+                        return Const(value)
+                else:
+                    return Const(_fold_comparison(node.op, a, b))
+            elif node.op in COMPARISONS and \
+                    isinstance(a, string_types) and \
+                    isinstance(b, string_types):
+                return Const(_fold_comparison(node.op, a, b))
+        return BinOp(node.op, left, right)
+
+    if isinstance(node, BoolOp):
+        return _simplify_bool(node.op, [simplify(a) for a in node.args])
+
+    if isinstance(node, In):
+        operand = simplify(node.operand)
+        if len(node.values) == 0:
+            return Const(False)
+        if len(node.values) == 1:
+            return BinOp('=', operand, node.values[0])
+        return In(operand, node.values)
+
+    if isinstance(node, IsNull):
+        operand = simplify(node.operand)
+        if isinstance(operand, Const):
+            return Const(operand.value is None)
+        return IsNull(operand)
+
+    return node
+
+
+###############################################################################
+# SQL emission
+
+def _quote_identifier(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def _literal_sql(value):
+    if value is None:
+        return 'NULL'
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, string_types):
+        return "'{}'".format(value.replace("'", "''"))
+    return repr(value)
+
+
+def _emit_node(node, emit):
+    """SQL of node, emit(child) giving the SQL of its children."""
+
+    def operand(child, min_precedence):
+        sql = emit(child)
+        if child.precedence < min_precedence or sql.startswith('-'):
+            # a leading '-' could make '--', which starts a comment
+            return '({})'.format(sql)
+        return sql
+
+    if isinstance(node, Const):
+        return _literal_sql(node.value)
+    if isinstance(node, Col):
+        return _quote_identifier(node.name)
+    if isinstance(node, Raw):
+        return node.sql
+    if isinstance(node, Func):
+        return '{}({})'.format(node.name, ','.join(emit(a) for a in node.args))
+    if isinstance(node, Unary):
+        if node.op == '-':
+            return '-' + operand(node.operand, _NEGATION)
+        return 'NOT ' + operand(node.operand, _NOT)
+    if isinstance(node, BinOp):
+        p = node.precedence
+        # comparisons don't chain, and on the right side equal precedence
+        # only goes without parentheses for the same associative operator:
+        # a*(b%c) isn't (a*b)%c, nor is a*(b/c) (a*b)/c in integers
+        left_min = p + 1 if p == _COMPARISON else p
+        right_min = p + 1
+        if node.op in ('+', '*') and isinstance(node.right, BinOp) and \
+                node.right.op == node.op:
+            right_min = p
+        return '{}{}{}'.format(operand(node.left, left_min), node.op,
+                               operand(node.right, right_min))
+    if isinstance(node, BoolOp):
+        return ' {} '.format(node.op).join(
+            operand(a, node.precedence) for a in node.args)
+    if isinstance(node, In):
+        return '{} IN ({})'.format(
+            operand(node.operand, _COMPARISON + 1),
+            ','.join(emit(v) for v in node.values))
+    if isinstance(node, IsNull):
+        return '{} IS NULL'.format(operand(node.operand, _COMPARISON + 1))
+    raise TypeError("Unknown expression {!r}".format(node))
+
+
+class Compiler(object):
+    """
+    Simplifies and emits expressions, remembering the result for every
+    subtree: a subexpression shared by several expressions compiled with
+    the same Compiler (e.g. the SELECT and WHERE of a query) is simplified
+    and turned into SQL only once. Plain strings are passed through.
+    """
+
+    def __init__(self):
+        self._simplified = {}
+        self._sql = {}
+
+    def simplify(self, node):
+        result = self._simplified.get(node)
+        if result is None:
+            result = _simplify_node(node, self.simplify)
+            self._simplified[node] = result
+            self._simplified[result] = result
+        return result
+
+    def emit(self, node):
+        sql = self._sql.get(node)
+        if sql is None:
+            sql = self._sql[node] = _emit_node(node, self.emit)
+        return sql
+
+    def sql(self, value):
+        if isinstance(value, string_types):
+            return value
+        return self.emit(self.simplify(value))
+
+
+def to_sql(node):
+    """SQL of node as is, without simplification."""
+    return Compiler().emit(node)
+
+
+def compile_sql(node):
+    """SQL of node once simplified."""
+    return Compiler().sql(node)
@@ -0,0 +1,283 @@
+#
+# functions.py
+# Copyright (c) 2016 Datacratic. All rights reserved.
+#
+# Low latency application of an MLDB function (classifier, embedding...)
+# through /v1/functions/<id>/application, e.g. for real-time scoring.
+#
+from __future__ import absolute_import, division, print_function
+
+import threading
+from collections import deque
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote
+
+from pymldb import ResourceError
+from pymldb.decode import dumps, loads
+from pymldb.metrics import clock
+
+_STOP = object()
+_HEADERS = {'Content-Type': 'application/json'}
+
+
+class _Pending(object):
+    """Result of FunctionClient.submit, see result()."""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+
+    def _set(self, result, error):
+        self._result = result
+        self._error = error
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """Waits for the output of the function, raising its error if any."""
+        if not self._done.wait(timeout):
+            raise RuntimeError("Timed out waiting for the function")
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+def _percentile(ordered, q):
+    if not ordered:
+        return None
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+class FunctionClient(object):
+    """
+    Applies the function function_id, see Connection.function_client.
+
+    The URL and headers of the requests are built once, and the input is
+    serialized by the fastest JSON encoder into the body of the GET, so a
+    call costs a single encoding and a request on a warm pooled connection.
+
+    client(input) applies the function right away. client.submit(input)
+    queues the call instead and returns a pending result: a dispatcher
+    thread takes the queued calls (up to max_batch) and sends them in
+    parallel through `workers` threads, identical inputs of a batch sharing
+    a single request and each caller getting its own decoded output.
+    map(inputs) submits a list of inputs and waits for all the outputs.
+
+    MLDB has no route applying a function to several inputs, so batches
+    don't save requests and calls are dispatched as soon as they are
+    queued. A window_ms > 0 waits that long for more calls, which only pays
+    off when identical inputs are submitted close together.
+
+    stats() reports the count, errors and p50/p99 latencies (measured from
+    the call to its output) of the last `history` calls.
+    """
+
+    def __init__(self, conn, function_id, window_ms=0, max_batch=64,
+                 workers=None, warm_up=True, history=10000):
+        self.conn = conn
+        self.function_id = function_id
+        self.url = '{}/v1/functions/{}/application'.format(
+            conn.uri, quote(function_id, safe=''))
+        self.window_sec = window_ms / 1000
+        self.max_batch = max_batch
+        self.workers = workers or conn.transport.pool_size
+        self._latencies = deque(maxlen=history)
+        self._lock = threading.Lock()
+        self._count = 0
+        self._errors = 0
+        self._batches = 0
+        self._batched = 0
+        self._shared = 0
+        self._queue = queue.Queue()
+        self._pool = None
+        self._dispatcher = None
+        if warm_up:
+            conn.transport.warm_up(conn.uri, self.workers)
+
+    def encode(self, input):
+        """Body of the request applying the function to input."""
+        return b'{"input":' + dumps(input) + b'}'
+
+    def _fetch(self, body):
+        response = self.conn.transport.get(self.url, data=body,
+                                           headers=_HEADERS)
+        if response.status_code != 200:
+            raise ResourceError(response)
+        return response.content
+
+    def _send(self, body):
+        return loads(self._fetch(body))['output']
+
+    def _record(self, start, error):
+        latency = clock() - start
+        with self._lock:
+            self._count += 1
+            if error:
+                self._errors += 1
+            self._latencies.append(latency)
+
+    def __call__(self, input):
+        """Returns the output of the function applied to input."""
+        start = clock()
+        try:
+            output = self._send(self.encode(input))
+        except Exception:
+            self._record(start, True)
+            raise
+        self._record(start, False)
+        return output
+
+    apply = __call__
+
+    def submit(self, input):
+        """Queues a call, see result() of the returned object."""
+        pending = _Pending()
+        self._queue.put((self.encode(input), pending, clock()))
+        if self._dispatcher is None:
+            with self._lock:
+                if self._dispatcher is None:
+                    from multiprocessing.pool import ThreadPool
+                    self._pool = ThreadPool(self.workers)
+                    self._dispatcher = threading.Thread(
+                        target=self._dispatch, args=(self._pool,))
+                    self._dispatcher.daemon = True
+                    self._dispatcher.start()
+        return pending
+
+    def map(self, inputs):
+        """Returns the outputs of the function applied to every input."""
+        return [pending.result()
+                for pending in [self.submit(input) for input in inputs]]
+
+    def _next_batch(self):
+        item = self._queue.get()
+        if item is _STOP:
+            return None
+        batch = [item]
+        deadline = clock() + self.window_sec
+        while len(batch) < self.max_batch:
+            timeout = deadline - clock()
+            try:
+                if timeout > 0:
+                    item = self._queue.get(timeout=timeout)
+                else:
+                    item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                self._queue.put(_STOP)
+                break
+            batch.append(item)
+        return batch
+
+    def _dispatch(self, pool):
+        calls = {}
+        try:
+            while True:
+                batch = self._next_batch()
+                if batch is None:
+                    return
+                calls = {}
+                for body, pending, start in batch:
+                    calls.setdefault(body, []).append((pending, start))
+                with self._lock:
+                    self._batches += 1
+                    self._batched += len(batch)
+                    self._shared += len(batch) - len(calls)
+                for body in list(calls):
+                    pool.apply_async(self._run, (body, calls[body]))
+                    # handed over to the pool
+                    del calls[body]
+        except Exception as e:
+            # let the next submit start a new dispatcher, and fail the
+            # calls left since nothing will send them
+            with self._lock:
+                if self._pool is pool:
+                    self._dispatcher = self._pool = None
+            pool.close()
+            left = [w for waiters in calls.values() for w in waiters]
+            while True:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not _STOP:
+                    left.append(item[1:])
+            for pending, start in left:
+                self._record(start, True)
+                pending._set(None, e)
+
+    def _run(self, body, waiters):
+        content = error = None
+        try:
+            content = self._fetch(body)
+        except Exception as e:
+            error = e
+        for pending, start in waiters:
+            output, failure = None, error
+            if failure is None:
+                # decoded per caller: outputs are mutable
+                try:
+                    output = loads(content)['output']
+                except Exception as e:
+                    failure = e
+            self._record(start, failure is not None)
+            pending._set(output, failure)
+
+    def stats(self):
+        """
+        Returns count, errors, p50_ms, p99_ms and max_ms, plus for submitted
+        calls the number of batches, their mean size and the number of
+        calls which shared the request of an identical input.
+        """
+        with self._lock:
+            ordered = sorted(self._latencies)
+            stats = {'count': self._count, 'errors': self._errors,
+                     'batches': self._batches,
+                     'mean_batch': (self._batched / self._batches
+                                    if self._batches else None),
+                     'shared': self._shared}
+        for name, q in (('p50_ms', 0.5), ('p99_ms', 0.99)):
+            value = _percentile(ordered, q)
+            stats[name] = None if value is None else value * 1000
+        stats['max_ms'] = ordered[-1] * 1000 if ordered else None
+        return stats
+
+    def reset_stats(self):
+        with self._lock:
+            self._latencies.clear()
+            self._count = self._errors = 0
+            self._batches = self._batched = self._shared = 0
+
+    def close(self):
+        """
+        Stops the dispatcher once the queued calls are sent, and waits for
+        their results.
+        """
+        with self._lock:
+            dispatcher, self._dispatcher = self._dispatcher, None
+            pool = self._pool
+        if dispatcher is not None:
+            self._queue.put(_STOP)
+            dispatcher.join()
+            # the dispatcher is done with the pool
+            pool.close()
+            pool.join()
+            with self._lock:
+                if self._pool is pool:
+                    self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
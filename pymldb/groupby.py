@@ -0,0 +1,127 @@
+#
+# groupby.py
+# Copyright (c) 2016 Datacratic. All rights reserved.
+#
+# BatFrame.groupby: grouped aggregates compiled into GROUP BY, HAVING,
+# ORDER BY and LIMIT clauses and computed by MLDB. Only the groups come back.
+#
+from __future__ import absolute_import, division, print_function
+
+from collections import OrderedDict
+
+from pymldb.aggregate import aggregate, parts
+from pymldb.decode import column_to_array
+from pymldb.expr import BinOp, BoolOp, Col, Raw, compile_sql, literal
+
+# count(*) for size()
+_ROWS = Raw('*')
+
+
+def _aggregate_expr(agg, column):
+    """The MLDB aggregate computing agg over column."""
+    return parts(agg, _ROWS if column == '*' else Col(column))[0]
+
+
+class GroupBy(object):
+    """
+    Groups of the rows of a BatFrame sharing the values of keys. Like
+    queries, GroupBy objects are immutable: having, sort and head return a
+    new GroupBy. Nothing is sent before agg or size.
+    """
+
+    def __init__(self, bf, keys):
+        if bf.query.LIMIT is not None or bf.query.OFFSET is not None:
+            raise ValueError("MLDB can't group a slice of the rows")
+        if isinstance(keys, str):
+            keys = [keys]
+        self.bf = bf
+        self.keys = list(keys)
+        self.query = bf.query.replace(
+            GROUPBY=tuple(compile_sql(Col(k)) for k in self.keys))
+
+    def _derive(self, query):
+        gb = GroupBy.__new__(GroupBy)
+        gb.__dict__.update(self.__dict__)
+        gb.query = query
+        return gb
+
+    def having(self, agg, column='*', op=None, value=None):
+        """
+        Keeps the groups for which `agg(column) op value`, e.g.
+        having('count', '*', '>=', 10) or having('mean', 'x', '<', 0).
+        Without op, agg is taken as a SQL predicate, e.g.
+        having('sum("x") > 100'). Successive calls are AND-ed.
+        """
+        if op is None:
+            predicate = Raw(agg)
+        else:
+            predicate = BinOp(op, _aggregate_expr(agg, column),
+                              literal(value))
+        having = self.query.HAVING
+        if having is not None:
+            predicate = BoolOp('AND', [having, predicate])
+        return self._derive(self.query.replace(HAVING=predicate))
+
+    def sort(self, agg, column='*', ascending=True):
+        """Orders the groups by agg(column), e.g. sort('count')."""
+        order = '{} {}'.format(compile_sql(_aggregate_expr(agg, column)),
+                               'ASC' if ascending else 'DESC')
+        return self._derive(self.query.addORDERBY(order))
+
+    def head(self, n=5):
+        """Keeps the first n groups."""
+        return self._derive(self.query.setLIMIT(n))
+
+    def _run(self, specs):
+        conn = self.query.conn
+        key_specs = [(None, Col(k)) for k in self.keys]
+        _, results = aggregate(self.query, key_specs + specs,
+                               getattr(conn, 'max_select_bytes', 8000),
+                               getattr(conn, 'lookup_parallel', 4))
+        import pandas as pd
+        keys = [column_to_array(values)
+                for values in results[:len(self.keys)]]
+        if len(keys) == 1:
+            index = pd.Index(keys[0], name=self.keys[0])
+        else:
+            index = pd.MultiIndex.from_arrays(keys, names=self.keys)
+        return index, [column_to_array(values)
+                       for values in results[len(self.keys):]]
+
+    def agg(self, spec):
+        """
+        Computes aggregates per group in MLDB. spec is an aggregate name or a
+        list of names (count, sum, mean, min, max, std, var) applied to
+        every selected column but the keys, or a dict mapping column names
+        to aggregate name(s).
+
+        Returns a `pandas.DataFrame` indexed by the keys, with a column per
+        column when each column has a single aggregate, else a column per
+        (column, aggregate), built from typed columns.
+        """
+        if isinstance(spec, dict):
+            items = list(spec.items())
+        else:
+            items = [(c, spec) for c in self.bf._selected_columns()
+                     if c not in self.keys]
+        single = all(isinstance(aggs, str) for _, aggs in items)
+        names = []
+        specs = []
+        for column, aggs in items:
+            for agg in ([aggs] if isinstance(aggs, str) else aggs):
+                names.append(column if single else (column, agg))
+                specs.append((agg, Col(column)))
+        index, columns = self._run(specs)
+
+        import pandas as pd
+        result = pd.DataFrame(OrderedDict(zip(names, columns)), index=index,
+                              columns=names)
+        if not single:
+            result.columns = pd.MultiIndex.from_tuples(names)
+        return result
+
+    def size(self):
+        """Returns the number of rows of each group as a `pandas.Series`."""
+        index, columns = self._run([('count', _ROWS)])
+        import pandas as pd
+        return pd.Series(columns[0], index=index)
@@ -8,20 +8,21 @@
 # @File Name:          index.py
 
 from pymldb.query import Query
+from pymldb.expr import Func, BinOp, In, Const, unique
 
 
 class Time(object):
     """docstring for Time"""
-    def __init__(self, dataset_url):
+    def __init__(self, dataset_url, conn=None):
         super(Time, self).__init__()
         self.dataset_url = dataset_url
-        self.query = Query(dataset_url)
+        self.query = Query(dataset_url, conn)
 
     def __getitem__(self, value):
         print(value)
 
     def copy(self):
-        copy_time = Time(self.dataset_url)
+        copy_time = Time(self.dataset_url, self.query.conn)
         copy_time = self.query.copy()
         return copy_time
 
@@ -39,15 +40,13 @@ class Index(object):
     def __getitem__(self, val):
         if isinstance(val, str):
             copy_bf = self._bf.copy()
-            copy_bf.query.addWHERE("rowName()='{}'".format(val))
+            copy_bf.query = copy_bf.query.addWHERE(
+                BinOp('=', Func('rowName'), Const(val)))
             return copy_bf
         elif isinstance(val, list):
             copy_bf = self._bf.copy()
-            where = []
-            for v in val:
-                where.append("rowName()='{}'".format(v))
-
-            copy_bf.query.addWHERE("({})".format(" OR ".join(where)))
+            names = unique(Const(str(v)) for v in val)
+            copy_bf.query = copy_bf.query.addWHERE(In(Func('rowName'), names))
             return copy_bf
         elif isinstance(val, tuple):
             if len(val) != 2:
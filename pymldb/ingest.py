@@ -0,0 +1,352 @@
+#
+# ingest.py
+# Copyright (c) 2016 Datacratic. All rights reserved.
+#
+# Bulk uploads of rows: rows are grouped in large chunks posted to
+# /v1/datasets/<id>/multirows by a fixed number of worker threads.
+#
+from __future__ import absolute_import, division, print_function
+
+import csv
+import gzip
+import io
+import re
+import sys
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote
+
+from pymldb import ResourceError
+from pymldb.decode import dumps, loads
+from pymldb.metrics import clock
+
+_STOP = object()
+# statuses meaning that the server is overloaded, worth retrying
+_RETRY_STATUSES = (429, 503)
+# plain decimal numbers: no nan/inf spellings, underscores or zero padding
+_INTEGER = re.compile(r'-?(?:0|[1-9][0-9]*)$')
+_FLOAT = re.compile(
+    r'-?(?:(?:0|[1-9][0-9]*)(?:\.[0-9]*)?|\.[0-9]+)(?:[eE][-+]?[0-9]+)?$')
+
+
+def _non_finite(value):
+    """
+    JSON has no NaN or infinity (the standard encoder writes invalid JSON,
+    others write null), these are sent as strings.
+    """
+    if value != value:
+        return 'NaN'
+    return 'Infinity' if value > 0 else '-Infinity'
+
+
+def default_timestamp():
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+
+
+def _column_values(series):
+    """
+    Converts a column to a list of JSON serializable python values, nulls
+    becoming None and infinities strings.
+    """
+    import numpy as np
+    if series.dtype.kind == 'M':
+        series = series.dt.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+    nulls = series.isnull().values
+    values = series.values
+    infinite = None
+    if values.dtype.kind == 'f':
+        infinite = np.isinf(values)
+        if not infinite.any():
+            infinite = None
+    if nulls.any() or infinite is not None:
+        values = values.astype(object)
+        values[nulls] = None
+        if infinite is not None:
+            values[infinite] = [_non_finite(v) for v in values[infinite]]
+    elif values.dtype.kind in 'biuf':
+        # tolist() converts to python scalars in C
+        return values.tolist()
+    return np.asarray(values, dtype=object).tolist()
+
+
+def dataframe_chunks(df, chunk_rows, timestamp):
+    """
+    Yields lists of at most chunk_rows [rowName, [[column, value, timestamp],
+    ...]] rows out of df, the format of the multirows route. Conversions are
+    done a column at a time; null cells are skipped.
+    """
+    names = [str(c) for c in df.columns]
+    for start in range(0, len(df), chunk_rows):
+        part = df.iloc[start:start + chunk_rows]
+        row_names = part.index.astype(str).tolist()
+        columns = [_column_values(part.iloc[:, j]) for j in range(len(names))]
+        # zip(*columns) transposes the columns into rows
+        yield [[row_name, [[name, value, timestamp]
+                           for name, value in zip(names, row)
+                           if value is not None]]
+               for row_name, row in zip(row_names, zip(*columns))]
+
+
+class RowUploader(object):
+    """
+    Posts chunks of rows to /v1/datasets/<id>/multirows from `workers`
+    threads. put() blocks while max_in_flight chunks are waiting to be sent,
+    so a slow server slows the producer down instead of letting chunks pile
+    up in memory. Chunks refused with 429/503 or failing to connect are
+    retried up to `retries` times with an exponential backoff. The first
+    upload error is re-raised by put() or close().
+    """
+
+    def __init__(self, conn, dataset_id, workers=4, max_in_flight=None,
+                 retries=3, backoff_sec=0.5):
+        self.conn = conn
+        self.retries = retries
+        self.backoff_sec = backoff_sec
+        self.url = '{}/v1/datasets/{}/multirows'.format(
+            conn.uri, quote(dataset_id, safe=''))
+        if max_in_flight is None:
+            max_in_flight = 2 * workers
+        self._queue = queue.Queue(maxsize=max_in_flight)
+        self._error = None
+        self._lock = threading.Lock()
+        self.rows = 0
+        self.chunks = 0
+        self.bytes = 0
+        self.retried = 0
+        self.start = clock()
+        self._threads = [threading.Thread(target=self._work)
+                         for _ in range(workers)]
+        for t in self._threads:
+            t.daemon = True
+            t.start()
+
+    def _work(self):
+        while True:
+            chunk = self._queue.get()
+            if chunk is _STOP:
+                return
+            if self._error is not None:
+                continue  # drain
+            try:
+                body = dumps(chunk)
+                self._post(body)
+                with self._lock:
+                    self.rows += len(chunk)
+                    self.chunks += 1
+                    self.bytes += len(body)
+            except Exception as e:
+                self._error = e
+
+    def _post(self, body):
+        import requests
+        attempt = 0
+        while True:
+            try:
+                resp = self.conn.transport.post(
+                    self.url, data=body,
+                    headers={'Content-Type': 'application/json'})
+            except requests.ConnectionError:
+                if attempt >= self.retries:
+                    raise
+            else:
+                if 200 <= resp.status_code < 400:
+                    return
+                if resp.status_code not in _RETRY_STATUSES or \
+                        attempt >= self.retries:
+                    raise ResourceError(resp)
+            time.sleep(self.backoff_sec * 2 ** attempt)
+            attempt += 1
+            with self._lock:
+                self.retried += 1
+
+    def _check(self):
+        if self._error is not None:
+            raise self._error
+
+    def put(self, chunk):
+        self._check()
+        self._queue.put(chunk)
+
+    def close(self):
+        """Waits for every chunk to be uploaded."""
+        for _ in self._threads:
+            self._queue.put(_STOP)
+        for t in self._threads:
+            t.join()
+        self._check()
+
+    def stats(self):
+        with self._lock:
+            elapsed = clock() - self.start
+            return {
+                'rows': self.rows,
+                'chunks': self.chunks,
+                'bytes': self.bytes,
+                'retried': self.retried,
+                'seconds': elapsed,
+                'rows_per_sec': self.rows / elapsed if elapsed > 0 else None,
+            }
+
+
+def put_dataframe(conn, dataset_id, df, chunk_rows=5000, workers=4,
+                  max_in_flight=None, timestamp=None, create=True,
+                  dataset_type='tabular', commit=True):
+    """See Connection.put_dataframe."""
+    if timestamp is None:
+        timestamp = default_timestamp()
+    dataset_url = '/v1/datasets/' + quote(dataset_id, safe='')
+    if create:
+        conn.put(dataset_url, {'type': dataset_type})
+    uploader = RowUploader(conn, dataset_id, workers, max_in_flight)
+    try:
+        for chunk in dataframe_chunks(df, chunk_rows, timestamp):
+            uploader.put(chunk)
+    finally:
+        uploader.close()
+    if commit:
+        conn.post(dataset_url + '/commit')
+    else:
+        conn._invalidate(dataset_url)
+    return uploader.stats()
+
+
+def _open_text(path):
+    opener = gzip.open if path.endswith('.gz') else io.open
+    if sys.version_info[0] < 3:
+        # the python 2 csv module wants bytes
+        return opener(path, 'rb')
+    return opener(path, 'rt', encoding='utf-8', newline='')
+
+
+def _parse_value(value):
+    """
+    Types a CSV cell: int, then float, else string. Only plain decimal
+    numbers are typed, e.g. '00501', '1_000' and 'nan' stay strings. '' is
+    null.
+    """
+    if value == '':
+        return None
+    if _INTEGER.match(value):
+        return int(value)
+    if _FLOAT.match(value):
+        number = float(value)
+        if number - number == 0:  # not '1e999'
+            return number
+    return value
+
+
+def parse_csv(lines, **csv_args):
+    """Yields the rows of CSV lines starting with a header as typed dicts."""
+    for row in csv.DictReader(lines, **csv_args):
+        yield dict((k, _parse_value(v)) for k, v in row.items())
+
+
+def read_csv(path, **csv_args):
+    """Yields the rows of a CSV file with a header line as typed dicts."""
+    with _open_text(path) as f:
+        for row in parse_csv(f, **csv_args):
+            yield row
+
+
+def read_jsonl(path):
+    """Yields the objects of a file holding one JSON object per line."""
+    with _open_text(path) as f:
+        for line in f:
+            if line.strip():
+                yield loads(line)
+
+
+def _to_multirows(rows, row_name_column, timestamp, chunk_rows):
+    """
+    Groups dicts, or (rowName, dict) pairs, into multirows chunks. Rows are
+    named after row_name_column, or numbered from 1 when it is None.
+    """
+    chunk = []
+    for i, row in enumerate(rows):
+        if isinstance(row, dict):
+            if row_name_column is None:
+                row_name = str(i + 1)
+            else:
+                row_name = str(row[row_name_column])
+        else:
+            row_name, row = row
+            row_name = str(row_name)
+        # v - v is nan for non-finite floats
+        chunk.append([row_name, [[k, v if v.__class__ is not float or
+                                  v - v == 0 else _non_finite(v), timestamp]
+                                 for k, v in row.items()
+                                 if v is not None and k != row_name_column]])
+        if len(chunk) >= chunk_rows:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _print_progress(stats):
+    print('{rows} rows uploaded, {rows_per_sec:.0f} rows/sec'.format(
+        rows=stats['rows'], rows_per_sec=stats['rows_per_sec'] or 0))
+
+
+def ingest(conn, dataset_id, source, format=None, row_name_column=None,
+           chunk_rows=5000, workers=4, max_in_flight=None, timestamp=None,
+           create=True, dataset_type='tabular', commit=True, progress=True,
+           report_sec=5):
+    """See Connection.ingest."""
+    if timestamp is None:
+        timestamp = default_timestamp()
+    if progress is True:
+        progress = _print_progress
+
+    if isinstance(source, str):
+        if format is None:
+            name = source[:-3] if source.endswith('.gz') else source
+            format = 'jsonl' if name.endswith(('.jsonl', '.json')) else 'csv'
+        if format == 'csv':
+            source = read_csv(source)
+        elif format == 'jsonl':
+            source = read_jsonl(source)
+        else:
+            raise ValueError("format must be 'csv' or 'jsonl'")
+
+    dataset_url = '/v1/datasets/' + quote(dataset_id, safe='')
+    if create:
+        conn.put(dataset_url, {'type': dataset_type})
+    uploader = RowUploader(conn, dataset_id, workers, max_in_flight)
+    errors = []
+
+    def produce():
+        try:
+            for chunk in _to_multirows(source, row_name_column, timestamp,
+                                       chunk_rows):
+                uploader.put(chunk)
+        except Exception as e:
+            errors.append(e)
+
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+    try:
+        while producer.is_alive():
+            producer.join(report_sec)
+            if progress and producer.is_alive():
+                progress(uploader.stats())
+    finally:
+        uploader.close()
+    if errors:
+        raise errors[0]
+    if commit:
+        conn.post(dataset_url + '/commit')
+    else:
+        conn._invalidate(dataset_url)
+    stats = uploader.stats()
+    if progress:
+        progress(stats)
+    return stats
@@ -0,0 +1,181 @@
+#
+# lookup.py
+# Copyright (c) 2016 Datacratic. All rights reserved.
+#
+# Execution of queries filtering on a large set of keys, e.g.
+# BatFrame.ix[list] (rowName() IN (...)) or Column.isin(values): the key
+# set is split in chunks small enough for a query string, which are queried
+# concurrently, or uploaded to a temporary dataset queried with a subquery.
+# Rows selected by row name come back in the order of the keys.
+#
+from __future__ import absolute_import, division, print_function
+
+import uuid
+try:
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote
+
+from pymldb.expr import (BoolOp, Compiler, Func, In, Raw, as_expr,
+                         to_sql)
+
+# formats whose results can be concatenated
+_SPLITTABLE_FORMATS = ('soa', 'aos')
+
+
+def _conjuncts(node):
+    if isinstance(node, BoolOp) and node.op == 'AND':
+        return list(node.args)
+    return [node]
+
+
+def find_key_set(where):
+    """
+    Returns (in_node, other conjuncts) for the IN with the most values among
+    the conjuncts of the simplified where, or None if there isn't any.
+    """
+    if where is None:
+        return None
+    conjuncts = _conjuncts(Compiler().simplify(as_expr(where)))
+    ins = [c for c in conjuncts if isinstance(c, In)]
+    if not ins:
+        return None
+    key_set = max(ins, key=lambda c: len(c.values))
+    return key_set, [c for c in conjuncts if c is not key_set]
+
+
+def _encoded_length(value):
+    """Bytes taken by value and its comma in a percent-encoded URL."""
+    return len(quote(to_sql(value), safe='')) + 3
+
+
+def key_chunks(values, max_bytes):
+    """
+    Splits values in lists which take at most about max_bytes of the
+    percent-encoded query string.
+    """
+    chunk = []
+    size = 0
+    for value in values:
+        length = _encoded_length(value)
+        if chunk and size + length > max_bytes:
+            yield chunk
+            chunk = []
+            size = 0
+        chunk.append(value)
+        size += length
+    if chunk:
+        yield chunk
+
+
+def concat_results(results, format):
+    """Concatenates 'soa' or 'aos' query results."""
+    if format == 'aos':
+        return [row for result in results for row in result]
+    columns = []
+    for result in results:
+        columns.extend(c for c in result if c not in columns)
+    merged = dict((c, []) for c in columns)
+    for result in results:
+        num_rows = len(result.get('_rowName', ()))
+        for c in columns:
+            merged[c].extend(result.get(c, [None] * num_rows))
+    return merged
+
+
+def order_by_keys(result, format, keys):
+    """Sorts the rows of a 'soa' or 'aos' result in the order of keys."""
+    position = dict((k, i) for i, k in enumerate(keys))
+    last = len(keys)
+    if format == 'aos':
+        return sorted(result,
+                      key=lambda row: position.get(row['_rowName'], last))
+    if not result:
+        return result
+    row_names = result['_rowName']
+    order = sorted(range(len(row_names)),
+                   key=lambda i: position.get(row_names[i], last))
+    return dict((c, [values[i] for i in order])
+                for c, values in result.items())
+
+
+def _run_chunks(query, key_set, others, format, max_bytes, parallel,
+                strict):
+    queries = [
+        query.replace(WHERE=BoolOp('AND',
+                                   others + [In(key_set.operand, chunk)]))
+        for chunk in key_chunks(key_set.values, max_bytes)]
+    if len(queries) == 1 or parallel <= 1:
+        results = [q._execute(format, strict) for q in queries]
+    else:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(parallel, len(queries)))
+        try:
+            results = pool.map(lambda q: q._execute(format, strict),
+                               queries)
+        finally:
+            pool.close()
+            pool.join()
+    return concat_results(results, format)
+
+
+def _run_with_temp_dataset(query, key_set, others, format, strict):
+    conn = query.conn
+    dataset_id = 'pymldb_keys_' + uuid.uuid4().hex
+    conn.ingest(dataset_id,
+                ((i, {'key': v.value}) for i, v in enumerate(key_set.values)),
+                progress=False)
+    try:
+        subquery = Raw('{} IN (SELECT key FROM "{}")'.format(
+            to_sql(key_set.operand), dataset_id))
+        return query.replace(
+            WHERE=BoolOp('AND', others + [subquery]))._execute(format, strict)
+    finally:
+        conn.delete('/v1/datasets/' + quote(dataset_id, safe=''))
+
+
+def execute(query, format, strict=False):
+    """
+    Runs query (a pymldb.query.Query), splitting its biggest IN (...) when
+    its percent-encoded SQL exceeds conn.max_in_bytes:
+      - in chunks run by conn.lookup_parallel threads, when the query can
+        be split (no GROUP BY, ORDER BY, LIMIT or OFFSET and format 'soa'
+        or 'aos')
+      - through a temporary dataset holding the keys, when there are at
+        least conn.temp_dataset_keys keys (None: never), or when the query
+        cannot be split
+    Rows selected by rowName() IN (...) are returned in the order of the
+    keys unless the query has an ORDER BY. With strict, an error response
+    raises a ResourceError instead of being returned.
+    """
+    found = find_key_set(query.WHERE)
+    if found is None:
+        return query._execute(format, strict)
+    key_set, others = found
+    conn = query.conn
+    max_bytes = getattr(conn, 'max_in_bytes', 6000)
+    temp_dataset_keys = getattr(conn, 'temp_dataset_keys', None)
+    splittable = format in _SPLITTABLE_FORMATS and not (
+        query.GROUPBY or query.ORDERBY or query.LIMIT is not None or
+        query.OFFSET is not None)
+
+    if temp_dataset_keys is not None and \
+            len(key_set.values) >= temp_dataset_keys:
+        result = _run_with_temp_dataset(query, key_set, others, format,
+                                        strict)
+    elif sum(_encoded_length(v) for v in key_set.values) <= max_bytes:
+        result = query._execute(format, strict)
+    elif splittable:
+        result = _run_chunks(query, key_set, others, format, max_bytes,
+                             getattr(conn, 'lookup_parallel', 4), strict)
+    elif temp_dataset_keys is not None:
+        result = _run_with_temp_dataset(query, key_set, others, format,
+                                        strict)
+    else:
+        result = query._execute(format, strict)
+
+    if key_set.operand == Func('rowName') and not query.ORDERBY and \
+            format in _SPLITTABLE_FORMATS and result:
+        result = order_by_keys(result, format,
+                               [v.value for v in key_set.values])
+    return result
@@ -3,12 +3,17 @@
 # Copyright (c) 2013 Datacratic. All rights reserved.
 #
 
-import requests, json
+import json
+import os
+from pymldb import _default_connection, ResourceError
 from pymldb.util import add_repr_html_to_response
-import pandas as pd
 
 host = "http://localhost"
 
+def transport():
+    """Pooled transport of the connection shared by every magic for host."""
+    return _default_connection(host).transport
+
 ###############################################################################
 # Functions used by the cell and line magics
 
@@ -40,7 +45,8 @@ Usage:
 
     %mldb loadcsv <dataset> <url>
                         Create a dataset with id <dataset> from a CSV
-                        hosted at the HTTP url <url>.
+                        hosted at the HTTP url <url>, or stored in the
+                        local file <url> (path or file://<path>).
                         
     %mldb py <uri> <json args>
                         Run a python script named "main.py" from <uri>
@@ -116,31 +122,50 @@ Usage:
 
 
 def load_csv(dataset, csv_input):
-
-    payload = {"args": [dataset, csv_input]}
-    payload["source"] = """
-import csv, urllib, StringIO
-if mldb.script.args[1].startswith("http"):
-    reader = csv.DictReader(open(urllib.urlretrieve(mldb.script.args[1])[0]))
-else:
-    reader = csv.DictReader(StringIO.StringIO(mldb.script.args[1]))
-
-dataset = mldb.create_dataset(dict(id=mldb.script.args[0], type="beh.mutable"))
-for i, row in enumerate(reader):
-    values = []
-    row_name = i
-    for col in row:
-        if col == "":
-            row_name = row[col]
-        else:
-            values.append([col, row[col], 0])
-    dataset.record_row(row_name, values)
-dataset.commit()
-print "Success!"
     """
-    resp = requests.post(host+"/v1/types/plugins/python/routes/run",
-                     data=json.dumps(payload))
-    return handle_script_output(resp)
+    csv_input is either the http(s) URL of a CSV file, which MLDB imports
+    itself with an import.text procedure, a local path (optionally prefixed
+    by file://) or the CSV content itself. Local content is streamed to MLDB
+    in typed, multi-row chunks by Connection.ingest and its rows are named
+    after the column with an empty header if there is one, else numbered
+    from 0. Rows imported from a URL keep the names import.text gives them
+    (their line number in the file).
+    """
+    if csv_input.startswith("http"):
+        payload = {
+            "type": "import.text",
+            "params": {
+                "dataFileUrl": csv_input,
+                "outputDataset": {"id": dataset, "type": "tabular"},
+                "runOnCreation": True
+            }
+        }
+        try:
+            _default_connection(host).post("/v1/procedures", payload)
+        except ResourceError as e:
+            return add_repr_html_to_response(e.result)
+        print("Success!")
+        return
+
+    from pymldb.ingest import parse_csv, read_csv
+    path = csv_input[len("file://"):] if csv_input.startswith("file://") \
+        else csv_input
+    if "\n" not in csv_input and os.path.isfile(path):
+        rows = read_csv(path)
+    else:
+        rows = parse_csv(csv_input.splitlines(True))
+
+    def named(rows):
+        for i, row in enumerate(rows):
+            row_name = row.pop("", None)
+            yield (i if row_name is None else row_name), row
+
+    try:
+        _default_connection(host).ingest(dataset, named(rows),
+                                         progress=False)
+    except ResourceError as e:
+        return add_repr_html_to_response(e.result)
+    print("Success!")
 
 def handle_script_output(resp):
     if resp.status_code != 200:
@@ -159,12 +184,13 @@ def handle_script_output(resp):
 def run_query(q):
     global host
 
-    resp = requests.get(host+"/v1/query", 
+    resp = transport().get(host+"/v1/query", 
         data={"q": q, "format": "aos"})
 
     if resp.status_code != 200:
         return add_repr_html_to_response(resp)
 
+    import pandas as pd
     resp_json = resp.json()
     if len(resp_json) == 0: 
         return pd.DataFrame()
@@ -205,7 +231,7 @@ def dispatcher(line, cell=None):
             payload = {"address": parts[1]}
             if len(parts) > 2:
                 payload["args"] = json.loads(" ".join(parts[2:]))
-            resp = requests.post(host+"/v1/types/plugins/" + type_name + "/routes/run",
+            resp = transport().post(host+"/v1/types/plugins/" + type_name + "/routes/run",
                              data=json.dumps(payload))
             return handle_script_output(resp)
         
@@ -219,8 +245,8 @@ def dispatcher(line, cell=None):
     
             name = parts[1]
             payload = {"type":"python", "params": {"address": parts[2]}}
-            requests.delete(host+"/v1/plugins/" + name)
-            resp = requests.put(host+"/v1/plugins/" + name,
+            transport().delete(host+"/v1/plugins/" + name)
+            resp = transport().put(host+"/v1/plugins/" + name,
                              data=json.dumps(payload))
             return add_repr_html_to_response(resp)
 
@@ -229,9 +255,10 @@ def dispatcher(line, cell=None):
 
             verb, uri = parts
             if verb == "GET":
-                resp = requests.get(host+uri)
+                resp = transport().get(host+uri)
             elif verb == "DELETE":
-                resp = requests.delete(host+uri)
+                resp = transport().delete(host+uri)
+                _default_connection(host)._invalidate(uri)
                 
             return add_repr_html_to_response(resp)
 
@@ -245,11 +272,13 @@ def dispatcher(line, cell=None):
                 for k in payload:       
                     if isinstance(payload[k], dict):        
                         payload[k] = json.dumps(payload[k])
-                resp = requests.get(host+uri, params=payload)
+                resp = transport().get(host+uri, params=payload)
             elif verb == "PUT":
-                resp = requests.put(host+uri, data=json.dumps(payload))
+                resp = transport().put(host+uri, data=json.dumps(payload))
             elif verb == "POST":
-                resp = requests.post(host+uri, data=json.dumps(payload))
+                resp = transport().post(host+uri, data=json.dumps(payload))
+            if verb != "GET":
+                _default_connection(host)._invalidate(uri, payload)
                 
             return add_repr_html_to_response(resp)
 
@@ -278,7 +307,7 @@ def dispatcher(line, cell=None):
             payload = {"source": cell}
             if len(parts) > 1:
                 payload["args"] = json.loads(" ".join(parts[1:]))
-            resp = requests.post(host+"/v1/types/plugins/" + type_name + "/routes/run",
+            resp = transport().post(host+"/v1/types/plugins/" + type_name + "/routes/run",
                              data=json.dumps(payload))
             
             return handle_script_output(resp)
@@ -299,11 +328,13 @@ def dispatcher(line, cell=None):
                     if isinstance(payload[k], dict):
                         payload[k] = json.dumps(payload[k])
                         
-                resp = requests.get(host+uri, params=payload)
+                resp = transport().get(host+uri, params=payload)
             elif verb == "PUT":
-                resp = requests.put(host+uri, data=json.dumps(payload))
+                resp = transport().put(host+uri, data=json.dumps(payload))
             elif verb == "POST":
-                resp = requests.post(host+uri, data=json.dumps(payload))
+                resp = transport().post(host+uri, data=json.dumps(payload))
+            if verb != "GET":
+                _default_connection(host)._invalidate(uri, payload)
                 
             return add_repr_html_to_response(resp)
         # help
@@ -0,0 +1,246 @@
+#
+# metrics.py
+# Copyright (c) 2016 Datacratic. All rights reserved.
+#
+# Per route and verb instrumentation of the HTTP calls made by a Connection:
+# latency histograms per phase, bytes sent/received and status codes.
+#
+from __future__ import absolute_import, division, print_function
+
+import bisect
+import logging
+import threading
+import time
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+try:
+    clock = time.perf_counter
+except AttributeError:
+    clock = time.time
+
+# the segment following one of these is an id
+_COLLECTIONS = set(['datasets', 'procedures', 'functions', 'plugins', 'types',
+                    'runs', 'columns', 'rows'])
+
+# histogram bucket upper bounds, in seconds
+BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5,
+           1, 2, 5, 10, 30, 60)
+
+
+def route_template(url):
+    """
+    Replaces the ids of a url path by placeholders, e.g.
+    http://host/v1/datasets/foo/rows -> /v1/datasets/<id>/rows
+    """
+    path = urlsplit(url).path
+    parts = path.split('/')
+    for i in range(1, len(parts)):
+        if parts[i - 1] in _COLLECTIONS and parts[i] and \
+                parts[i] not in _COLLECTIONS:
+            parts[i] = '<id>'
+    return '/'.join(parts)
+
+
+class Histogram(object):
+    """Fixed buckets latency histogram. Not thread-safe on its own."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile."""
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'min': self.min,
+            'max': self.max,
+            'mean': self.sum / self.count if self.count else None,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+            'buckets': list(zip(self.buckets + (float('inf'),), self.counts)),
+        }
+
+
+class _RouteStats(object):
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.coalesced = 0
+        self.status = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.latency = {}
+
+    def observe(self, phase, seconds):
+        histogram = self.latency.get(phase)
+        if histogram is None:
+            histogram = self.latency[phase] = Histogram()
+        histogram.add(seconds)
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'coalesced': self.coalesced,
+            'status': dict(self.status),
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+            'latency': dict((phase, h.summary())
+                            for phase, h in self.latency.items()),
+        }
+
+
+class _Timer(object):
+
+    def __init__(self, metrics, verb, url, phase):
+        self.metrics = metrics
+        self.verb = verb
+        self.url = url
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = clock()
+        return self
+
+    def __exit__(self, *args):
+        self.metrics.observe(self.verb, self.url, self.phase,
+                             clock() - self.start)
+
+
+class Metrics(object):
+    """
+    Thread-safe registry of request statistics, keyed by "VERB /route".
+
+    Latency phases recorded for every request:
+      - connect: opening a new connection (0 when a pooled one was reused)
+      - server: from sending the request to receiving the response headers
+      - download: reading the response body
+      - total: the whole call
+    Phases recorded by the callers that decode results:
+      - decode: JSON parsing
+      - build: DataFrame construction
+
+    Requests answered by an identical one already in flight (see
+    Transport(coalesce=True)) are not counted as requests but as coalesced.
+
+    Hooks are called as hook(verb, route, name, value) for every observation,
+    name being a latency phase (value in seconds), 'bytes_sent',
+    'bytes_received', 'status' or 'coalesced'. They can be used to export
+    the numbers to another metrics system. Exceptions raised by hooks are
+    logged and ignored. Recording costs a lock and a few additions per
+    request, so it can be left on; Metrics(enabled=False) turns it off.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._routes = {}
+        self._hooks = []
+        self._lock = threading.Lock()
+
+    def add_hook(self, hook):
+        self._hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self._hooks.remove(hook)
+
+    def _route(self, verb, route):
+        key = '{} {}'.format(verb, route)
+        stats = self._routes.get(key)
+        if stats is None:
+            stats = self._routes[key] = _RouteStats()
+        return stats
+
+    def _notify(self, verb, route, name, value):
+        for hook in self._hooks:
+            try:
+                hook(verb, route, name, value)
+            except Exception:
+                logger.exception("metrics hook failed")
+
+    def record_request(self, verb, url, status, bytes_sent, bytes_received,
+                       phases):
+        """Records one HTTP exchange. phases maps phase names to seconds."""
+        if not self.enabled:
+            return
+        route = route_template(url)
+        with self._lock:
+            stats = self._route(verb, route)
+            stats.count += 1
+            if status is None or status >= 400:
+                stats.errors += 1
+            stats.status[status] = stats.status.get(status, 0) + 1
+            stats.bytes_sent += bytes_sent
+            stats.bytes_received += bytes_received
+            for phase, seconds in phases.items():
+                stats.observe(phase, seconds)
+        if self._hooks:
+            self._notify(verb, route, 'status', status)
+            self._notify(verb, route, 'bytes_sent', bytes_sent)
+            self._notify(verb, route, 'bytes_received', bytes_received)
+            for phase, seconds in phases.items():
+                self._notify(verb, route, phase, seconds)
+
+    def record_coalesced(self, verb, url):
+        """Records a request which shared the response of an identical one."""
+        if not self.enabled:
+            return
+        route = route_template(url)
+        with self._lock:
+            self._route(verb, route).coalesced += 1
+        if self._hooks:
+            self._notify(verb, route, 'coalesced', 1)
+
+    def observe(self, verb, url, phase, seconds):
+        """Records the duration of a client side phase (decode, build...)"""
+        if not self.enabled:
+            return
+        route = route_template(url)
+        with self._lock:
+            self._route(verb, route).observe(phase, seconds)
+        if self._hooks:
+            self._notify(verb, route, phase, seconds)
+
+    def time(self, verb, url, phase):
+        """Context manager recording the duration of its block as phase."""
+        return _Timer(self, verb, url, phase)
+
+    def snapshot(self):
+        with self._lock:
+            return dict((key, stats.summary())
+                        for key, stats in self._routes.items())
+
+    def reset(self):
+        with self._lock:
+            self._routes = {}
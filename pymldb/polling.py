@@ -0,0 +1,104 @@
+#
+# polling.py
+# Copyright (c) 2016 Datacratic. All rights reserved.
+#
+# Policies deciding when a ProgressMonitor polls its procedure run next.
+# A policy instance holds the state of a single run.
+#
+from __future__ import absolute_import, division, print_function
+
+
+def current_step(progress):
+    """Returns the step being executed out of a run's progress, or None."""
+    if not progress:
+        return None
+    steps = progress.get('steps', [progress])
+    for step in steps:
+        if 'started' in step and 'ended' not in step:
+            return step
+    return None
+
+
+class FixedPolling(object):
+    """Polls every interval seconds, first_interval seconds after launch."""
+
+    def __init__(self, interval=1, first_interval=0.5):
+        self.interval = interval
+        self.first_interval = first_interval
+
+    def first(self):
+        return self.first_interval
+
+    def next(self, state, progress, now):
+        if state is None:
+            # the run doesn't exist yet
+            return self.first_interval
+        return self.interval
+
+
+class AdaptivePolling(object):
+    """
+    Polls quickly after launch, then backs off exponentially (by backoff, up
+    to max_interval) as long as the current step progresses at a steady rate
+    or not at all. Whenever a step starts, or the rate changes by more than
+    rate_tolerance, polling goes back to min_interval.
+
+    For steps reporting a fraction (value <= 1), the observed rate gives an
+    ETA of the end of the step, and the next poll is scheduled right then if
+    that is sooner than the backed off interval.
+    """
+
+    def __init__(self, min_interval=0.1, max_interval=30, backoff=2.0,
+                 rate_tolerance=0.25):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.rate_tolerance = rate_tolerance
+        self.interval = min_interval
+        self._step = None
+        self._value = None
+        self._time = None
+        self._rate = None
+
+    def first(self):
+        return self.min_interval
+
+    def _back_off(self):
+        self.interval = min(self.interval * self.backoff, self.max_interval)
+
+    def next(self, state, progress, now):
+        step = current_step(progress) if state == 'executing' else None
+        if step is None:
+            # not started yet or between steps
+            self._back_off()
+            return self.interval
+
+        name = step.get('name')
+        value = step.get('value', 0)
+        if name != self._step:
+            self._step = name
+            self._value = value
+            self._time = now
+            self._rate = None
+            self.interval = self.min_interval
+            return self.interval
+
+        elapsed = now - self._time
+        if value > self._value and elapsed > 0:
+            rate = (value - self._value) / elapsed
+            if self._rate is not None and \
+                    abs(rate - self._rate) > self.rate_tolerance * self._rate:
+                self.interval = self.min_interval
+            else:
+                self._back_off()
+            self._rate = rate
+            self._value = value
+            self._time = now
+        else:
+            self._back_off()
+
+        interval = self.interval
+        if self._rate and value <= 1:
+            eta = (1 - value) / self._rate
+            interval = max(min(interval, eta), self.min_interval)
+        return interval
@@ -0,0 +1,96 @@
+#
+# prefetch.py
+# Copyright (c) 2016 Datacratic. All rights reserved.
+#
+# Runs an iterator in a background thread so that producing the next items
+# (typically fetching the next page of a query) overlaps with the consumer's
+# processing of the current one.
+#
+from __future__ import absolute_import, division, print_function
+
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+_DONE = object()
+
+
+class Prefetcher(object):
+    """
+    Iterator over `iterable` whose items are produced by a background thread,
+    at most `depth` items ahead of the consumer. Exceptions raised while
+    producing are re-raised in the consumer.
+    """
+
+    def __init__(self, iterable, depth=1):
+        self._queue = queue.Queue(maxsize=max(depth, 1))
+        self._stop = threading.Event()
+        self._finished = False
+        self._thread = threading.Thread(target=self._produce,
+                                        args=(iter(iterable),))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _put(self, item):
+        # poll so that close() can unblock a producer waiting on a full queue
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self, iterator):
+        try:
+            for item in iterator:
+                if not self._put((item, None)):
+                    return
+        except Exception as e:
+            self._put((_DONE, e))
+            return
+        self._put((_DONE, None))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._finished:
+            raise StopIteration
+        item, error = self._queue.get()
+        if item is _DONE:
+            self._finished = True
+            self._stop.set()
+            if error is not None:
+                raise error
+            raise StopIteration
+        return item
+
+    next = __next__  # python 2
+
+    def close(self):
+        """Stops the producer, dropping whatever was prefetched."""
+        self._finished = True
+        self._stop.set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def prefetched(iterable, depth=1):
+    """
+    Generator over a Prefetcher of iterable which stops its producer thread
+    when the generator is closed or garbage collected, e.g. when the consumer
+    breaks out of a for loop.
+    """
+    prefetcher = Prefetcher(iterable, depth)
+    try:
+        for item in prefetcher:
+            yield item
+    finally:
+        prefetcher.close()
@@ -8,98 +8,282 @@
 # cancel button. The button # will fail if the notebook is not under the same
 # host:port than MLDB because of cross origin policies.
 #
+# A RunTracker polls any number of ProgressMonitors from a single thread.
+#
 from __future__ import absolute_import, division, print_function
 import threading
-import requests
+import traceback
+from collections import OrderedDict
+from .metrics import clock
+from .polling import FixedPolling
 from .steps_logger import getStepsLogger
 
 class ProgressMonitor(object):
 
     def __init__(self, conn, refresh_rate_sec, proc_id, run_id=None,
-                 notebook=True):
+                 notebook=True, policy=None):
+        """
+        policy decides when to poll next, see polling.py. Defaults to
+        polling every refresh_rate_sec.
+        """
         self.conn = conn
         self.refresh_rate_sec = refresh_rate_sec
         self.proc_id = proc_id
         self.run_id = run_id
         self.event = threading.Event()
+        # set once the monitor is done with the run, finish() included
+        self.done = threading.Event()
+        # held while polling or finishing, which can happen in two threads
+        # with a RunTracker
+        self.lock = threading.Lock()
+        self.run_id_flat = None
+        self.sl = None
+        if policy is None:
+            policy = FixedPolling(refresh_rate_sec)
+        self.policy = policy
+        # last state and progress seen, None until the run exists
+        self.state = None
+        self.progress = None
+        self.polls = 0
         self.notebook = notebook
         if self.notebook:
             from IPython.display import display, HTML
             self.display_html = lambda x: display(HTML(x))
 
+    def _steps_logger(self):
+        if self.sl is None:
+            self.sl = getStepsLogger(self.notebook)
+        return self.sl
+
+    def _get_run(self):
+        return self.conn.transport.get(
+            self.conn.uri + '/v1/procedures/{}/runs/{}'.format(
+                self.proc_id, self.run_id)).json()
+
+    def poll(self):
+        """
+        Checks the run once and logs its progress. Returns False once the run
+        is over, True while it should still be polled.
+        """
+        conn = self.conn
+        sl = self._steps_logger()
+        self.polls += 1
+        if self.run_id is None:
+            # find run id
+            res = conn.get('/v1/procedures/{}/runs'.format(self.proc_id)).json()
+            if res:
+                self.run_id = res[0]
+            else:
+                return True
+        if self.run_id_flat is None:
+            self.run_id_flat = self.run_id
+            for c in '-.:':
+                self.run_id_flat = self.run_id_flat.replace(c, '_')
+            if conn.uri == 'localhost':
+                host = ''
+            else:
+                host = conn.uri
+            if self.notebook:
+                self.display_html("""
+                    <script type="text/javascript">
+                        function cancel_{run_id_flat}(btn) {{
+                            $(btn).attr("disabled", true).html("Cancelling...");
+                            $.ajax({{
+                                url: "{host}/v1/procedures/{proc_id}/runs/{run_id}/state",
+                                type: 'PUT',
+                                data: JSON.stringify({{"state" : "cancelled"}}),
+                                success: () => {{ $(btn).html("Cancelled"); }},
+                                error: (xhr) => {{ console.error(xhr);
+                                                    console.warn("If this is a Cross-Origin Request, this is a normal error. Otherwise you may report it.");
+                                                    $(btn).html("Cancellation failed - See JavaScript console");
+                                                }}
+                            }});
+                        }}
+                    </script>
+                    <button id="{run_id_flat}" onclick="cancel_{run_id_flat}(this);">Cancel</button>
+                """.format(run_id=self.run_id, run_id_flat=self.run_id_flat,
+                           proc_id=self.proc_id, host=host))
+        res = self._get_run()
+        self.state = res['state']
+        self.progress = res.get('progress')
+        if res['state'] == 'executing':
+            if 'steps' in res['progress']:
+                sl.log_progress_steps(res['progress']['steps'])
+            else:
+                sl.log_progress_steps([res['progress']])
+        elif res['state'] == 'initializing':
+            pass
+        else:
+            return False
+        return True
+
+    def next_interval(self):
+        """Seconds until the next poll, according to the policy."""
+        return self.policy.next(self.state, self.progress, clock())
+
+    def finish(self):
+        """Cleans up the display once the run is over or tracking stopped."""
+        if self.run_id is not None:
+            if self.notebook:
+                self.display_html("""
+                    <script type="text/javascript" class="removeMe">
+                        $(function() {{
+                            var outputArea = $(".removeMe").parents(".output_area:first");
+                            outputArea.prevAll().remove();
+                            outputArea.next().remove();
+                            outputArea.remove();
+                        }})
+                    </script>
+                """.format(run_id_flat=self.run_id_flat))
+            res = self._get_run()
+            if res['state'] == 'finished':
+                self._steps_logger().clean_finish()
+
     def monitor_progress(self):
         # wrap everything in a try/except because exceptions are not passed to
         # mldb.log by themselves.
-        proc_id = self.proc_id
-        run_id = self.run_id
-        conn = self.conn
-        refresh_rate_sec = 0.5
-        run_id_flat = None
         try:
-            # find run id
-            sl = getStepsLogger(self.notebook)
-            while not self.event.wait(refresh_rate_sec):
-                if run_id is None:
-                    res = conn.get('/v1/procedures/{}/runs'.format(proc_id)).json()
-                    if res:
-                        run_id = res[0]
-                    else:
-                        continue
-                refresh_rate_sec = self.refresh_rate_sec
-                if run_id_flat is None:
-                    run_id_flat = run_id
-                    for c in '-.:':
-                        run_id_flat = run_id_flat.replace(c, '_')
-                    if conn.uri == 'localhost':
-                        host = ''
-                    else:
-                        host = conn.uri
-                    if self.notebook:
-                        self.display_html("""
-                            <script type="text/javascript">
-                                function cancel_{run_id_flat}(btn) {{
-                                    $(btn).attr("disabled", true).html("Cancelling...");
-                                    $.ajax({{
-                                        url: "{host}/v1/procedures/{proc_id}/runs/{run_id}/state",
-                                        type: 'PUT',
-                                        data: JSON.stringify({{"state" : "cancelled"}}),
-                                        success: () => {{ $(btn).html("Cancelled"); }},
-                                        error: (xhr) => {{ console.error(xhr);
-                                                            console.warn("If this is a Cross-Origin Request, this is a normal error. Otherwise you may report it.");
-                                                            $(btn).html("Cancellation failed - See JavaScript console");
-                                                        }}
-                                    }});
-                                }}
-                            </script>
-                            <button id="{run_id_flat}" onclick="cancel_{run_id_flat}(this);">Cancel</button>
-                        """.format(run_id=run_id, run_id_flat=run_id_flat, proc_id=proc_id, host=host))
-                res = requests.get(conn.uri + '/v1/procedures/{}/runs/{}'.format(proc_id, run_id)).json()
-                if res['state'] == 'executing':
-                    if 'steps' in res['progress']:
-                        sl.log_progress_steps(res['progress']['steps'])
-                    else:
-                        sl.log_progress_steps([res['progress']])
-                elif res['state'] == 'initializing':
-                    continue
-                else:
+            interval = self.policy.first()
+            while not self.event.wait(interval):
+                if not self.poll():
                     break
-            if run_id is not None:
-                if self.notebook:
-                    self.display_html("""
-                        <script type="text/javascript" class="removeMe">
-                            $(function() {{
-                                var outputArea = $(".removeMe").parents(".output_area:first");
-                                outputArea.prevAll().remove();
-                                outputArea.next().remove();
-                                outputArea.remove();
-                            }})
-                        </script>
-                    """.format(run_id_flat=run_id_flat))
-                res = requests.get(conn.uri + '/v1/procedures/{}/runs/{}'.format(proc_id, run_id)).json()
-                if res['state'] == 'finished':
-                    sl.clean_finish()
-
+                interval = self.next_interval()
+            self.finish()
         except Exception as e:
             print(str(e))
             import traceback
             print(traceback.format_exc())
+        finally:
+            self.done.set()
+
+
+class RunTracker(object):
+    """
+    Polls the ProgressMonitors of many procedure runs from a single thread.
+
+    Each run is polled when its polling policy says so, but the total poll
+    rate is capped at max_polls_per_sec: with many runs, each one is polled
+    less often instead of hitting MLDB harder. The thread only exists while
+    there are runs to track.
+
+    poll_counts maps (proc_id, run_id) to the number of polls made, for the
+    active runs and the last `history` finished ones.
+    """
+
+    def __init__(self, max_polls_per_sec=20, history=1000):
+        self.max_polls_per_sec = max_polls_per_sec
+        self.history = history
+        self.poll_counts = OrderedDict()
+        self._next_poll = {}  # ProgressMonitor -> time of its next poll
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def track(self, pm):
+        """Starts polling pm."""
+        with self._lock:
+            self._next_poll[pm] = clock() + pm.policy.first()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+        self._wakeup.set()
+
+    def stop(self, pm, wait=True):
+        """
+        Stops polling pm. With wait, its final update is made right away in
+        the calling thread (after a poll of pm in progress, if any) instead
+        of waiting for the tracker thread to get to it.
+        """
+        pm.event.set()
+        self._wakeup.set()
+        if not wait:
+            return
+        if self._release(pm):
+            self._finish(pm)
+        else:
+            # the tracker saw the run end and is finishing it
+            pm.done.wait()
+
+    def _count_polls(self, pm):
+        self.poll_counts[(pm.proc_id, pm.run_id)] = pm.polls
+
+    def active(self):
+        with self._lock:
+            return len(self._next_poll)
+
+    def _release(self, pm):
+        """
+        Stops tracking pm. Returns whether it was still tracked, in which
+        case the caller has to _finish() it.
+        """
+        with self._lock:
+            if self._next_poll.pop(pm, None) is None:
+                return False
+            self._count_polls(pm)
+            while len(self.poll_counts) > self.history + len(self._next_poll):
+                self.poll_counts.popitem(last=False)
+        return True
+
+    def _finish(self, pm, finish=True):
+        try:
+            if finish:
+                with pm.lock:
+                    pm.finish()
+        except Exception as e:
+            print(str(e))
+            print(traceback.format_exc())
+        finally:
+            pm.done.set()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._next_poll:
+                    self._thread = None
+                    return
+                schedule = list(self._next_poll.items())
+            # the more runs, the less often each one is polled
+            min_interval = len(schedule) / self.max_polls_per_sec
+
+            now = clock()
+            due = []
+            for pm, next_poll in schedule:
+                if pm.event.is_set():
+                    if self._release(pm):
+                        self._finish(pm)
+                elif next_poll <= now:
+                    due.append((next_poll, pm))
+            due.sort(key=lambda x: x[0])
+
+            for _, pm in due:
+                try:
+                    with pm.lock:
+                        if pm.event.is_set():
+                            # stopped, finished by stop()
+                            continue
+                        running = pm.poll()
+                except Exception as e:
+                    print(str(e))
+                    print(traceback.format_exc())
+                    if self._release(pm):
+                        self._finish(pm, finish=False)
+                    continue
+                if not running:
+                    if self._release(pm):
+                        self._finish(pm)
+                    continue
+                interval = pm.next_interval()
+                with self._lock:
+                    self._count_polls(pm)
+                    if pm in self._next_poll:
+                        self._next_poll[pm] = \
+                            clock() + max(interval, min_interval)
+
+            with self._lock:
+                if not self._next_poll:
+                    continue
+                wait = min(self._next_poll.values()) - clock()
+            if wait > 0:
+                self._wakeup.wait(wait)
+            self._wakeup.clear()
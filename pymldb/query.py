@@ -11,65 +11,98 @@
 import json
 import requests
 import traceback
-import copy
-from collections import Counter
 import logging
-logging.basicConfig(level=logging.DEBUG)
+from pymldb.decode import loads
+from pymldb.cache import dataset_from_url
+from pymldb.expr import BoolOp, Compiler, as_expr, unique
+from pymldb import lookup
+logger = logging.getLogger(__name__)
 
 
 class Query(object):
-    """docstring for Query"""
-    def __init__(self, dataset_url):
-        self.dataset_url = dataset_url
-        self.SELECT = Counter()
-        self.WHERE = None # list()
-        self.GROUPBY = list()
-        self.OFFSET = None
-        self.LIMIT = None
-        self.ORDERBY = list()
+    """
+    Immutable description of a query on a dataset.
+
+    The add/remove/set/merge methods don't modify the query, they return a
+    new one. Derived queries share every part that is left unchanged with
+    their parent (the clauses are tuples and strings), so deriving a query
+    costs a few attribute copies instead of deep copies, and copy() returns
+    the query itself. buildQuery() is computed once per query.
+
+    SELECT is a tuple of expressions in which an expression appears once per
+    addSELECT call, which removeSELECT undoes one at a time. Expressions
+    are SQL strings or pymldb.expr trees; trees are simplified when the
+    query is built, sharing the work between SELECT and WHERE.
+    """
+    _FIELDS = ('SELECT', 'WHERE', 'GROUPBY', 'HAVING', 'OFFSET', 'LIMIT',
+               'ORDERBY')
+
+    def __init__(self, dataset_url, conn=None):
+        if conn is None:
+            from pymldb import _default_connection
+            conn = _default_connection(dataset_url)
+        fields = self.__dict__
+        fields['dataset_url'] = dataset_url
+        fields['conn'] = conn
+        fields['SELECT'] = ()
+        fields['WHERE'] = None
+        fields['GROUPBY'] = ()
+        fields['HAVING'] = None
+        fields['OFFSET'] = None
+        fields['LIMIT'] = None
+        fields['ORDERBY'] = ()
+        fields['_built'] = None
+
+    def __setattr__(self, name, value):
+        raise AttributeError(
+            "Query is immutable, use replace() to derive a new one")
+
+    def replace(self, **changes):
+        """Returns a query sharing everything but the given clauses."""
+        for name in changes:
+            if name not in self._FIELDS:
+                raise TypeError("Unknown clause {}".format(name))
+        query = Query.__new__(Query)
+        fields = query.__dict__
+        fields.update(self.__dict__)
+        fields.update(changes)
+        fields['_built'] = None
+        return query
 
     def addSELECT(self, obj):
-        logging.debug("Adding SELECT {}".format(obj))
-        self.SELECT[obj] += 1
-        logging.debug(self.SELECT)
+        return self.replace(SELECT=self.SELECT + (obj,))
 
     def removeSELECT(self, obj):
-        logging.debug("Removing SELECT {}".format(obj))
         if obj not in self.SELECT:
-            return
-
-        self.SELECT[obj] -= 1
-        if self.SELECT[obj] == 0:
-            del self.SELECT[obj]
-        logging.debug(self.SELECT)
+            return self
+        # remove the last occurrence so that the column keeps its position
+        i = len(self.SELECT) - 1 - self.SELECT[::-1].index(obj)
+        return self.replace(SELECT=self.SELECT[:i] + self.SELECT[i + 1:])
 
     def mergeSELECT(self, query):
-        self.SELECT = self.SELECT + query.SELECT
+        return self.replace(SELECT=self.SELECT + query.SELECT)
 
     def addWHERE(self, where, boolean=None):
         if where is None:
-            return
+            return self
 
         if self.WHERE is None:
-            self.WHERE = where
-        else:
-            # if boolean is None:
-            #     raise RuntimeError("Must provide boolean instruction to WHERE")
-            if boolean != "OR" and boolean != "AND":
-                raise RuntimeError("Boolean instruction must OR or AND")
-            self.WHERE = "({} {} {})".format(self.WHERE, boolean, where)
-
-        # self.WHERE.append(where)
+            return self.replace(WHERE=where)
+        # if boolean is None:
+        #     raise RuntimeError("Must provide boolean instruction to WHERE")
+        if boolean != "OR" and boolean != "AND":
+            raise RuntimeError("Boolean instruction must OR or AND")
+        return self.replace(
+            WHERE=BoolOp(boolean, [as_expr(self.WHERE), as_expr(where)]))
 
     def mergeWHERE(self, query, how):
-        self.addWHERE(query.WHERE, how)
-        # self.WHERE.extend(query.WHERE)
+        return self.addWHERE(query.WHERE, how)
 
     def addGROUPBY(self, value):
-        self.GROUPBY.append(str(value))
+        return self.replace(GROUPBY=self.GROUPBY + (str(value),))
 
     def mergeGROUPBY(self, query):
-        self.GROUPBY.extend(query.GROUPBY)
+        return self.replace(GROUPBY=self.GROUPBY + query.GROUPBY)
 
     def setOFFSET(self, value):
         # Basically the start of slicing. This can normally be a negative
@@ -79,10 +112,9 @@ class Query(object):
             raise RuntimeError("Can only slice with integer")
         if value < 0:
             raise RuntimeError("Slicing with negative index is not allowed")
-        if self.OFFSET is None:
-            self.OFFSET = value
-        if self.OFFSET < value:
-            self.OFFSET = value
+        if self.OFFSET is None or self.OFFSET < value:
+            return self.replace(OFFSET=value)
+        return self
 
     def setLIMIT(self, value):
         # Basically the stop of slicing. This can normally be a negative
@@ -92,101 +124,116 @@ class Query(object):
             raise RuntimeError("Can only slice with integer")
         if value < 0:
             raise RuntimeError("Slicing with negative index is not allowed")
-        if self.LIMIT is None:
-            self.LIMIT = value
-        if self.LIMIT > value:
-            self.LIMIT = value
+        if self.LIMIT is None or self.LIMIT > value:
+            return self.replace(LIMIT=value)
+        return self
 
     def addORDERBY(self, value):
-        self.ORDERBY.append(value)
+        return self.replace(ORDERBY=self.ORDERBY + (value,))
 
     def mergeORDERBY(self, query):
-        self.ORDERBY.extend(query.ORDERBY)
+        return self.replace(ORDERBY=self.ORDERBY + query.ORDERBY)
 
     def mergeQuery(self, query, how=None):
-        self.mergeSELECT(query)
-        self.mergeWHERE(query, how)
-        self.mergeGROUPBY(query)
-        self.mergeORDERBY(query)
-
         if self.OFFSET is not None and query.OFFSET is not None:
             raise RuntimeError("Multiple slicing asked")
 
-        if self.OFFSET is None:
-            self.OFFSET = query.OFFSET
-
         if self.LIMIT is not None and query.LIMIT is not None:
             raise RuntimeError("Multiple slicing asked")
 
-        if self.LIMIT is None:
-            self.LIMIT = query.LIMIT
+        merged = self.mergeWHERE(query, how)
+        return merged.replace(
+            SELECT=self.SELECT + query.SELECT,
+            GROUPBY=self.GROUPBY + query.GROUPBY,
+            ORDERBY=self.ORDERBY + query.ORDERBY,
+            OFFSET=self.OFFSET if self.OFFSET is not None else query.OFFSET,
+            LIMIT=self.LIMIT if self.LIMIT is not None else query.LIMIT)
 
     def buildQuery(self):
-        data = {}
-        # print("Building query")
-        # print(self.SELECT, len(self.SELECT))
-        if len(self.SELECT) == 0:
-            # print("Replacing SELECT with *")
-            data["select"] = '*'
-        else:
-            data["select"] = ",".join(self.SELECT.keys())
-
-        if self.WHERE is not None:
-            # data["where"] = " ".join(self.WHERE)
-            data["where"] = self.WHERE
-        if len(self.GROUPBY) > 0:
-            data["groupBy"] = ",".join(self.GROUPBY)
-        if self.OFFSET is not None:
-            data["offset"] = self.OFFSET
-        if self.LIMIT is not None:
-            data["limit"] = self.LIMIT
-        if len(self.ORDERBY) > 0:
-            data["orderBy"] = ",".join(self.ORDERBY)
-
-        return data
-
-    def executeQuery(self, format):
-
+        """Returns the query string parameters, a new dict on every call."""
+        built = self._built
+        if built is None:
+            built = {}
+            compiler = Compiler()
+            if len(self.SELECT) == 0:
+                built["select"] = '*'
+            else:
+                built["select"] = ",".join(
+                    unique(compiler.sql(s) for s in self.SELECT))
+
+            if self.WHERE is not None:
+                where = compiler.sql(self.WHERE)
+                if where != 'TRUE':
+                    built["where"] = where
+            if len(self.GROUPBY) > 0:
+                built["groupBy"] = ",".join(self.GROUPBY)
+            if self.HAVING is not None:
+                built["having"] = compiler.sql(self.HAVING)
+            if self.OFFSET is not None:
+                built["offset"] = self.OFFSET
+            if self.LIMIT is not None:
+                built["limit"] = self.LIMIT
+            if len(self.ORDERBY) > 0:
+                built["orderBy"] = ",".join(self.ORDERBY)
+            self.__dict__['_built'] = built
+        return dict(built)
+
+    def executeQuery(self, format, strict=False):
+        """
+        Runs the query and returns its decoded result. Large key sets
+        (IN (...) with many values) are split, see pymldb.lookup.execute.
+        With strict, an error response raises a ResourceError instead of
+        returning the decoded error.
+        """
+        return lookup.execute(self, format, strict)
+
+    def _execute(self, format, strict=False):
         query = self.buildQuery()
         query["format"] = format
-        logging.debug("REST params\n{}".format(json.dumps(query)))
+        logger.debug("REST params\n{}".format(json.dumps(query)))
 
         select_url = self.dataset_url + "/query"
 
+        def fetch():
+            try:
+                # logger.info(select_url)
+                response = self.conn.transport.get(select_url, params=query)
+                logger.info("URL poked {}".format(response.url))
+            except requests.HTTPError as e:
+                logger.error("Code: {}\nReason: {}".format(
+                    e.status_code, e.reason))
+                logger.error("Content: {}".format(response.content))
+                logger.error(traceback.format_exc())
+
+            if response.status_code != 200:
+                if strict:
+                    from pymldb import ResourceError
+                    raise ResourceError(response)
+                logger.error("Code: {}\nReason: {}".format(
+                    response.status_code, response.reason))
+                logger.error("Content: {}".format(response.content))
+                logger.error(traceback.format_exc())
+            return response
+
+        dataset = dataset_from_url(self.dataset_url)
+        content = self.conn._cached_content(
+            select_url, query, fetch,
+            datasets=[dataset] if dataset is not None else [])
         try:
-            # logging.info(select_url)
-            response = requests.get(select_url, params=query)
-            logging.info("URL poked {}".format(response.url))
-        except requests.HTTPError as e:
-            logging.error("Code: {}\nReason: {}".format(
-                e.status_code, e.reason))
-            logging.error("Content: {}".format(response.content))
-            logging.error(traceback.format_exc())
-
-        if response.status_code != 200:
-            logging.error("Code: {}\nReason: {}".format(
-                response.status_code, response.reason))
-            logging.error("Content: {}".format(response.content))
-            logging.error(traceback.format_exc())
-
-        try:
-            return response.json()
+            with self.conn.metrics.time('GET', select_url, 'decode'):
+                return loads(content)
         except:
             return {}
 
     def __or__(self, value):
         if isinstance(value, Query):
-            query = self.copy()
-            # self.addWHERE('OR')
-            query.mergeQuery(value, "OR")
-        return query
+            return self.mergeQuery(value, "OR")
+        return NotImplemented
 
     def __and__(self, value):
         if isinstance(value, Query):
-            query = self.copy()
-            # self.addWHERE('AND')
-            query.mergeQuery(value, "AND")
-        return query
+            return self.mergeQuery(value, "AND")
+        return NotImplemented
 
     def __rand__(self, value):
         raise NotImplementedError()
@@ -195,14 +242,8 @@ class Query(object):
         raise NotImplementedError()
 
     def copy(self):
-        query = Query(self.dataset_url)
-        query.SELECT = copy.deepcopy(self.SELECT)
-        query.WHERE = copy.deepcopy(self.WHERE)
-        query.ORDERBY = copy.deepcopy(self.ORDERBY)
-        query.GROUPBY = copy.deepcopy(self.GROUPBY)
-        query.OFFSET = copy.deepcopy(self.OFFSET)
-        query.LIMIT = copy.deepcopy(self.LIMIT)
-        return query
+        # immutable, nothing to copy
+        return self
 
     def __repr__(self):
         return json.dumps(self.buildQuery(), indent=4)
@@ -0,0 +1,317 @@
+#
+# shards.py
+# Copyright (c) 2016 Datacratic. All rights reserved.
+#
+# Fan-out of a query over datasets sharing a schema (e.g. one per day): the
+# query is run on every shard concurrently and the results are merged on
+# the client. Plain SELECTs are concatenated, ORDER BY results are merged
+# in order (with LIMIT pushed down to each shard) and decomposable
+# aggregates (count, sum, min, max, avg) are combined from partial results.
+#
+from __future__ import absolute_import, division, print_function
+
+import heapq
+import json
+import numbers
+import re
+from collections import OrderedDict
+
+from pymldb.expr import string_types
+from pymldb.sql import (AGGREGATE, has_aggregate, join_clauses, split_alias,
+                        split_clauses, split_list)
+
+PLACEHOLDER = '{dataset}'
+
+_DECOMPOSABLE = ('count', 'sum', 'min', 'max', 'avg')
+_CALL = re.compile(r'^(\w+)\s*\(')
+_DIRECTION = re.compile(r'\s+(ASC|DESC)\s*$', re.IGNORECASE)
+
+
+def _call(expr):
+    """(function name, arguments) when expr is a single call, else None."""
+    match = _CALL.match(expr)
+    if match is None:
+        return None
+    depth = 0
+    quote = None
+    for i in range(match.end() - 1, len(expr)):
+        c = expr[i]
+        if quote is not None:
+            if c == quote:
+                quote = None  # a doubled quote reopens right away
+        elif c in '\'"':
+            quote = c
+        elif c in '([{':
+            depth += 1
+        elif c in ')]}':
+            depth -= 1
+            if depth == 0:
+                if expr[i + 1:].strip():
+                    return None
+                return match.group(1), expr[match.end():i]
+    return None
+
+
+def _add(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return a + b
+
+
+def _least(a, b):
+    if a is None or (b is not None and _rank(b) < _rank(a)):
+        return b
+    return a
+
+
+def _greatest(a, b):
+    if a is None or (b is not None and _rank(a) < _rank(b)):
+        return b
+    return a
+
+
+# aggregate -> how its partial results are combined
+_COMBINE = {'count': _add, 'sum': _add, 'min': _least, 'max': _greatest,
+            'avg': _add}
+
+
+def _rank(value):
+    """Sort key of a value: nulls, then numbers, then strings, then others."""
+    if value is None:
+        return (0, 0)
+    if isinstance(value, numbers.Number):
+        return (1, value)
+    if isinstance(value, string_types):
+        return (2, value)
+    return (3, json.dumps(value, sort_keys=True))
+
+
+class _SortKey(object):
+    """Orders rows by several columns, each ascending or descending."""
+    __slots__ = ('values', 'ascending')
+
+    def __init__(self, values, ascending):
+        self.values = [_rank(v) for v in values]
+        self.ascending = ascending
+
+    def __lt__(self, other):
+        for a, b, ascending in zip(self.values, other.values,
+                                   self.ascending):
+            if a != b:
+                return (a < b) == ascending
+        return False
+
+    def __eq__(self, other):
+        return self.values == other.values
+
+
+def _rows(soa):
+    names = list(soa)
+    num_rows = len(soa.get('_rowName', ()))
+    return [dict((c, soa[c][i]) for c in names) for i in range(num_rows)]
+
+
+def _columns(results, hidden):
+    columns = []
+    seen = set(hidden)
+    for result in results:
+        for c in result:
+            if c not in seen:
+                seen.add(c)
+                columns.append(c)
+    return columns
+
+
+def _to_soa(rows, columns):
+    return OrderedDict((c, [row.get(c) for row in rows]) for c in columns)
+
+
+class ShardPlan(object):
+    """
+    How sql_template, a SELECT whose FROM clause contains the {dataset}
+    placeholder, is run on each shard (template) and how the 'soa' results
+    are merged (merge):
+      - 'aggregate' when it has a GROUP BY clause or aggregates: the
+        aggregates are combined group by group (rows of the same name).
+        count, sum, min and max are combined as is, avg is computed from a
+        sum and a count. Other aggregates, HAVING, ORDER BY, LIMIT and
+        OFFSET are rejected since they can't be computed from partial
+        results.
+      - 'sort' when it has an ORDER BY clause: the ordered shard results
+        are merged. The sort keys are added to the SELECT when they aren't
+        aliases of selected columns, LIMIT + OFFSET is pushed down to each
+        shard and OFFSET and LIMIT are applied to the merged rows.
+      - 'concat' otherwise: the results are concatenated in the order of
+        the shards (a LIMIT is pushed down as for 'sort').
+    """
+
+    def __init__(self, sql_template):
+        if PLACEHOLDER not in sql_template:
+            raise ValueError("The query must contain the {} placeholder"
+                             .format(PLACEHOLDER))
+        clauses = split_clauses(sql_template.strip().rstrip(';'))
+        bodies = dict((clause, body) for clause, body in clauses)
+        items = [split_alias(i) for i in split_list(bodies.get('SELECT', ''))]
+        self.limit = None
+        self.offset = 0
+        self.order = []  # (column, ascending)
+        self.hidden = []  # columns only needed to merge
+        self.aggregates = []  # (column, aggregate, part columns)
+        if 'GROUP BY' in bodies or has_aggregate(bodies.get('SELECT', '')):
+            self.mode = 'aggregate'
+            select = self._plan_aggregates(bodies, items)
+        else:
+            self.mode = 'sort' if 'ORDER BY' in bodies else 'concat'
+            select = self._plan_select(bodies, items)
+
+        shard_clauses = []
+        for clause, body in clauses:
+            if clause == 'SELECT':
+                body = select
+            elif clause == 'LIMIT':
+                body = str(self.limit + self.offset)
+            elif clause == 'OFFSET':
+                continue
+            shard_clauses.append([clause, body])
+        self.template = join_clauses(shard_clauses)
+
+    def _plan_aggregates(self, bodies, items):
+        for clause in ('HAVING', 'ORDER BY', 'LIMIT', 'OFFSET'):
+            if clause in bodies:
+                raise ValueError("{} can't be applied to aggregates "
+                                 "combined across shards".format(clause))
+        select = []
+        for i, (expr, alias) in enumerate(items):
+            call = _call(expr)
+            name = call[0].lower() if call else None
+            if name is not None and name.startswith('vertical_'):
+                name = name[len('vertical_'):]
+            if name in _DECOMPOSABLE:
+                if name == 'avg':
+                    parts = ['sum({})'.format(call[1]),
+                             'count({})'.format(call[1])]
+                else:
+                    parts = [expr]
+                columns = ['_shard{}_{}'.format(i, j)
+                           for j in range(len(parts))]
+                select.extend('{} AS "{}"'.format(p, c)
+                              for p, c in zip(parts, columns))
+                self.hidden.extend(columns)
+                self.aggregates.append((alias or expr, name, columns))
+            elif AGGREGATE.search(expr):
+                raise ValueError("{} can't be combined across shards, only "
+                                 "{} can".format(expr,
+                                                 ', '.join(_DECOMPOSABLE)))
+            else:
+                # a GROUP BY key, the same on every shard
+                select.append(expr if alias is None else
+                              '{} AS "{}"'.format(expr,
+                                                  alias.replace('"', '""')))
+        return ', '.join(select)
+
+    def _plan_select(self, bodies, items):
+        if 'LIMIT' in bodies:
+            self.limit = int(bodies['LIMIT'])
+        if 'OFFSET' in bodies:
+            self.offset = int(bodies['OFFSET'])
+        select = [bodies.get('SELECT', '')]
+        aliases = set(alias for _, alias in items if alias is not None)
+        for i, item in enumerate(split_list(bodies.get('ORDER BY', ''))):
+            ascending = True
+            match = _DIRECTION.search(item)
+            if match:
+                ascending = match.group(1).upper() == 'ASC'
+                item = item[:match.start()]
+            column = item.strip()
+            if len(column) > 1 and column[0] == column[-1] == '"':
+                column = column[1:-1].replace('""', '"')
+            if column not in aliases:
+                column = '_shard_order{}'.format(i)
+                select.append('{} AS "{}"'.format(item.strip(), column))
+                self.hidden.append(column)
+            self.order.append((column, ascending))
+        return ', '.join(select)
+
+    def shard_sql(self, dataset):
+        return self.template.replace(PLACEHOLDER, dataset)
+
+    def merge(self, results):
+        """Merges the 'soa' results of the shards into a single one."""
+        results = [r for r in results if r]
+        if self.mode == 'aggregate':
+            return self._merge_aggregates(results)
+        columns = _columns(results, self.hidden)
+        if self.mode == 'sort':
+            ascending = [a for _, a in self.order]
+
+            def keyed(index, rows):
+                for i, row in enumerate(rows):
+                    key = _SortKey([row.get(c) for c, _ in self.order],
+                                   ascending)
+                    yield key, index, i, row
+            rows = [row for _, _, _, row in heapq.merge(
+                *[keyed(i, _rows(r)) for i, r in enumerate(results)])]
+        else:
+            rows = [row for r in results for row in _rows(r)]
+        end = None if self.limit is None else self.offset + self.limit
+        return _to_soa(rows[self.offset:end], columns)
+
+    def _merge_aggregates(self, results):
+        part_columns = set(self.hidden)
+        groups = OrderedDict()
+        for result in results:
+            for row in _rows(result):
+                group = groups.get(row['_rowName'])
+                if group is None:
+                    groups[row['_rowName']] = dict(row)
+                    continue
+                for column, value in row.items():
+                    if column not in part_columns:
+                        group.setdefault(column, value)
+                for _, aggregate, columns in self.aggregates:
+                    combine = _COMBINE[aggregate]
+                    for c in columns:
+                        group[c] = combine(group.get(c), row.get(c))
+
+        for group in groups.values():
+            for name, aggregate, columns in self.aggregates:
+                if aggregate == 'avg':
+                    total, count = group.get(columns[0]), group.get(columns[1])
+                    group[name] = total / count if count else None
+                else:
+                    group[name] = group.get(columns[0])
+
+        columns = _columns(results, [])
+        names = dict((parts[0], name) for name, _, parts in self.aggregates)
+        output = []
+        for c in columns:
+            if c in names:
+                output.append(names[c])
+            elif c not in part_columns:
+                output.append(c)
+        return _to_soa(list(groups.values()), output)
+
+
+def query_shards(conn, sql_template, datasets, parallel=None):
+    """
+    Runs the ShardPlan of sql_template on every dataset of datasets with
+    conn, `parallel` (default: all) shards at a time, and returns the merged
+    'soa' result.
+    """
+    plan = ShardPlan(sql_template)
+    sqls = [plan.shard_sql(dataset) for dataset in datasets]
+    parallel = min(parallel or len(sqls), len(sqls))
+    if parallel <= 1:
+        results = [conn.query(sql, format='soa') for sql in sqls]
+    else:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(parallel)
+        try:
+            results = pool.map(lambda sql: conn.query(sql, format='soa'),
+                               sqls)
+        finally:
+            pool.close()
+            pool.join()
+    return plan.merge(results)
@@ -0,0 +1,208 @@
+#
+# sql.py
+# Copyright (c) 2016 Datacratic. All rights reserved.
+#
+# Small helpers to rewrite SQL strings sent to /v1/query.
+#
+from __future__ import absolute_import, division, print_function
+
+import re
+
+_TRAILING_LIMIT = re.compile(r'\s+LIMIT\s+(\d+)\s*$', re.IGNORECASE)
+_TRAILING_OFFSET = re.compile(r'\s+OFFSET\s+(\d+)\s*$', re.IGNORECASE)
+
+
+def split_limit_offset(sql):
+    """
+    Removes the trailing LIMIT and OFFSET clauses of sql.
+
+    Returns (sql, limit, offset) where limit is None when there was no LIMIT
+    clause and offset is 0 when there was no OFFSET clause.
+    """
+    sql = sql.strip().rstrip(';').rstrip()
+    limit = None
+    offset = 0
+    # either order is accepted
+    for _ in range(2):
+        match = _TRAILING_OFFSET.search(sql)
+        if match:
+            offset = int(match.group(1))
+            sql = sql[:match.start()]
+            continue
+        match = _TRAILING_LIMIT.search(sql)
+        if match:
+            limit = int(match.group(1))
+            sql = sql[:match.start()]
+    return sql, limit, offset
+
+
+# clause keywords of an MLDB select statement, in order
+CLAUSES = ('SELECT', 'NAMED', 'FROM', 'WHEN', 'WHERE', 'GROUP BY', 'HAVING',
+           'ORDER BY', 'LIMIT', 'OFFSET')
+_CLAUSE_WORDS = set(c.split()[0] for c in CLAUSES)
+_OPENING = '([{'
+_CLOSING = ')]}'
+
+
+def _top_level_words(sql):
+    """
+    Yields (WORD, start, end) for every bare word of sql that is not nested
+    in parentheses/brackets/braces, in a CASE ... END expression or in a
+    string or quoted identifier.
+    """
+    depth = 0
+    i = 0
+    n = len(sql)
+    while i < n:
+        c = sql[i]
+        if c in '\'"':
+            # strings and quoted identifiers, a doubled quote escapes it
+            i += 1
+            while i < n:
+                if sql[i] == c:
+                    if i + 1 < n and sql[i + 1] == c:
+                        i += 2
+                        continue
+                    break
+                i += 1
+            i += 1
+        elif c in _OPENING:
+            depth += 1
+            i += 1
+        elif c in _CLOSING:
+            depth -= 1
+            i += 1
+        elif c.isalpha() or c == '_':
+            start = i
+            while i < n and (sql[i].isalnum() or sql[i] == '_'):
+                i += 1
+            word = sql[start:i].upper()
+            if word == 'CASE':
+                depth += 1
+            elif word == 'END' and depth > 0:
+                depth -= 1
+            elif depth == 0:
+                yield word, start, i
+        else:
+            i += 1
+
+
+def split_list(body):
+    """
+    Splits body (e.g. of a SELECT or ORDER BY clause) on its top-level
+    commas, e.g. 'x, f(y, z) AS w' gives ['x', 'f(y, z) AS w'].
+    """
+    items = []
+    depth = 0
+    start = 0
+    i = 0
+    n = len(body)
+    while i < n:
+        c = body[i]
+        if c in '\'"':
+            i += 1
+            while i < n:
+                if body[i] == c:
+                    if i + 1 < n and body[i + 1] == c:
+                        i += 2
+                        continue
+                    break
+                i += 1
+        elif c in _OPENING:
+            depth += 1
+        elif c in _CLOSING:
+            depth -= 1
+        elif c == ',' and depth == 0:
+            items.append(body[start:i].strip())
+            start = i + 1
+        i += 1
+    items.append(body[start:].strip())
+    return [item for item in items if item]
+
+
+def split_alias(item):
+    """
+    Splits a SELECT item into (expression, alias or None), the alias being
+    unquoted, e.g. 'sum(x) AS "total"' gives ('sum(x)', 'total').
+    """
+    words = [w for w in _top_level_words(item) if w[0] == 'AS']
+    if not words:
+        return item.strip(), None
+    _, start, end = words[-1]
+    alias = item[end:].strip()
+    if len(alias) > 1 and alias[0] == alias[-1] == '"':
+        alias = alias[1:-1].replace('""', '"')
+    return item[:start].strip(), alias
+
+
+# calls of MLDB aggregate functions
+AGGREGATE = re.compile(
+    r'\b(?:vertical_)?(?:count|sum|min|max|avg|count_distinct|'
+    r'weighted_avg|latest|earliest|pivot|string_agg|stddev|variance)\s*\(',
+    re.IGNORECASE)
+
+
+def has_aggregate(body):
+    """Whether an expression of body (of a SELECT clause) is an aggregate."""
+    return any(AGGREGATE.search(split_alias(item)[0])
+               for item in split_list(body))
+
+
+def split_clauses(sql):
+    """
+    Splits a select statement on its top-level clause keywords.
+
+    Returns a list of [clause, body] pairs, e.g. 'SELECT x FROM ds WHERE y'
+    gives [['SELECT', 'x'], ['FROM', 'ds'], ['WHERE', 'y']]. Anything before
+    the first keyword is kept under the None clause.
+    """
+    words = list(_top_level_words(sql))
+    starts = []  # (clause, keyword start, body start)
+    for idx, (word, start, end) in enumerate(words):
+        if word not in _CLAUSE_WORDS:
+            continue
+        if word in ('GROUP', 'ORDER'):
+            if idx + 1 >= len(words) or words[idx + 1][0] != 'BY':
+                continue
+            starts.append((word + ' BY', start, words[idx + 1][2]))
+        else:
+            starts.append((word, start, end))
+
+    clauses = []
+    if not starts or sql[:starts[0][1]].strip():
+        clauses.append([None, sql[:starts[0][1] if starts else len(sql)]
+                        .strip()])
+    for idx, (clause, _, body_start) in enumerate(starts):
+        body_end = starts[idx + 1][1] if idx + 1 < len(starts) else len(sql)
+        clauses.append([clause, sql[body_start:body_end].strip()])
+    return clauses
+
+
+def join_clauses(clauses):
+    """Inverse of split_clauses."""
+    parts = []
+    for clause, body in clauses:
+        if clause is None:
+            parts.append(body)
+        else:
+            parts.append('{} {}'.format(clause, body))
+    return ' '.join(parts)
+
+
+def add_where(sql, predicate):
+    """Returns sql with predicate ANDed to its top-level WHERE clause."""
+    clauses = split_clauses(sql.strip().rstrip(';'))
+    for clause in clauses:
+        if clause[0] == 'WHERE':
+            clause[1] = '({}) AND ({})'.format(predicate, clause[1])
+            return join_clauses(clauses)
+
+    # no WHERE, insert one right after FROM/WHEN
+    after = CLAUSES.index('WHERE')
+    position = len(clauses)
+    for idx, (clause, _) in enumerate(clauses):
+        if clause is not None and CLAUSES.index(clause) > after:
+            position = idx
+            break
+    clauses.insert(position, ['WHERE', predicate])
+    return join_clauses(clauses)
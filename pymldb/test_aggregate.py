@@ -0,0 +1,45 @@
+#
+# test_aggregate.py
+# Copyright (c) 2016 Datacratic. All rights reserved.
+#
+# Unit tests of the decomposition of aggregates into MLDB aggregators.
+# usage: python -m unittest discover -s pymldb -p 'test_*.py'
+#
+from __future__ import absolute_import, division, print_function
+
+import math
+import unittest
+
+from pymldb.aggregate import combine, numeric, parts
+from pymldb.expr import Col, to_sql
+
+
+class TestAggregate(unittest.TestCase):
+
+    def test_parts(self):
+        x = Col('x')
+        self.assertEqual([to_sql(p) for p in parts('count', x)],
+                         ['count("x")'])
+        self.assertEqual([to_sql(p) for p in parts('std', x)],
+                         ['stddev(CASE WHEN "x" IS NUMBER THEN "x" END)'])
+        self.assertEqual([to_sql(p) for p in parts('mean', x)],
+                         ['avg(CASE WHEN "x" IS NUMBER THEN "x" END)'])
+        self.assertEqual(parts(None, x), [x])
+        self.assertRaises(ValueError, parts, 'median', x)
+
+    def test_numeric_is_idempotent(self):
+        once = numeric(Col('x'))
+        self.assertIs(numeric(once), once)
+
+    def test_combine(self):
+        self.assertEqual(combine('sum', [5]), 5)
+        self.assertEqual(combine('count', [0]), 0)
+        self.assertIsNone(combine('min', [None]))
+        # no numbers, or a single one: NaN like pandas
+        self.assertTrue(math.isnan(combine('std', [None])))
+        self.assertTrue(math.isnan(combine('var', [None])))
+        self.assertEqual(combine('var', [2.5]), 2.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+#
+# test_expr.py
+# Copyright (c) 2016 Datacratic. All rights reserved.
+#
+# Unit tests of the expression trees: simplification and SQL emission.
+# usage: python -m unittest discover -s pymldb -p 'test_*.py'
+#
+from __future__ import absolute_import, division, print_function
+
+import unittest
+
+from pymldb.expr import (BinOp, BoolOp, Col, Const, In, IsNull, Unary,
+                         compile_sql, to_sql)
+
+a, b, c = Col('a'), Col('b'), Col('c')
+
+
+class TestEmission(unittest.TestCase):
+
+    def test_non_associative_right_operands_keep_parentheses(self):
+        self.assertEqual(to_sql(BinOp('*', a, BinOp('%', b, c))),
+                         '"a"*("b"%"c")')
+        self.assertEqual(to_sql(BinOp('*', a, BinOp('/', b, c))),
+                         '"a"*("b"/"c")')
+        self.assertEqual(to_sql(BinOp('+', a, BinOp('-', b, c))),
+                         '"a"+("b"-"c")')
+        self.assertEqual(to_sql(BinOp('-', a, BinOp('-', b, c))),
+                         '"a"-("b"-"c")')
+
+    def test_associative_and_left_operands_go_without_parentheses(self):
+        self.assertEqual(to_sql(BinOp('+', a, BinOp('+', b, c))),
+                         '"a"+"b"+"c"')
+        self.assertEqual(to_sql(BinOp('*', a, BinOp('*', b, c))),
+                         '"a"*"b"*"c"')
+        self.assertEqual(to_sql(BinOp('-', BinOp('-', a, b), c)),
+                         '"a"-"b"-"c"')
+        self.assertEqual(to_sql(BinOp('*', BinOp('+', a, b), c)),
+                         '("a"+"b")*"c"')
+
+    def test_negative_operands_never_make_a_comment(self):
+        self.assertEqual(to_sql(BinOp('-', a, Const(-1))), '"a"-(-1)')
+        self.assertEqual(to_sql(Unary('-', Unary('-', a))), '-(-"a")')
+
+    def test_quoting(self):
+        self.assertEqual(to_sql(BinOp('=', Const("it's"), Col('x"y'))),
+                         '\'it\'\'s\'="x""y"')
+        self.assertEqual(to_sql(IsNull(a)), '"a" IS NULL')
+        self.assertEqual(to_sql(Const(None)), 'NULL')
+        self.assertEqual(to_sql(Const(True)), 'TRUE')
+
+
+class TestSimplification(unittest.TestCase):
+
+    def test_constant_folding(self):
+        self.assertEqual(compile_sql(BinOp('+', Const(1), Const(2))), '3')
+        self.assertEqual(compile_sql(BinOp('/', Const(6), Const(2))), '3')
+        # integer division is left to MLDB
+        self.assertEqual(compile_sql(BinOp('/', Const(7), Const(2))), '7/2')
+        self.assertEqual(compile_sql(BinOp('/', Const(1), Const(0))), '1/0')
+        self.assertEqual(compile_sql(Unary('-', Const(-3))), '3')
+
+    def test_boolean_identities(self):
+        self.assertEqual(
+            compile_sql(BoolOp('AND', [Const(True), BinOp('>', a, Const(1))])),
+            '"a">1')
+        self.assertEqual(
+            compile_sql(BoolOp('OR', [Const(True), BinOp('>', a, Const(1))])),
+            'TRUE')
+        self.assertEqual(compile_sql(Unary('NOT', Unary('NOT', a))), '"a"')
+
+    def test_equalities_become_in(self):
+        self.assertEqual(
+            compile_sql(BoolOp('OR', [BinOp('=', a, Const(1)),
+                                      BinOp('=', a, Const(2))])),
+            '"a" IN (1,2)')
+        self.assertEqual(compile_sql(In(a, [])), 'FALSE')
+        self.assertEqual(compile_sql(In(a, [Const(1)])), '"a"=1')
+
+    def test_nodes_compare_by_structure(self):
+        self.assertEqual(BinOp('+', a, Const(1)), BinOp('+', Col('a'),
+                                                        Const(1)))
+        self.assertEqual(len(set([Col('a'), Col('a'), Col('b')])), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
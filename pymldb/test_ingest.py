@@ -0,0 +1,52 @@
+#
+# test_ingest.py
+# Copyright (c) 2016 Datacratic. All rights reserved.
+#
+# Unit tests of the typing and chunking of uploaded rows.
+# usage: python -m unittest discover -s pymldb -p 'test_*.py'
+#
+from __future__ import absolute_import, division, print_function
+
+import unittest
+
+from pymldb.ingest import _parse_value, _to_multirows, parse_csv
+
+
+class TestIngest(unittest.TestCase):
+
+    def test_plain_decimals_are_typed(self):
+        self.assertEqual(_parse_value('1'), 1)
+        self.assertEqual(_parse_value('-0'), 0)
+        self.assertEqual(_parse_value('1.5'), 1.5)
+        self.assertEqual(_parse_value('.5'), 0.5)
+        self.assertEqual(_parse_value('-2.'), -2.0)
+        self.assertEqual(_parse_value('1e3'), 1000.0)
+        self.assertIsNone(_parse_value(''))
+
+    def test_other_cells_stay_strings(self):
+        for value in ('00501', '1_000', 'nan', 'Nan', 'Infinity', 'inf',
+                      '1e999', ' 5', '+5', '0x10', 'abc'):
+            self.assertEqual(_parse_value(value), value)
+
+    def test_parse_csv(self):
+        rows = list(parse_csv(['a,b', '1,00501', ',x']))
+        self.assertEqual(rows, [{'a': 1, 'b': '00501'},
+                                {'a': None, 'b': 'x'}])
+
+    def test_multirows(self):
+        rows = [{'id': 'r1', 'x': 1, 'y': None},
+                {'id': 'r2', 'x': float('nan'), 'y': float('-inf')},
+                {'id': 'r3', 'x': 2.5}]
+        chunks = list(_to_multirows(rows, 'id', 'ts', 2))
+        self.assertEqual(len(chunks), 2)
+        self.assertEqual(chunks[0][0], ['r1', [['x', 1, 'ts']]])
+        self.assertEqual(sorted(chunks[0][1][1]),
+                         [['x', 'NaN', 'ts'], ['y', '-Infinity', 'ts']])
+        self.assertEqual(chunks[1], [['r3', [['x', 2.5, 'ts']]]])
+        numbered = list(_to_multirows([('k', {'x': 1}), {'x': 2}], None,
+                                      'ts', 10))
+        self.assertEqual([row[0] for row in numbered[0]], ['k', '2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
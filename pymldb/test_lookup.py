@@ -0,0 +1,64 @@
+#
+# test_lookup.py
+# Copyright (c) 2016 Datacratic. All rights reserved.
+#
+# Unit tests of the splitting of key sets and the ordering of their rows.
+# usage: python -m unittest discover -s pymldb -p 'test_*.py'
+#
+from __future__ import absolute_import, division, print_function
+
+import unittest
+try:
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote
+
+from pymldb.expr import BinOp, BoolOp, Col, Const, In, to_sql
+from pymldb.lookup import (concat_results, find_key_set, key_chunks,
+                           order_by_keys)
+
+
+class TestLookup(unittest.TestCase):
+
+    def test_key_chunks_fit_the_encoded_query_string(self):
+        keys = [Const(u'caf\xe9 & "{}"'.format(i)) for i in range(500)]
+        chunks = list(key_chunks(keys, 1000))
+        self.assertEqual([k for chunk in chunks for k in chunk], keys)
+        self.assertTrue(len(chunks) > 1)
+        for chunk in chunks:
+            sql = ','.join(to_sql(k) for k in chunk)
+            self.assertTrue(len(quote(sql.encode('utf-8'), safe='')) <= 1000)
+
+    def test_key_chunks_keep_oversized_keys(self):
+        keys = [Const('x' * 50), Const('y')]
+        self.assertEqual(list(key_chunks(keys, 10)), [[keys[0]], [keys[1]]])
+        self.assertEqual(list(key_chunks([], 10)), [])
+
+    def test_find_key_set(self):
+        small = In(Col('a'), [Const(1), Const(2)])
+        big = In(Col('b'), [Const(1), Const(2), Const(3)])
+        other = BinOp('>', Col('c'), Const(0))
+        key_set, others = find_key_set(BoolOp('AND', [small, big, other]))
+        self.assertEqual(key_set, big)
+        self.assertEqual(others, [small, other])
+        self.assertIsNone(find_key_set(other))
+        self.assertIsNone(find_key_set(None))
+
+    def test_order_by_keys(self):
+        soa = {'_rowName': ['b', 'z', 'a'], 'x': [2, 0, 1]}
+        self.assertEqual(order_by_keys(soa, 'soa', ['a', 'b']),
+                         {'_rowName': ['a', 'b', 'z'], 'x': [1, 2, 0]})
+        aos = [{'_rowName': 'b'}, {'_rowName': 'a'}]
+        self.assertEqual(order_by_keys(aos, 'aos', ['a', 'b']),
+                         [{'_rowName': 'a'}, {'_rowName': 'b'}])
+        self.assertEqual(order_by_keys({}, 'soa', ['a']), {})
+
+    def test_concat_results(self):
+        merged = concat_results([{'_rowName': ['a'], 'x': [1]},
+                                 {'_rowName': ['b'], 'y': [2]}], 'soa')
+        self.assertEqual(merged, {'_rowName': ['a', 'b'], 'x': [1, None],
+                                  'y': [None, 2]})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+#
+# test_shards.py
+# Copyright (c) 2016 Datacratic. All rights reserved.
+#
+# Unit tests of the planning and merging of sharded queries.
+# usage: python -m unittest discover -s pymldb -p 'test_*.py'
+#
+from __future__ import absolute_import, division, print_function
+
+import unittest
+
+from pymldb.shards import ShardPlan
+
+
+class TestShardPlan(unittest.TestCase):
+
+    def test_aggregates_are_combined_by_group(self):
+        plan = ShardPlan('SELECT avg(x) AS m, count(*) AS n FROM {dataset} '
+                         'GROUP BY g')
+        self.assertEqual(plan.mode, 'aggregate')
+        self.assertEqual(plan.shard_sql('ds1'),
+                         'SELECT sum(x) AS "_shard0_0", count(x) AS '
+                         '"_shard0_1", count(*) AS "_shard1_0" FROM ds1 '
+                         'GROUP BY g')
+        merged = plan.merge([
+            {'_rowName': ['a', 'b'], '_shard0_0': [4, 1],
+             '_shard0_1': [2, 1], '_shard1_0': [2, 1]},
+            {'_rowName': ['a'], '_shard0_0': [2], '_shard0_1': [1],
+             '_shard1_0': [1]},
+            {}])
+        self.assertEqual(dict(merged), {'_rowName': ['a', 'b'],
+                                        'm': [2.0, 1.0], 'n': [3, 1]})
+
+    def test_sorted_results_are_merged_then_sliced(self):
+        plan = ShardPlan('SELECT x FROM {dataset} ORDER BY x DESC '
+                         'LIMIT 2 OFFSET 1')
+        self.assertEqual(plan.mode, 'sort')
+        # LIMIT + OFFSET rows of each shard
+        self.assertEqual(plan.template, 'SELECT x, x AS "_shard_order0" '
+                         'FROM {dataset} ORDER BY x DESC LIMIT 3')
+        merged = plan.merge([
+            {'_rowName': ['a', 'b'], 'x': [9, 3], '_shard_order0': [9, 3]},
+            {'_rowName': ['c', 'd'], 'x': [5, 1], '_shard_order0': [5, 1]}])
+        self.assertEqual(dict(merged), {'_rowName': ['c', 'b'],
+                                        'x': [5, 3]})
+
+    def test_concat(self):
+        plan = ShardPlan('SELECT x FROM {dataset} LIMIT 3')
+        self.assertEqual(plan.mode, 'concat')
+        merged = plan.merge([{'_rowName': ['a', 'b'], 'x': [9, 3]},
+                             {'_rowName': ['c', 'd'], 'x': [5, 1]}])
+        self.assertEqual(dict(merged), {'_rowName': ['a', 'b', 'c'],
+                                        'x': [9, 3, 5]})
+
+    def test_rejected_queries(self):
+        for sql in ('SELECT x FROM ds',
+                    'SELECT stddev(x) FROM {dataset}',
+                    'SELECT sum(x) FROM {dataset} ORDER BY x',
+                    'SELECT g, count(*) FROM {dataset} GROUP BY g LIMIT 2'):
+            self.assertRaises(ValueError, ShardPlan, sql)
+
+
+if __name__ == '__main__':
+    unittest.main()
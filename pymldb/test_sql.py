@@ -0,0 +1,64 @@
+#
+# test_sql.py
+# Copyright (c) 2016 Datacratic. All rights reserved.
+#
+# Unit tests of the SQL string helpers.
+# usage: python -m unittest discover -s pymldb -p 'test_*.py'
+#
+from __future__ import absolute_import, division, print_function
+
+import unittest
+
+from pymldb.sql import (add_where, has_aggregate, join_clauses, split_alias,
+                        split_clauses, split_limit_offset, split_list)
+
+
+class TestSql(unittest.TestCase):
+
+    def test_split_clauses_ignores_nested_and_quoted_keywords(self):
+        sql = ("SELECT x, f(a FROM b) FROM ds WHERE y = 'GROUP BY' "
+               "GROUP BY z ORDER BY x LIMIT 5")
+        clauses = split_clauses(sql)
+        self.assertEqual(clauses, [
+            ['SELECT', 'x, f(a FROM b)'], ['FROM', 'ds'],
+            ['WHERE', "y = 'GROUP BY'"], ['GROUP BY', 'z'],
+            ['ORDER BY', 'x'], ['LIMIT', '5']])
+        self.assertEqual(join_clauses(clauses), sql)
+
+    def test_split_clauses_case_expression(self):
+        clauses = split_clauses(
+            'SELECT CASE WHEN x THEN 1 ELSE 2 END FROM ds WHERE y')
+        self.assertEqual([c for c, _ in clauses], ['SELECT', 'FROM', 'WHERE'])
+
+    def test_add_where(self):
+        self.assertEqual(add_where('SELECT x FROM ds', 'y > 1'),
+                         'SELECT x FROM ds WHERE y > 1')
+        self.assertEqual(
+            add_where('SELECT x FROM ds WHERE a OR b ORDER BY x', 'y > 1'),
+            'SELECT x FROM ds WHERE (y > 1) AND (a OR b) ORDER BY x')
+        self.assertEqual(add_where('SELECT x FROM ds LIMIT 3;', 'y'),
+                         'SELECT x FROM ds WHERE y LIMIT 3')
+
+    def test_split_limit_offset(self):
+        self.assertEqual(split_limit_offset('SELECT x FROM ds OFFSET 4 '
+                                            'LIMIT 2;'),
+                         ('SELECT x FROM ds', 2, 4))
+        self.assertEqual(split_limit_offset('SELECT x FROM ds'),
+                         ('SELECT x FROM ds', None, 0))
+
+    def test_split_list_and_alias(self):
+        self.assertEqual(split_list("x, f(y, z) AS w, 'a,b'"),
+                         ['x', 'f(y, z) AS w', "'a,b'"])
+        self.assertEqual(split_alias('sum(x) AS "to""tal"'),
+                         ('sum(x)', 'to"tal'))
+        self.assertEqual(split_alias('x'), ('x', None))
+
+    def test_has_aggregate(self):
+        self.assertTrue(has_aggregate('x, Count(*) AS n'))
+        self.assertTrue(has_aggregate('vertical_sum(x)'))
+        self.assertFalse(has_aggregate('x AS "sum(x)", y'))
+        self.assertFalse(has_aggregate('summary(x)'))
+
+
+if __name__ == '__main__':
+    unittest.main()
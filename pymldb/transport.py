@@ -0,0 +1,265 @@
+#
+# transport.py
+# Copyright (c) 2016 Datacratic. All rights reserved.
+#
+# Pooled, keep-alive HTTP transport shared by Connection, BatFrame, Column,
+# Query, ProgressMonitor and the magics.
+#
+from __future__ import absolute_import, division, print_function
+
+import threading
+import weakref
+try:
+    from urllib.parse import quote, unquote
+except ImportError:
+    from urllib import quote, unquote
+from .metrics import Metrics, clock
+from .coalesce import SingleFlight, request_key
+
+# seconds spent opening connections by the current thread's request
+_timing = threading.local()
+_timed_pool_classes = None
+
+# scheme of the URLs of HTTP over a Unix domain socket, whose host is the
+# quoted path of the socket
+UNIX_SCHEME = 'http+unix'
+
+
+def unix_socket_uri(path):
+    """Base URI of the MLDB listening on the Unix domain socket at path."""
+    return '{}://{}'.format(UNIX_SCHEME, quote(path, safe=''))
+
+
+def _get_timed_pool_classes():
+    """
+    urllib3 connection pools whose connections record how long connect()
+    takes, so that connection setup can be told apart from server time.
+    The http+unix pool sends HTTP over a Unix domain socket.
+    """
+    global _timed_pool_classes
+    if _timed_pool_classes is None:
+        from requests.packages.urllib3.connectionpool import (
+            HTTPConnectionPool, HTTPSConnectionPool)
+        from requests.packages.urllib3.poolmanager import SSL_KEYWORDS
+        import socket
+
+        def timed(connection_cls):
+            class TimedConnection(connection_cls):
+                def connect(self):
+                    start = clock()
+                    try:
+                        return super(TimedConnection, self).connect()
+                    finally:
+                        _timing.connect_sec = \
+                            getattr(_timing, 'connect_sec', 0) + \
+                            clock() - start
+            return TimedConnection
+
+        class TimedHTTPConnectionPool(HTTPConnectionPool):
+            ConnectionCls = timed(HTTPConnectionPool.ConnectionCls)
+
+        class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+            ConnectionCls = timed(HTTPSConnectionPool.ConnectionCls)
+
+        class UnixHTTPConnection(HTTPConnectionPool.ConnectionCls):
+            def __init__(self, *args, **kwargs):
+                self.socket_path = kwargs.pop('socket_path')
+                super(UnixHTTPConnection, self).__init__(*args, **kwargs)
+
+            def _new_conn(self):
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                if isinstance(self.timeout, (int, float)):
+                    sock.settimeout(self.timeout)
+                try:
+                    sock.connect(self.socket_path)
+                except Exception:
+                    sock.close()
+                    raise
+                return sock
+
+        class TimedUnixHTTPConnectionPool(HTTPConnectionPool):
+            ConnectionCls = timed(UnixHTTPConnection)
+
+            def __init__(self, host, *args, **kwargs):
+                # the pool manager only drops them for the http scheme
+                for keyword in SSL_KEYWORDS:
+                    kwargs.pop(keyword, None)
+                # before the host gets lower cased
+                socket_path = unquote(host)
+                super(TimedUnixHTTPConnectionPool, self).__init__(
+                    host, *args, **kwargs)
+                self.conn_kw['socket_path'] = socket_path
+
+        _timed_pool_classes = {'http': TimedHTTPConnectionPool,
+                               'https': TimedHTTPSConnectionPool,
+                               UNIX_SCHEME: TimedUnixHTTPConnectionPool}
+    return _timed_pool_classes
+
+
+class Transport(object):
+    """
+    Thread-safe pool of keep-alive HTTP connections.
+
+    requests.Session objects are not safe to share between threads, so each
+    thread gets its own session. All the sessions mount the same HTTPAdapter,
+    which means they all draw from the same urllib3 connection pool.
+    """
+
+    def __init__(self, pool_size=10, pool_block=False, max_retries=0,
+                 keep_alive=True, metrics=None, coalesce=False,
+                 balancer=None):
+        """
+        Parameters
+        ----------
+        pool_size: int
+            Maximum number of connections kept open per host.
+        pool_block: bool
+            When True, threads wait for a free connection instead of opening
+            an extra (non pooled) one once pool_size is reached.
+        max_retries: int
+            Number of retries on connection errors.
+        keep_alive: bool
+            Whether to ask the server to keep connections open.
+        metrics: Metrics
+            Where every request is recorded. A new one by default.
+        coalesce: bool
+            When True, a GET identical (url, params, body and headers) to
+            one already in flight waits for it and returns the same
+            response instead of being sent again. Suppressed duplicates are
+            counted in coalescer.stats() and per route in metrics.
+        balancer: HostBalancer
+            Sends the reads addressed to its primary host to any of its
+            hosts, see balance.py.
+        """
+        # requests is imported on first use to keep `import pymldb` fast
+        from requests.adapters import HTTPAdapter
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+        self._adapter = HTTPAdapter(pool_connections=pool_size,
+                                    pool_maxsize=pool_size,
+                                    max_retries=max_retries,
+                                    pool_block=pool_block)
+        poolmanager = self._adapter.poolmanager
+        poolmanager.pool_classes_by_scheme = _get_timed_pool_classes()
+        poolmanager.key_fn_by_scheme[UNIX_SCHEME] = \
+            poolmanager.key_fn_by_scheme['http']
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.coalescer = SingleFlight() if coalesce else None
+        self.balancer = balancer
+        self._local = threading.local()
+        # weak references: a session goes away with the thread it belongs
+        # to (e.g. a ThreadPool worker), close() closes those still alive
+        self._sessions = weakref.WeakSet()
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        """The requests.Session bound to the calling thread."""
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            import requests
+            session = requests.Session()
+            session.mount('http://', self._adapter)
+            session.mount('https://', self._adapter)
+            session.mount(UNIX_SCHEME + '://', self._adapter)
+            if not self.keep_alive:
+                session.headers['Connection'] = 'close'
+            self._local.session = session
+            with self._lock:
+                self._sessions.add(session)
+        return session
+
+    def request(self, method, url, **kwargs):
+        if self.coalescer is not None and method == 'GET':
+            key = request_key(method, url, kwargs)
+            if key is not None:
+                response, suppressed = self.coalescer.do(
+                    key, lambda: self._send(method, url, **kwargs))
+                if suppressed:
+                    self.metrics.record_coalesced(method, url)
+                return response
+        return self._send(method, url, **kwargs)
+
+    def _send(self, method, url, **kwargs):
+        if self.balancer is not None:
+            return self.balancer.send(self._request, method, url, kwargs)
+        return self._request(method, url, **kwargs)
+
+    def _request(self, method, url, **kwargs):
+        metrics = self.metrics
+        if not metrics.enabled:
+            return self.session.request(method, url, **kwargs)
+
+        _timing.connect_sec = 0
+        start = clock()
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except Exception:
+            metrics.record_request(method, url, None, 0, 0,
+                                   {'total': clock() - start})
+            raise
+        total = clock() - start
+        connect = _timing.connect_sec
+        # elapsed: from sending the request until the headers are parsed
+        elapsed = response.elapsed.total_seconds()
+        body = response.request.body
+        received = 0
+        if not kwargs.get('stream'):
+            received = len(response.content)
+        metrics.record_request(
+            method, url, response.status_code,
+            len(response.request.url) +
+            (len(body) if hasattr(body, '__len__') else 0),
+            received,
+            {'connect': connect,
+             'server': max(elapsed - connect, 0),
+             'download': max(total - elapsed, 0),
+             'total': total})
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def warm_up(self, uri, num_connections=None, route='/v1/types'):
+        """
+        Opens num_connections (default: pool_size) connections to uri
+        concurrently so that the first real requests don't pay for the TCP
+        (and TLS) handshakes. Errors are ignored, an unreachable host will
+        be reported by the first real request.
+        """
+        if num_connections is None:
+            num_connections = self.pool_size
+        num_connections = min(num_connections, self.pool_size)
+        import requests
+
+        def ping():
+            try:
+                # not coalesced: each ping must open its own connection
+                self._request('GET', uri + route).content
+            except requests.RequestException:
+                pass
+
+        threads = [threading.Thread(target=ping)
+                   for _ in range(num_connections)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    def close(self):
+        with self._lock:
+            sessions = list(self._sessions)
+            self._sessions = weakref.WeakSet()
+        for session in sessions:
+            session.close()
+        self._adapter.close()
+        self._local = threading.local()
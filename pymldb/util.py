@@ -4,20 +4,30 @@
 #
 
 import types, json
-from pygments import highlight
-from pygments.lexers import JsonLexer
-from pygments.formatters import HtmlFormatter
-from pygments.style import Style
-from pygments.token import Keyword, Name, String, Number
 
-class PygmentsStyle(Style):
-    default_style = ""
-    styles = {
-        Name: 'bold #333', String: '#00d', Number: '#00d', Keyword: '#00d'
-    }
+_pygments_style = None
+
+def get_pygments_style():
+    # pygments is only needed to render responses in a notebook, import it on
+    # first use to keep `import pymldb` fast
+    global _pygments_style
+    if _pygments_style is None:
+        from pygments.style import Style
+        from pygments.token import Keyword, Name, String, Number
+
+        class PygmentsStyle(Style):
+            default_style = ""
+            styles = {
+                Name: 'bold #333', String: '#00d', Number: '#00d', Keyword: '#00d'
+            }
+        _pygments_style = PygmentsStyle
+    return _pygments_style
         
 def add_repr_html_to_response(resp):
     def _repr_html_(self):
+        from pygments import highlight
+        from pygments.lexers import JsonLexer
+        from pygments.formatters import HtmlFormatter
         result = "<strong>%s %s</strong><br />" % (self.request.method, self.request.url)
         color = "black"
         if self.status_code >= 400: color = "red" 
@@ -28,7 +38,7 @@ def add_repr_html_to_response(resp):
                 result += highlight(
                     json.dumps(self.json(), indent=2), 
                     JsonLexer(), 
-                    HtmlFormatter(noclasses = True, nobackground =True, style=PygmentsStyle)
+                    HtmlFormatter(noclasses = True, nobackground =True, style=get_pygments_style())
                     )
             elif self.headers["content-type"] == "text/html":
                 result += self.content
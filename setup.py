@@ -63,4 +63,9 @@ setup(
         'pygments',
         'requests[security]>=2.6',
     ],
+
+    # AsyncConnection (pymldb.aio), python 3 only
+    extras_require={
+        'async': ['aiohttp>=3.0'],
+    },
 )